@@ -0,0 +1,298 @@
+"""
+Benchmarks of the calibration tool. Example:
+    python benchmark.py startup cards/example_bb_PNetXbbVsQCD.yml
+    python benchmark.py processor cards/example_bb_PNetXbbVsQCD.yml --step 1
+    python benchmark.py xtagger cards/example_bb_PNetXbbVsQCD.yml
+    python benchmark.py h2d cards/example_bb_PNetXbbVsQCD.yml --nbin2d 200 400 800
+    python benchmark.py sfbdt cards/example_bb_PNetXbbVsQCD.yml --nthread 1 4
+
+"""
+
+from functools import partial
+from itertools import product
+import subprocess
+import statistics
+import datetime
+import json
+import time
+import sys
+import os
+
+from logger import _logger
+
+# heavy dependencies tracked in the startup benchmark
+HEAVY_MODULES = ['coffea', 'awkward', 'uproot', 'uproot3', 'xgboost', 'numba', 'scipy', 'boost_histogram', 'matplotlib', 'mplhep', 'seaborn']
+
+# run in a fresh interpreter: load the launcher and the card, then import the unit of the first step to run
+STARTUP_SNIPPET = '''
+import json, sys
+import launcher
+global_cfg = launcher.load_global_cfg(sys.argv[1])
+launcher.import_unit(sys.argv[2])
+print(json.dumps([m for m in sys.argv[3:] if m in sys.modules]))
+'''
+
+
+def get_first_step(global_cfg, run_step):
+    r"""The first step launched by `launcher.launch_routine` for the given run_step, or None if no step runs"""
+    if global_cfg.use_jet_skim and '1' in run_step[:3]:
+        return '0'
+    for i, flag in enumerate(run_step):
+        if flag == '1' and not (i == 0 and global_cfg.reuse_mc_weight_from_routine is not None):
+            return str(i + 1)
+    return None
+
+
+def benchmark_startup(config_path, run_steps=None, repeat=5, output=None):
+    r"""Measure the time-to-first-step (interpreter startup, launcher imports, card loading, and the import of the first
+        step's unit) for each run_step combination. Each measurement runs in a fresh interpreter."""
+    from launcher import load_global_cfg
+
+    global_cfg = load_global_cfg(config_path)
+    if run_steps is None:
+        run_steps = [''.join(digits) for digits in product('01', repeat=4) if '1' in digits]
+
+    results = {}
+    for run_step in run_steps:
+        first_step = get_first_step(global_cfg, run_step)
+        if first_step is None:
+            continue
+        times = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            proc = subprocess.run(
+                [sys.executable, '-c', STARTUP_SNIPPET, config_path, first_step] + HEAVY_MODULES,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True,
+            )
+            times.append(time.perf_counter() - start_time)
+        results[run_step] = {
+            'first_step': first_step,
+            'median': statistics.median(times),
+            'min': min(times),
+            'heavy_modules': json.loads(proc.stdout.strip().splitlines()[-1]),
+        }
+        _logger.info(f"run_step {run_step} (first step {first_step}): median {results[run_step]['median']:.2f}s, "
+                     f"min {results[run_step]['min']:.2f}s, loaded {results[run_step]['heavy_modules']}")
+
+    if output is not None:
+        # append to the history to track the startup time over commits
+        history = []
+        if os.path.isfile(output):
+            with open(output) as f:
+                history = json.load(f)
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+        history.append({'time': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit, 'repeat': repeat, 'results': results})
+        with open(output, 'w') as fw:
+            json.dump(history, fw, indent=4)
+        _logger.info(f'Benchmark results appended to {output}')
+    return results
+
+
+def benchmark_processor(config_path, step, repeat=3, chunksize=None, maxchunks=None):
+    r"""Measure the throughput (events/s) of the coffea processor of a step on a single core, using the iterative executor.
+        The outputs of the upstream steps should exist."""
+    from launcher import load_global_cfg, get_fileset, import_unit
+    from utils.resource_estimator import get_num_entries
+
+    global_cfg = load_global_cfg(config_path)
+    if chunksize is not None:
+        global_cfg.coffea_chunksize = chunksize
+    if maxchunks is not None:
+        global_cfg.coffea_maxchunks = maxchunks
+    fileset = get_fileset(global_cfg)
+    nevents = sum(get_num_entries(global_cfg, fileset).values())
+
+    unit = import_unit(step)(
+        global_cfg, fileset=fileset, workers=1, executor='iterative', chunksize=global_cfg.coffea_chunksize, maxchunks=global_cfg.coffea_maxchunks,
+    )
+    unit.preprocess()
+    times = []
+    for _ in range(repeat):
+        unit.initalize_processor()
+        start_time = time.perf_counter()
+        unit.run_coffea_job()
+        times.append(time.perf_counter() - start_time)
+    result = {'events': nevents, 'median': statistics.median(times), 'events_per_s': nevents / statistics.median(times)}
+    _logger.info(f"Step {step} processor: {nevents} events in {result['median']:.2f}s (median of {repeat}), {result['events_per_s']:.0f} events/s")
+    return result
+
+
+def benchmark_xtagger_map(config_path, repeat=5, size=1000000):
+    r"""Measure the throughput (values/s) of the tagger transformation map derived in step 2, compared to the cubic
+        interpolation it tabulates, and the deviation between them on random tagger values over the span"""
+    from launcher import load_global_cfg
+    import numpy as np
+    import pickle
+
+    global_cfg = load_global_cfg(config_path)
+    path = os.path.join('output', global_cfg.routine_name + '_' + str(global_cfg.year), '2_coastline', 'xtagger_map.pickle')
+    with open(path, 'rb') as f:
+        xtagger_map = pickle.load(f)
+    tagger = np.random.default_rng(42).uniform(xtagger_map.tmin, xtagger_map.tmax, size)
+
+    result = {'max_deviation': xtagger_map.max_deviation}
+    for name, func in [('cubic', xtagger_map.cubic_map()), ('lookup', xtagger_map)]:
+        times = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            func(tagger)
+            times.append(time.perf_counter() - start_time)
+        result[name] = size / statistics.median(times)
+        _logger.info(f'Tagger transformation ({name}): {result[name]:.3g} values/s')
+    result['sample_deviation'] = float(np.max(np.abs(xtagger_map(tagger) - xtagger_map.cubic_map()(tagger))))
+    _logger.info(f"Speedup {result['lookup'] / result['cubic']:.1f}x, maximum deviation {result['max_deviation']:.2e} "
+                 f"(on the sample: {result['sample_deviation']:.2e})")
+    return result
+
+
+def benchmark_h2d_grid(config_path, nbin2d_list=[200, 400, 800], nchunks=20, entries=10000, ndatasets=4):
+    r"""Measure the memory and the fill/merge time of the step 2 coastline grid (dataset x pT x sfBDT x xtagger) in the
+        dense and the sparse storage, with random entries filled in `nchunks` chunks. The memory is given by the
+        pickled size of one chunk output (sent from the workers) and of the merged result."""
+    from launcher import load_global_cfg
+    from utils.coffea_tools import HistAccumulator, SparseHistAccumulator
+    import numpy as np
+    import pickle
+    import hist
+
+    global_cfg = load_global_cfg(config_path)
+    rng = np.random.default_rng(42)
+    chunks = [{
+        'dataset': f'dataset{i % ndatasets}', 'pt': rng.uniform(global_cfg.pt_edges[0], 1000., entries),
+        'sfbdt': rng.beta(2., 2., entries), 'xtagger': rng.uniform(0., 1., entries), 'weight': rng.normal(1., 0.1, entries),
+    } for i in range(nchunks)]
+
+    results = {}
+    for nbin2d in nbin2d_list:
+        dataset = hist.axis.StrCategory([], name='dataset', label='dataset', growth=True)
+        axes = [
+            hist.axis.Variable(list(global_cfg.pt_edges) + [100000], name='pt', label='pt'),
+            hist.axis.Regular(nbin2d, 0., 1., name='sfbdt', label='sfbdt'),
+            hist.axis.Regular(nbin2d, 0., 1., name='xtagger', label='xtagger'),
+        ]
+        for storage, h in [
+            ('dense', HistAccumulator(dataset, *axes, storage=hist.storage.Weight(), label='Counts')),
+            ('sparse', SparseHistAccumulator(dataset, *axes, label='Counts')),
+        ]:
+            start_time = time.perf_counter()
+            outs = []
+            for chunk in chunks:
+                out = h.identity()
+                out.fill(**chunk)
+                outs.append(out)
+            fill_time = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            result = h.identity()
+            for out in outs:
+                result.add(out)
+            merge_time = time.perf_counter() - start_time
+            results[(nbin2d, storage)] = {
+                'fill_s': fill_time, 'merge_s': merge_time,
+                'chunk_bytes': len(pickle.dumps(outs[0])), 'result_bytes': len(pickle.dumps(result)),
+            }
+            r = results[(nbin2d, storage)]
+            _logger.info(f"nbin2d={nbin2d} {storage}: fill {r['fill_s']:.2f}s, merge {r['merge_s']:.2f}s, "
+                         f"chunk output {r['chunk_bytes'] / 1024**2:.1f} MB, merged result {r['result_bytes'] / 1024**2:.1f} MB")
+    return results
+
+
+def benchmark_sfbdt(config_path, repeat=3, size=100000, nthread_list=[1]):
+    r"""Measure the throughput (jets/s) of the customized sfBDT prediction, in the batched path of `XGBEnsemble` with each
+        number of threads and in the flat trees of `FlatTreeEnsemble`, compared to the former path (float64 inputs stacked
+        through a list, one DMatrix predicted by each fold on a single thread). The inputs are random, which does not matter
+        for the throughput of fixed-depth trees."""
+    from launcher import load_global_cfg
+    from utils.xgb_tools import XGBEnsemble, FlatTreeEnsemble
+    import awkward as ak
+    import numpy as np
+    import xgboost as xgb
+
+    global_cfg = load_global_cfg(config_path)
+    assert global_cfg.custom_sfbdt_path is not None, 'The sfBDT benchmark requires a customized sfBDT model (custom_sfbdt_path).'
+    model_files = [global_cfg.custom_sfbdt_path + '.%d' % i for i in range(global_cfg.custom_sfbdt_kfold)]
+    var_list = global_cfg.sfbdt_input_exprs
+    rng = np.random.default_rng(42)
+    inputs = {v: ak.from_numpy(rng.normal(0., 1., size)) for v in var_list}
+
+    def legacy_eval(bst_list, inputs):
+        dmat = xgb.DMatrix(np.array([inputs[k] for k in var_list]).T, feature_names=var_list)
+        preds = np.array([bst.predict(dmat) for bst in bst_list])
+        return preds.sum(axis=0) / len(bst_list)
+
+    legacy_bst_list = [xgb.Booster(params={'nthread': 1}, model_file=f) for f in model_files]
+    paths = [('legacy', partial(legacy_eval, legacy_bst_list))]
+    for nthread in nthread_list:
+        paths.append((f'batched nthread={nthread}', XGBEnsemble(model_files, var_list, nthread=nthread).eval))
+    paths.append(('flat', FlatTreeEnsemble(model_files, var_list).eval))
+
+    result, preds = {}, {}
+    for name, func in paths:
+        func({v: inputs[v][:10] for v in var_list}) # warm up (compile the numba kernel)
+        times = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            preds[name] = func(inputs)
+            times.append(time.perf_counter() - start_time)
+        result[name] = size / statistics.median(times)
+        _logger.info(f'sfBDT prediction ({name}): {result[name]:.3g} jets/s, speedup {result[name] / result["legacy"]:.2f}x, '
+                     f'maximum deviation {np.max(np.abs(preds[name] - preds["legacy"])):.2e}')
+    return result
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser('Benchmarks of the calibration tool')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_startup = subparsers.add_parser('startup', help='Measure the time-to-first-step for each run_step combination.')
+    parser_startup.add_argument('config_path')
+    parser_startup.add_argument('--run-steps', '-s', nargs='+', type=str, default=None,
+        help='The run_step combinations to benchmark (default: all combinations running at least one step).')
+    parser_startup.add_argument('--repeat', '-n', type=int, default=5,
+        help='Number of measurements for each run_step combination.')
+    parser_startup.add_argument('--output', type=str, default=None,
+        help='If specified, append the results to this JSON file to track the startup time over commits.')
+    parser_processor = subparsers.add_parser('processor', help='Measure the throughput of the coffea processor of a step on a single core.')
+    parser_processor.add_argument('config_path')
+    parser_processor.add_argument('--step', '-s', type=str, required=True, choices=['0', '1', '2', '3'],
+        help='The step to benchmark. The outputs of the upstream steps should exist.')
+    parser_processor.add_argument('--repeat', '-n', type=int, default=3,
+        help='Number of measurements.')
+    parser_processor.add_argument('--chunksize', type=int, default=None,
+        help='Number of events per chunk. Will overide the option in base config.')
+    parser_processor.add_argument('--maxchunks', type=int, default=None,
+        help='Maximum number of chunks to process per dataset. Will overide the option in base config.')
+    parser_xtagger = subparsers.add_parser('xtagger', help='Measure the throughput of the tagger transformation map. Step 2 should have run.')
+    parser_xtagger.add_argument('config_path')
+    parser_xtagger.add_argument('--repeat', '-n', type=int, default=5,
+        help='Number of measurements.')
+    parser_xtagger.add_argument('--size', type=int, default=1000000,
+        help='Number of tagger values to transform in each measurement.')
+    parser_h2d = subparsers.add_parser('h2d', help='Measure the memory and merge time of the step 2 coastline grid in dense and sparse storage.')
+    parser_h2d.add_argument('config_path')
+    parser_h2d.add_argument('--nbin2d', nargs='+', type=int, default=[200, 400, 800],
+        help='The numbers of bins of the grid on the transformed tagger and sfBDT.')
+    parser_h2d.add_argument('--nchunks', type=int, default=20,
+        help='Number of chunks to fill and merge.')
+    parser_h2d.add_argument('--entries', type=int, default=10000,
+        help='Number of jets filled per chunk.')
+    parser_sfbdt = subparsers.add_parser('sfbdt', help='Measure the throughput of the customized sfBDT prediction.')
+    parser_sfbdt.add_argument('config_path')
+    parser_sfbdt.add_argument('--repeat', '-n', type=int, default=3,
+        help='Number of measurements.')
+    parser_sfbdt.add_argument('--size', type=int, default=100000,
+        help='Number of jets to predict in each measurement.')
+    parser_sfbdt.add_argument('--nthread', nargs='+', type=int, default=[1],
+        help='The numbers of xgboost threads of the batched path.')
+    args = parser.parse_args()
+
+    if args.command == 'startup':
+        benchmark_startup(args.config_path, run_steps=args.run_steps, repeat=args.repeat, output=args.output)
+    elif args.command == 'processor':
+        benchmark_processor(args.config_path, args.step, repeat=args.repeat, chunksize=args.chunksize, maxchunks=args.maxchunks)
+    elif args.command == 'xtagger':
+        benchmark_xtagger_map(args.config_path, repeat=args.repeat, size=args.size)
+    elif args.command == 'h2d':
+        benchmark_h2d_grid(args.config_path, nbin2d_list=args.nbin2d, nchunks=args.nchunks, entries=args.entries)
+    elif args.command == 'sfbdt':
+        benchmark_sfbdt(args.config_path, repeat=args.repeat, size=args.size, nthread_list=args.nthread)
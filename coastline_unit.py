@@ -3,7 +3,8 @@ For step 2: calculate the sfBDT coastline on the target transformed tagger.
 
 """
 
-from coffea import processor, hist
+from coffea import processor
+import hist
 import awkward as ak
 import numpy as np
 import uproot
@@ -21,18 +22,101 @@ import mplhep as hep
 plt.style.use(hep.style.CMS)
 
 from functools import partial
+from itertools import product
+import hashlib
+import glob
 import pickle
 import shutil
 import json
 import os
 
-from unit import ProcessingUnit
+from unit import ProcessingUnit, StandaloneMultiThreadedUnit, FIT_CFG_KEYS
 from utils.web_maker import WebMaker
-from utils.tools import lookup_pt_based_weight, parse_tagger_expr, eval_expr
+from utils.tools import lookup_pt_based_weight, parse_tagger_expr, get_variable_names, eval_expr, get_jet_selection, get_columns, prefetch_columns, hash_object
+from utils.expr_tools import ExprEvaluator
+from utils.coffea_tools import HistAccumulator, SparseHistAccumulator, sort_categories
 from utils.fast_splines import interp2d
-from utils.xgb_tools import XGBEnsemble
+from utils.tagger_transform import TaggerTransformMap
+from utils.xgb_tools import get_sfbdt_model_files, load_sfbdt_model, make_sfbdt_cache
 from logger import _logger
 
+# default parameters to derive the sfBDT coastline, see `derive_coastline_map`
+DEFAULT_COASTLINE_PARAMS = {'sigma': 10, 'y_ex': 0.04, 'level_end': [0.6, 0.], 'nlevels': 12, 'skip_levels': 3}
+
+
+def get_coastline_params(global_cfg, **kwargs):
+    r"""The coastline parameters specified in the card (or overridden by `kwargs`), the missing ones taking the default values"""
+    params = {**DEFAULT_COASTLINE_PARAMS, **(global_cfg.coastline_params or {}), **kwargs}
+    assert set(params) == set(DEFAULT_COASTLINE_PARAMS), f"Unknown coastline parameters: {set(params) - set(DEFAULT_COASTLINE_PARAMS)}"
+    return params
+
+
+def derive_coastline_map(h2d_values, nbin2d, sigma, y_ex, level_end, nlevels, skip_levels):
+    r"""Derive the sfBDT coastline of each pT bin from the values of the pT-sfBDT-xtagger histogram (under/overflow included).
+        The sfBDT-cumulative 2D distribution is smeared by a gaussian filter of width `sigma` (in bins), with the sfBDT range
+        extended by `y_ex` beforehand. The contour levels are `nlevels` points spaced evenly from 0 to the smeared value at
+        `level_end` (xtagger, sfBDT), the first `skip_levels` of which are dropped.
+    """
+    coastline_map = []
+    for ipt in range(1, h2d_values.shape[0] - 1):
+        arr2d = h2d_values[ipt][1:-1, 1:-1].T # (dim_tagger, dim_sfbdt)
+        arr2d_norm = arr2d / np.sum(arr2d)
+
+        # accumulate 2D hist on the y-axis (sfBDT)
+        arr2d_cum = np.cumsum(arr2d_norm[:, ::-1], axis=1)[:, ::-1]
+
+        # extend the y-limit on sfBDT a bit to rescue from the gaussian filter
+        step = 1./ nbin2d
+        nstep_extend = int(y_ex / step)
+        x = y = np.arange(step/2, 1., step) # bin centers of the hist
+
+        # smear the 2d hist with gaussian filter
+        arr2d_cum_expend = np.zeros((arr2d_cum.shape[0], arr2d_cum.shape[1] + nstep_extend))
+        arr2d_cum_expend[:, :arr2d_cum.shape[1]] = arr2d_cum
+        arr2d_cum_smeared = scipy.ndimage.gaussian_filter(arr2d_cum_expend, sigma=sigma)[:, :arr2d_cum.shape[1]]
+        arr2d_cum_smeared[:, -1] = 0.
+
+        # define end point for the contour
+        level_en = arr2d_cum_smeared[min(int(level_end[0] * len(x)), len(x) - 1), min(int(level_end[1] * len(y)), len(y) - 1)]
+        levels = np.linspace(0, level_en, nlevels)[skip_levels:]
+
+        _logger.debug(f'Calculated coastline contour levels for pT bin {ipt}: {str(levels)}')
+
+        # fast-spline the 2d smeared hist
+        fspline = interp2d(x, y, arr2d_cum_smeared)
+
+        coastline_map.append({'arr2d': arr2d, 'arr2d_cum_smeared': arr2d_cum_smeared, 'fspline': fspline, 'levels': levels})
+    return coastline_map
+
+
+def concurrent_coastline_unit(arg):
+    r"""Unit concurrent task to derive the coastline of one parameter set in the scan"""
+    h2d_values, nbin2d, params = arg
+    return derive_coastline_map(h2d_values, nbin2d, **params)
+
+
+def get_anatree_files(anatree, year):
+    r"""The files of the main analysis tree: `path` can be a file path, a glob pattern, or a list of them"""
+    files = []
+    for path in (anatree.path if isinstance(anatree.path, list) else [anatree.path]):
+        path = path.replace("$YEAR", str(year))
+        files += sorted(glob.glob(path)) if glob.has_magic(path) else [path]
+    return files
+
+
+def concurrent_tagger_reading_unit(arg):
+    r"""Unit concurrent task to read an entry range of the main analysis tree. Return the tagger values and weights passing
+        the selection and within the tagger span."""
+    path, treename, branches, (selection, tagger, weight), (tmin, tmax), entry_start, entry_stop = arg
+    with uproot.open(path) as f:
+        df = f[treename].arrays(branches, entry_start=entry_start, entry_stop=entry_stop)
+    anatree_selection = eval_expr(selection, df)
+
+    tagger = ak.to_numpy(eval_expr(tagger, df)[anatree_selection])
+    weight = ak.to_numpy(eval_expr(weight, df)[anatree_selection])
+    sel = (tagger >= tmin) & (tagger <= tmax)
+    return tagger[sel], weight[sel]
+
 
 class CoastlineCoffeaProcessor(processor.ProcessorABC):
     r"""The coffea processor for the coastline and template writing step"""
@@ -41,36 +125,48 @@ class CoastlineCoffeaProcessor(processor.ProcessorABC):
         self.global_cfg = global_cfg
         self.weight_map = weight_map
         self.xtagger_map = xtagger_map
-        self.nbin2d = kwargs.pop('nbin2d', 200)
+        self.nbin2d = kwargs.pop('nbin2d', global_cfg.coastline_nbin2d)
         self.pt_reweight_edges = [edge[0] for edge in global_cfg.rwgt_pt_bins]
 
         self.tagger_expr = parse_tagger_expr(global_cfg.tagger_name_replace_map, global_cfg.tagger.expr)
         self.lookup_mc_weight = partial(lookup_pt_based_weight, self.weight_map, self.pt_reweight_edges, jet_var_maxlimit=2500)
+        self.columns = get_columns(global_cfg, *self.get_branches(global_cfg), on_skim=global_cfg.use_jet_skim)
         if self.global_cfg.custom_sfbdt_path is not None:
-            self.xgb = XGBEnsemble(
-                [self.global_cfg.custom_sfbdt_path + '.%d' % i for i in range(self.global_cfg.custom_sfbdt_kfold)],
-                self.global_cfg.sfbdt_input_exprs,
-            )
+            self.xgb = load_sfbdt_model(self.global_cfg)
+        self.sfbdt_cache = make_sfbdt_cache(self.global_cfg)
 
-        dataset = hist.Cat("dataset", "dataset")
+        dataset = hist.axis.StrCategory([], name='dataset', label='dataset', growth=True)
 
-        # fine 2D grids on tagger-sfBDT to derive the coastline
-        pt_bin = hist.Bin('pt', 'pt', list(global_cfg.pt_edges) + [100000])
-        sfbdt_grid = hist.Bin('sfbdt', 'sfbdt', self.nbin2d, 0., 1.)
-        xtagger_grid = hist.Bin('xtagger', 'xtagger', self.nbin2d, 0., 1.) # transformed tagger bin
-        h2d_grid = hist.Hist('Counts', dataset, pt_bin, sfbdt_grid, xtagger_grid)
+        # fine 2D grids on tagger-sfBDT to derive the coastline, stored sparsely as only a fraction of the bins is filled in
+        # each chunk. Densified in the postprocessing
+        pt_bin = hist.axis.Variable(list(global_cfg.pt_edges) + [100000], name='pt', label='pt')
+        sfbdt_grid = hist.axis.Regular(self.nbin2d, 0., 1., name='sfbdt', label='sfbdt')
+        xtagger_grid = hist.axis.Regular(self.nbin2d, 0., 1., name='xtagger', label='xtagger') # transformed tagger bin
+        h2d_grid = SparseHistAccumulator(dataset, pt_bin, sfbdt_grid, xtagger_grid, label='Counts')
 
         # sfBDT 1D hist to derive data/MC discrepancy used for uncertainty
-        jetidx_cat = hist.Cat('jetidx', 'jetidx')
-        pt_finebin = hist.Bin('pt', 'pt', list(self.pt_reweight_edges))
-        sfbdt_bin = hist.Bin('sfbdt', 'sfbdt', 50, 0., 1.)
-        h_sfbdt = hist.Hist('Counts', dataset, jetidx_cat, pt_finebin, sfbdt_bin)
+        jetidx_cat = hist.axis.StrCategory([], name='jetidx', label='jetidx', growth=True)
+        pt_finebin = hist.axis.Variable(list(self.pt_reweight_edges), name='pt', label='pt')
+        sfbdt_bin = hist.axis.Regular(50, 0., 1., name='sfbdt', label='sfbdt')
+        h_sfbdt = HistAccumulator(dataset, jetidx_cat, pt_finebin, sfbdt_bin, storage=hist.storage.Weight(), label='Counts')
 
         self._accumulator = processor.dict_accumulator({
             'h2d_grid': h2d_grid,
             'h_sfbdt': h_sfbdt,
+            'nbytes': processor.value_accumulator(int),
+            'expr_cache': processor.defaultdict_accumulator(int),
+            'sfbdt_cache': processor.defaultdict_accumulator(int),
         })
 
+    @staticmethod
+    def get_branches(global_cfg):
+        r"""The event-level and jet-level branches and the expressions read by the processor (see `get_columns`)"""
+        custom_sfbdt = global_cfg.custom_sfbdt_path is not None
+        event_branches = ['ht', 'genWeight', 'xsecWeight', 'puWeight', 'l1PreFiringWeight']
+        jet_branches = ['fj_x_pt', 'fj_x_nbhadrons', 'fj_x_nchadrons'] + ([] if custom_sfbdt else ['fj_x_sfBDT'])
+        exprs = [parse_tagger_expr(global_cfg.tagger_name_replace_map, global_cfg.tagger.expr)] + (list(global_cfg.sfbdt_input_exprs) if custom_sfbdt else [])
+        return event_branches, jet_branches, exprs
+
     @property
     def accumulator(self):
         return self._accumulator
@@ -78,39 +174,45 @@ class CoastlineCoffeaProcessor(processor.ProcessorABC):
 
     def process(self, events):
         out = self.accumulator.identity()
-        dataset = events.metadata['dataset']
+        metadata = events.metadata
+        dataset = metadata['dataset']
         is_mc = dataset != 'jetht'
 
-        presel = ak.numexpr.evaluate('passmetfilters & (' + '|'.join(self.global_cfg.hlt_branches[self.global_cfg.year]) + ')', events)
         lumi = self.global_cfg.lumi_dict[self.global_cfg.year]
+        events, nbytes = prefetch_columns(events, self.columns, self.global_cfg.coffea_decompression_workers)
+        out['nbytes'].add(nbytes)
+        evaluator = ExprEvaluator(events)
 
         for i in '12': # jet index
-            custom_sel = ak.numexpr.evaluate(self.global_cfg.custom_selection.replace('fj_x', f'fj_{i}'), events) if self.global_cfg.custom_selection is not None else ak.ones_like(presel, dtype=bool)
-            events_fj = events[(presel) & (events[f'fj_{i}_is_qualified']) & (custom_sel)]
+            sel, fj = get_jet_selection(events, i, self.global_cfg, on_skim=self.global_cfg.use_jet_skim, evaluator=evaluator)
+            events_fj = events[sel]
 
             # calculate weights and flavour variables
             if is_mc:
                 # calculate the MC-to-data weigts only for MC
-                mc_weight = self.lookup_mc_weight(f'fj{i}', events_fj[f'fj_{i}_pt'], events_fj['ht'])
-                weight = ak.numexpr.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeight*{lumi}', events_fj) * mc_weight
+                mc_weight = self.lookup_mc_weight(f'fj{i}', events_fj[f'{fj}_pt'], events_fj['ht'])
+                weight = evaluator.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeight*{lumi}', sel) * mc_weight
                 assert self.global_cfg.type in ['bb', 'cc', 'qq'], "Calibration type must be 'bb', 'cc', or 'qq'."
                 if self.global_cfg.type == 'bb':
-                    flv_sel = ak.numexpr.evaluate(f'fj_{i}_nbhadrons >= 1', events_fj)
+                    flv_sel = evaluator.evaluate(f'{fj}_nbhadrons >= 1', sel)
                 elif self.global_cfg.type == 'cc':
-                    flv_sel = ak.numexpr.evaluate(f'(fj_{i}_nbhadrons == 0) & (fj_{i}_nchadrons >= 1)', events_fj)
+                    flv_sel = evaluator.evaluate(f'({fj}_nbhadrons == 0) & ({fj}_nchadrons >= 1)', sel)
                 elif self.global_cfg.type == 'qq':
-                    flv_sel = ak.numexpr.evaluate(f'(fj_{i}_nbhadrons == 0) & (fj_{i}_nchadrons == 0)', events_fj)
+                    flv_sel = evaluator.evaluate(f'({fj}_nbhadrons == 0) & ({fj}_nchadrons == 0)', sel)
             else:
                 weight = ak.ones_like(events_fj.ht)
 
             # fill into histograms for each WP (range choices on tagger), MC only, flavour selection applied
             if self.global_cfg.custom_sfbdt_path is not None:
-                sfbdt_inputs = {v: ak.numexpr.evaluate(v.replace('fj_x', f'fj_{i}'), events_fj) for v in self.global_cfg.sfbdt_input_exprs}
-                sfbdt = ak.Array(self.xgb.eval(sfbdt_inputs))
+                predict = lambda: self.xgb.eval({v: evaluator.evaluate(v.replace('fj_x', fj), sel) for v in self.global_cfg.sfbdt_input_exprs})
+                if self.sfbdt_cache is not None:
+                    sfbdt = ak.Array(self.sfbdt_cache.get(metadata, f'{fj}_nominal', sel, predict, counter=out['sfbdt_cache']))
+                else:
+                    sfbdt = ak.Array(predict())
             else:
-                sfbdt = events_fj[f'fj_{i}_sfBDT']
+                sfbdt = events_fj[f'{fj}_sfBDT']
             if is_mc:
-                tagger_flv_sel = ak.numexpr.evaluate(self.tagger_expr.replace('fj_x', f'fj_{i}'), events_fj[flv_sel])
+                tagger_flv_sel = evaluator.evaluate(self.tagger_expr.replace('fj_x', fj), sel)[flv_sel]
                 # check how many event are beyond the tagger span
                 if (np.sum(tagger_flv_sel < self.global_cfg.tagger.span[0]) + np.sum(tagger_flv_sel > self.global_cfg.tagger.span[1])) / len(tagger_flv_sel) > 0.01:
                     _logger.warning(f"More than 1% of events are beyond the tagger span {self.global_cfg.tagger.span}. Is it expected?")
@@ -118,34 +220,41 @@ class CoastlineCoffeaProcessor(processor.ProcessorABC):
                 xtagger_flv_sel = self.xtagger_map(tagger_flv_sel)
                 out[f'h2d_grid'].fill(
                     dataset=dataset,
-                    pt=events_fj[f'fj_{i}_pt'][flv_sel],
+                    pt=events_fj[f'{fj}_pt'][flv_sel],
                     sfbdt=sfbdt[flv_sel],
                     xtagger=xtagger_flv_sel,
                     weight=weight[flv_sel],
+                    threads=self.global_cfg.coffea_fill_threads,
                 )
 
             # fill the sfbdt histograms for all MC and data, without flavour selection
             out[f'h_sfbdt'].fill(
                 dataset=dataset,
                 jetidx=i,
-                pt=events_fj[f'fj_{i}_pt'],
+                pt=events_fj[f'{fj}_pt'],
                 sfbdt=sfbdt,
                 weight=weight,
+                threads=self.global_cfg.coffea_fill_threads,
             )
 
+        out['expr_cache']['hits'] += evaluator.hits
+        out['expr_cache']['misses'] += evaluator.misses
         return out
 
 
     def postprocess(self, accumulator):
+        sort_categories(accumulator)
         return accumulator
 
 
 class CoastlineUnit(ProcessingUnit):
     r"""The unit processing wrapper of the second step (calculate the coastline and derive the fit template"""
 
+    fingerprint_exclude_cfg_keys = FIT_CFG_KEYS + ['skip_tmpl_writing', 'skip_inclusive_plot_writing', 'logmsv_div_by_binw']
+
     def __init__(self, global_cfg, job_name='2_coastline', job_name_step1='1_mc_reweight', fileset=None, **kwargs):
         # coastline variables
-        self.nbin2d = kwargs.pop('nbin2d', 200)
+        self.nbin2d = kwargs.pop('nbin2d', global_cfg.coastline_nbin2d)
 
         super().__init__(
             job_name=job_name,
@@ -167,25 +276,25 @@ class CoastlineUnit(ProcessingUnit):
         if not os.path.exists(self.webdir):
             os.makedirs(self.webdir)
 
+        # inputs of the step fingerprint
+        self.input_files = get_anatree_files(self.global_cfg.main_analysis_tree, self.global_cfg.year)
+        if self.global_cfg.custom_sfbdt_path is not None:
+            self.input_files += get_sfbdt_model_files(self.global_cfg)
+        self.upstream_artifacts = [os.path.join(self.outputdir_step1, 'hist.json')]
+        self.derived_processor_kwargs = ['weight_map', 'xtagger_map']
+
 
     def preprocess(self):
         ## 1. Obtain tagger shape from the provided signal analysis ROOT file
         anatree = self.global_cfg.main_analysis_tree
 
         if not hasattr(anatree, 'provide_tagger_array') or anatree.provide_tagger_array:
-            # read the tagger array from the main analysis signal tree
+            # read the tagger array from the main analysis signal tree, in chunks processed concurrently
             self.provide_tagger_array = True
-            df = uproot.lazy(anatree.path.replace("$YEAR", str(self.global_cfg.year)) + ':' + anatree.treename)
-            anatree_selection = eval_expr(anatree.selection, df)
-
-            tagger = eval_expr(anatree.tagger, df)[anatree_selection]
-            weight = eval_expr(anatree.weight, df)[anatree_selection]
+            tagger, weight = self.read_anatree_tagger(anatree)
 
             ## Transfrom the tagger to uniform distribution
             tmin, tmax = self.global_cfg.tagger.span
-            sel = (tagger >= tmin) & (tagger <= tmax)
-            tagger, weight = tagger[sel], weight[sel]
-
             nbin_hist = 1000
             hist = bh.Histogram(bh.axis.Regular(nbin_hist, tmin, tmax), storage=bh.storage.Weight())
             hist.fill(tagger, weight=weight)
@@ -194,7 +303,9 @@ class CoastlineUnit(ProcessingUnit):
             # use provided histogram as the direct template
             self.provide_tagger_array = False
             tmin, tmax = self.global_cfg.tagger.span
-            hist = uproot.open(anatree.path.replace("$YEAR", str(self.global_cfg.year)) + ':' + anatree.histname).to_boost()
+            anatree_files = get_anatree_files(anatree, self.global_cfg.year)
+            assert len(anatree_files) == 1, "Provide the tagger shape histogram in a single file."
+            hist = uproot.open(anatree_files[0] + ':' + anatree.histname).to_boost()
             nbin_hist = hist.axes[0].size
             assert tmin == hist.axes[0].edges[0] and tmax == hist.axes[0].edges[-1], \
                 f"Provide tagger shape histogram has range [{hist.axes[0].edges[0]}, {hist.axes[0].edges[-1]}] which does not match with the tagger span."
@@ -205,8 +316,10 @@ class CoastlineUnit(ProcessingUnit):
         y_cum = np.insert(np.cumsum(y / sum(y)), 0, 0.)
         # plt.plot(x, y_cum); plt.show()
 
-        # the tagger tranformation map is derived from the cumulative sum
-        self.xtagger_map = scipy.interpolate.interp1d(x, y_cum, kind='cubic')
+        # the tagger tranformation map is derived from the cumulative sum, tabulated on a dense grid for fast lookup
+        self.xtagger_map = TaggerTransformMap(x, y_cum)
+        _logger.debug(f'Tagger transformation map: cubic interpolation is monotone: {self.xtagger_map.is_monotone}, '
+                      f'maximum deviation of the lookup table: {self.xtagger_map.max_deviation:.2e}')
 
         if self.provide_tagger_array:
             # also store the signal hist info for later plot making
@@ -238,10 +351,13 @@ class CoastlineUnit(ProcessingUnit):
                     os.path.join('..', self.global_cfg.reuse_mc_weight_from_routine + '_' + str(self.global_cfg.year), self.job_name_step1),
                     self.outputdir_step1
                 )
-                shutil.copytree(
-                    os.path.join('web', self.global_cfg.reuse_mc_weight_from_routine + '_' + str(self.global_cfg.year), self.job_name),
-                    os.path.join('web', self.global_cfg.routine_name + '_' + str(self.global_cfg.year), self.job_name)
-                )
+                webdir_step1 = os.path.join('web', self.global_cfg.reuse_mc_weight_from_routine + '_' + str(self.global_cfg.year), self.job_name_step1)
+                if os.path.isdir(webdir_step1):
+                    shutil.copytree(
+                        webdir_step1,
+                        os.path.join('web', self.global_cfg.routine_name + '_' + str(self.global_cfg.year), self.job_name_step1),
+                        dirs_exist_ok=True,
+                    )
         if not os.path.isfile(os.path.join(self.outputdir_step1, 'hist.json')):
             _logger.exception('Cannot find ' + os.path.join(self.outputdir_step1, 'hist.json') + '\n' \
                 + 'Please run the previous step ' + self.job_name_step1 + ' first.')
@@ -257,6 +373,33 @@ class CoastlineUnit(ProcessingUnit):
         )
 
 
+    def read_anatree_tagger(self, anatree):
+        r"""Read the tagger values and weights from the main analysis tree, passing the selection and within the tagger span.
+            The files are split into entry ranges of `coffea_chunksize`, read concurrently with only the branches used in
+            the expressions."""
+        exprs = (anatree.selection, anatree.tagger, anatree.weight)
+        branches = sorted(set().union(*[get_variable_names(expr) for expr in exprs]))
+        chunks = []
+        for path in get_anatree_files(anatree, self.global_cfg.year):
+            with uproot.open(path) as f:
+                num_entries = f[anatree.treename].num_entries
+            chunks += [(path, start, min(start + self.global_cfg.coffea_chunksize, num_entries)) \
+                for start in range(0, num_entries, self.global_cfg.coffea_chunksize)]
+        _logger.info(f'Reading the signal tagger shape from {len(chunks)} chunks of the main analysis tree.')
+
+        args = [(path, anatree.treename, branches, exprs, self.global_cfg.tagger.span, start, stop) for path, start, stop in chunks]
+        if len(args) > 1 and self.workers > 1:
+            reader_handler = StandaloneMultiThreadedUnit(workers=min(self.workers, len(args)))
+            for arg in args:
+                reader_handler.book(arg)
+            result = reader_handler.run(concurrent_tagger_reading_unit)
+            if result is None:
+                raise KeyboardInterrupt
+        else:
+            result = [concurrent_tagger_reading_unit(arg) for arg in args]
+        return np.concatenate([r[0] for r in result]), np.concatenate([r[1] for r in result])
+
+
     def postprocess(self):
 
         _logger.info("[Postprocess]: Storing the sfBDT coastline histograms.")
@@ -265,47 +408,14 @@ class CoastlineUnit(ProcessingUnit):
         with open(os.path.join(self.outputdir, 'result.pickle'), 'wb') as fw:
             pickle.dump(self.result, fw)
         
-        # 2. Derive and store the sfBDT coastline
-        self.coastline_map = []
-    
-        # the xtagger-sfBDT map for all pT ranges (under/overflow included)
-        bh2d_pts = self.result['h2d_grid'].integrate('dataset').to_boost()
-        for ipt in range(1, len(self.global_cfg.pt_edges) + 1):
-            arr2d = bh2d_pts.view(flow=True).value[ipt][1:-1, 1:-1].T # (dim_tagger, dim_sfbdt)
-            arr2d_norm = arr2d / np.sum(arr2d)
-
-            # accumulate 2D hist on the y-axis (sfBDT)
-            arr2d_cum = np.cumsum(arr2d_norm[:, ::-1], axis=1)[:, ::-1]
-
-            # extend the y-limit on sfBDT a bit to rescue from the gaussian filter
-            step = 1./ self.nbin2d
-            y_ex = 0.04
-            nstep_extend = int(y_ex / step)
-            x = y = np.arange(step/2, 1. + step/2, step) # 200 bins correspond to the hist
-
-            # smear the 2d hist with gaussian filter
-            arr2d_cum_expend = np.zeros((arr2d_cum.shape[0], arr2d_cum.shape[1] + nstep_extend))
-            arr2d_cum_expend[:, :-nstep_extend] = arr2d_cum
-            arr2d_cum_smeared = scipy.ndimage.gaussian_filter(arr2d_cum_expend, sigma=10)[:, :-nstep_extend]
-            arr2d_cum_smeared[:, -1] = 0.
-
-            # define end point for the contour
-            level_en = arr2d_cum_smeared[int(0.6 * len(x)), 0]  # at point (0.6, 0)
-            levels = np.linspace(0, level_en, 12)[3:]
-
-            _logger.debug(f'Calculated coastline contour levels for pT bin {ipt}: {str(levels)}')
-
-            # fast-spline the 2d smeared hist
-            fspline = interp2d(x, y, arr2d_cum_smeared)
-
-            self.coastline_map.append({'arr2d': arr2d, 'arr2d_cum_smeared': arr2d_cum_smeared, 'fspline': fspline, 'levels': levels})
-        
+        # 2. Derive and store the sfBDT coastline, and those of the scanned parameters if requested
+        self.coastline_map = self.derive_coastline_maps()
         with open(os.path.join(self.outputdir, 'coastline_map.pickle'), 'wb') as fw:
             pickle.dump(self.coastline_map, fw)
 
         # 3. Store the sfBDT reweight hist to json file
         hist_values = {}
-        h_sfbdt = self.result['h_sfbdt'].to_boost()
+        h_sfbdt = self.result['h_sfbdt']
         for ipt, (ptmin, ptmax) in enumerate(self.global_cfg.rwgt_pt_bins):
             for i in '12':
                 sam_axes = h_sfbdt.axes[0]
@@ -329,6 +439,68 @@ class CoastlineUnit(ProcessingUnit):
             json.dump(hist_values, fw, indent=4)
 
 
+    def derive_coastline_maps(self):
+        r"""Derive the coastline with the parameters in the card, and with each parameter set of `coastline_scan`. The
+            derived coastlines are cached by the parameters (and the 2D histogram) under `coastline_cache/`, so that a
+            scanned parameter set is promoted without recalculation by specifying it as `coastline_params`.
+        """
+        h2d_values = self.result['h2d_grid'].to_hist()[{'dataset': sum}].values(flow=True)
+        h2d_digest = hashlib.sha1(np.ascontiguousarray(h2d_values).tobytes()).hexdigest()[:8]
+        cachedir = os.path.join(self.outputdir, 'coastline_cache')
+        os.makedirs(cachedir, exist_ok=True)
+        for filename in os.listdir(cachedir): # remove the coastlines derived from an outdated histogram
+            if not filename.startswith(h2d_digest):
+                os.remove(os.path.join(cachedir, filename))
+
+        # the nominal parameter set comes first, followed by all combinations of the scanned values
+        params_list = [get_coastline_params(self.global_cfg)]
+        scan = self.global_cfg.coastline_scan or {}
+        for values in product(*scan.values()):
+            params = get_coastline_params(self.global_cfg, **dict(zip(scan.keys(), values)))
+            if params not in params_list:
+                params_list.append(params)
+
+        cache_paths = [os.path.join(cachedir, f'{h2d_digest}_{hash_object(params)[:16]}.pickle') for params in params_list]
+        coastline_maps = [None] * len(params_list)
+        for i, path in enumerate(cache_paths):
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    coastline_maps[i] = pickle.load(f)['coastline_map']
+
+        # derive the missing coastlines concurrently
+        missing = [i for i in range(len(params_list)) if coastline_maps[i] is None]
+        if len(missing) > 1:
+            _logger.info(f'[Postprocess]: Deriving the sfBDT coastline for {len(missing)} parameter sets.')
+            scan_handler = StandaloneMultiThreadedUnit(workers=min(self.workers, len(missing)))
+            for i in missing:
+                scan_handler.book((h2d_values, self.nbin2d, params_list[i]))
+            result = scan_handler.run(concurrent_coastline_unit)
+            if result is None:
+                raise KeyboardInterrupt
+        else:
+            result = [derive_coastline_map(h2d_values, self.nbin2d, **params_list[i]) for i in missing]
+        for i, coastline_map in zip(missing, result):
+            coastline_maps[i] = coastline_map
+            with open(cache_paths[i] + '.tmp', 'wb') as fw:
+                pickle.dump({'params': params_list[i], 'coastline_map': coastline_map}, fw)
+            os.replace(cache_paths[i] + '.tmp', cache_paths[i])
+        _logger.info(f'[Postprocess]: Coastline of {len(params_list)} parameter sets ({len(params_list) - len(missing)} from the cache).')
+
+        # summarize the contour levels of the scanned parameter sets
+        self.coastline_scan = None
+        if not len(scan) and os.path.isfile(os.path.join(self.outputdir, 'coastline_scan.json')):
+            os.remove(os.path.join(self.outputdir, 'coastline_scan.json'))
+        if len(scan):
+            self.coastline_scan = [
+                {'params': params, 'cache': os.path.basename(path), 'levels': [cmap['levels'].tolist() for cmap in coastline_map]}
+                    for params, path, coastline_map in zip(params_list, cache_paths, coastline_maps)
+            ]
+            with open(os.path.join(self.outputdir, 'coastline_scan.json'), 'w') as fw:
+                json.dump(self.coastline_scan, fw, indent=4)
+
+        return coastline_maps[0]
+
+
     def make_webpage(self):
 
         _logger.info('[Make webpage]: Making the sfBDT coastline.')
@@ -386,14 +558,14 @@ class CoastlineUnit(ProcessingUnit):
         web.add_h1("Tagger transformation")
         anatree = self.global_cfg.main_analysis_tree
         if self.provide_tagger_array:
-            web.add_text(f"Signal sample: `{anatree.path.replace('$YEAR', str(self.global_cfg.year))}:{anatree.treename}`.")
+            web.add_text(f"Signal sample: `{', '.join(get_anatree_files(anatree, self.global_cfg.year))}:{anatree.treename}`.")
             web.add_text(f"Applied selection: `{anatree.selection}`. Tagger name/expression: `{anatree.tagger}`\n")
             web.add_text(f"Defined WPs: {self.global_cfg.tagger.wps}\n")
             web.add_text(r"This corresponds to the signal effiency at: {%s}" %
                 ', '.join([f'{wp}: [{lo*100:.1f}\%, {hi*100:.1f}\%]' for wp, (lo, hi) in zip(self.global_cfg.tagger.wps.keys(), sig_effs)]))
             web.add_text()
         else:
-            web.add_text(f"Provided signal tagger shape in histogram: `{anatree.path.replace('$YEAR', str(self.global_cfg.year))}:{anatree.histname}`.")
+            web.add_text(f"Provided signal tagger shape in histogram: `{get_anatree_files(anatree, self.global_cfg.year)[0]}:{anatree.histname}`.")
             web.add_text()
 
         web.add_figure(self.webdir, src='tagger_trans.png', title='tagger transformation map')
@@ -431,7 +603,7 @@ class CoastlineUnit(ProcessingUnit):
             f, ax = plt.subplots(figsize=(10, 10))
             hep.cms.label(data=True, llabel='Preliminary', year=year, ax=ax, rlabel=r'%s $fb^{-1}$ (13 TeV)' % lumi, fontname='sans-serif')
             step = 1./ self.nbin2d
-            x = y = np.arange(step/2, 1. + step/2, step) ## 200 bins correspond to the hist
+            x = y = np.arange(step/2, 1., step) # bin centers of the hist
             Y, X = np.meshgrid(y, x)
             CS = ax.contour(X, Y, self.coastline_map[i]['arr2d_cum_smeared'], levels=self.coastline_map[i]['levels'])
             ax.clabel(CS, inline=0, fontsize=10)
@@ -443,5 +615,16 @@ class CoastlineUnit(ProcessingUnit):
             plt.close()
 
             web.add_figure(self.webdir, src=f'coastline_{year}_pt{ptmin}to{ptmax}.png', title=f'pT ({ptmin}, {ptmax})')
-        
+
+        if getattr(self, 'coastline_scan', None) is not None:
+            web.add_h2('Coastline parameter scan')
+            web.add_text(f"Current parameters: `{get_coastline_params(self.global_cfg)}`. To promote a scanned parameter set, "
+                "specify it as `coastline_params` and rerun this step with `--skip-coffea`.")
+            web.add_text()
+            web.add_text('| parameters | ' + ' | '.join([f'levels at pT ({ptmin}, {ptmax})' for ptmin, ptmax in zip(pt_edges[:-1], pt_edges[1:])]) + ' |')
+            web.add_text('| --- ' * len(pt_edges) + '|')
+            for entry in self.coastline_scan:
+                web.add_text(f"| `{entry['params']}` | " + ' | '.join([', '.join([f'{v:.3f}' for v in levels]) for levels in entry['levels']]) + ' |')
+            web.add_text()
+
         web.write_to_file(self.webdir)
\ No newline at end of file
@@ -4,12 +4,9 @@ For step 4: apply the fit to derive SFs, then make plots for the fit.
 """
 
 import numpy as np
-import uproot
-import uproot3
 
 import matplotlib.pyplot as plt
 import matplotlib as mpl
-import seaborn as sns
 from cycler import cycler 
 mpl.use('Agg')
 mpl.rcParams['axes.prop_cycle'] = cycler(color=['blue', 'red', 'green', 'violet', 'darkorange', 'black', 'cyan', 'yellow'])
@@ -40,9 +37,27 @@ def runcmd(cmd, shell=True):
     return (out, p.returncode)
 
 
+# set once the CMSSW environment is set up in this process (or in the parent process before forking)
+_cmssw_env_ready = False
+
+def setup_cmssw_env():
+    r"""Set up the CMSSW environment used by the fit, once per process tree"""
+    global _cmssw_env_ready
+    if _cmssw_env_ready:
+        return
+    _logger.info("[Postprocess]: Set up the CMSSW environment...")
+    out, ret = runcmd("bash cmssw/wrapper.sh cmssw/env_setup.sh")
+    if ret != 0:
+        _logger.error("Error running cmssw setup:\n\n" + out)
+        raise RuntimeError('Error running cmssw setup.')
+    _cmssw_env_ready = True
+
+
 class FitUnit(ProcessingUnit):
     r"""The unit processing wrapper of the second step (calculate the coastline and derive the fit template"""
 
+    fingerprint_exclude_cfg_keys = ['skip_tmpl_writing', 'skip_inclusive_plot_writing', 'coastline_scan']
+
     def __init__(self, global_cfg, job_name='4_fit', job_name_step1='1_mc_reweight', job_name_step2='2_coastline', 
                  job_name_step3='3_tmpl_writer', fileset=None, **kwargs):
         super().__init__(
@@ -65,6 +80,12 @@ class FitUnit(ProcessingUnit):
             os.makedirs(self.outputdir)
         if not os.path.exists(self.webdir):
             os.makedirs(self.webdir)
+
+        # inputs of the step fingerprint
+        self.upstream_artifacts = [
+            os.path.join(self.outputdir_step3, 'tmpl_fitpath.pickle'),
+            os.path.join(self.outputdir_step3, 'tmpl_hist.pickle'),
+        ]
         
 
     def preprocess(self):
@@ -80,6 +101,12 @@ class FitUnit(ProcessingUnit):
             self.tmpl_fitpath = pickle.load(f)
         
         # Load the fitting and plotting arguments
+        self.init_fit_options()
+
+
+    def init_fit_options(self):
+        import seaborn as sns
+
         self.fit_options = SimpleNamespace( # args for plot maker
             year=self.global_cfg.year,
             lumi=self.global_cfg.lumi_dict[self.global_cfg.year],
@@ -99,19 +126,18 @@ class FitUnit(ProcessingUnit):
             logmsv_div_by_binw=self.global_cfg.logmsv_div_by_binw,
         )
 
-    def postprocess(self):
 
-        _logger.info("[Postprocess]: Launch the fit in the threaded workflow.")
+    def setup_fit(self):
+        r"""Set up the CMSSW environment and the concurrent fit handler"""
 
-        # 1. Setup CMSSW environment
-        _logger.info("[Postprocess]: Set up the CMSSW environment...")
-        out, ret = runcmd("bash cmssw/wrapper.sh cmssw/env_setup.sh")
-        if ret != 0:
-            _logger.exception("Error running cmssw setup:\n\n" + out)
-            raise
-        
-        # 2. Launch the fit then make plots
-        fit_handler = StandaloneMultiThreadedUnit(workers=self.workers, use_unordered_mapping=True)
+        setup_cmssw_env()
+        self.fit_handler = StandaloneMultiThreadedUnit(
+            workers=self.workers, use_unordered_mapping=True, runtime_model_path=os.path.join(self.outputdir, 'runtime_model.json')
+        )
+
+
+    def get_fit_arguments(self, tmpl_fitpath):
+        r"""Get the arguments of all fit points for the given template paths"""
 
         def is_central_sfbdt(path):
             r"""find the central BDT point"""
@@ -120,40 +146,81 @@ class FitUnit(ProcessingUnit):
             c_bdt = sorted(bdtdirs)[int((len(bdtdirs) - 1)/2)]
             return os.path.basename(os.path.normpath(path)) == c_bdt
 
-        def get_fit_arguments():
-            # Launch in three fit mode:
-            n_fit = 0
-            args_collection = []
-            for mode, readflag in zip(['main', 'sfbdt_rwgt', 'fit_var_rwgt'], \
-                [self.global_cfg.do_main_fit, self.global_cfg.do_sfbdt_rwgt_fit, self.global_cfg.do_fit_var_rwgt_fit]):
-                if readflag: # ok, will run this fit scheme
-                    non_central_fit = []
-                    for path in self.tmpl_fitpath:
-                        # workpath is under "4_fit/{mode}" while input card path is under "3_tmpl_writer/cards"
-                        workpath = path.replace(self.job_name_step3 + '/cards', self.job_name + f'/{mode}')
-                        is_central = is_central_sfbdt(path)
-                        if is_central:
-                            # launch central BDT first as it may take longer time
-                            # the central BDT cut is the nominal fit point. Run more fit utilities for these cases
-                            args_collection.append((path, workpath, self.fit_options, is_central, mode,))
-                            n_fit += 1
-                            if self.global_cfg.test_n_fit != -1 and n_fit >= self.global_cfg.test_n_fit:
-                                return args_collection
-                        else:
-                            non_central_fit.append((path, workpath))
-                    if not self.global_cfg.run_central_fit_only:
-                        for path, workpath in non_central_fit:
-                            # launch non-central points after all central ones are submitted
-                            args_collection.append((path, workpath, self.fit_options, is_central, mode,))
-                            if self.global_cfg.test_n_fit != -1 and n_fit >= self.global_cfg.test_n_fit:
-                                return args_collection
-            return args_collection
-
-        # run all fits concurrently
-        _logger.info(f"[Postprocess]: Launch all fit points on {self.workers} concurrent workers.")
-        for args in get_fit_arguments():
-            fit_handler.book(args)
-        result = fit_handler.run(concurrent_fit_unit)
+        # Launch in three fit mode:
+        n_fit = 0
+        args_collection = []
+        for mode, readflag in zip(['main', 'sfbdt_rwgt', 'fit_var_rwgt'], \
+            [self.global_cfg.do_main_fit, self.global_cfg.do_sfbdt_rwgt_fit, self.global_cfg.do_fit_var_rwgt_fit]):
+            if readflag: # ok, will run this fit scheme
+                non_central_fit = []
+                for path in tmpl_fitpath:
+                    # workpath is under "4_fit/{mode}" while input card path is under "3_tmpl_writer/cards"
+                    workpath = path.replace(self.job_name_step3 + '/cards', self.job_name + f'/{mode}')
+                    is_central = is_central_sfbdt(path)
+                    if is_central:
+                        # launch central BDT first as it may take longer time
+                        # the central BDT cut is the nominal fit point. Run more fit utilities for these cases
+                        args_collection.append((path, workpath, self.fit_options, is_central, mode,))
+                        n_fit += 1
+                        if self.global_cfg.test_n_fit != -1 and n_fit >= self.global_cfg.test_n_fit:
+                            return args_collection
+                    else:
+                        non_central_fit.append((path, workpath))
+                if not self.global_cfg.run_central_fit_only:
+                    for path, workpath in non_central_fit:
+                        # launch non-central points after all central ones are submitted
+                        args_collection.append((path, workpath, self.fit_options, is_central, mode,))
+                        if self.global_cfg.test_n_fit != -1 and n_fit >= self.global_cfg.test_n_fit:
+                            return args_collection
+        return args_collection
+
+
+    def book_fit(self, args, submit=False):
+        # central fits run impacts and uncertainty breakdown, taking much longer than other points
+        path, workpath, fit_options, is_central, mode = args
+        cost_key = mode + ('_central' if is_central else '') + ('_skipfit' if fit_options.skip_fit else '')
+        if not submit:
+            self.fit_handler.book(args, cost_key=cost_key, prior=600. if is_central else 30.)
+        else:
+            self.fit_handler.submit(args, cost_key=cost_key, prior=600. if is_central else 30.)
+
+
+    def start_streaming(self):
+        r"""Streaming mode: the fit points are submitted by `submit_fit_points` as soon as their templates are written
+            in step 3, then collected in the postprocessing. The fit points should not be limited by `test_n_fit`."""
+        assert self.global_cfg.test_n_fit == -1, "The streaming mode does not support test_n_fit."
+        _logger.info(f"Launch the fit points on {self.workers} concurrent workers as soon as their templates are written.")
+        self.init_fit_options()
+        self.setup_fit()
+        self.fit_handler.start(concurrent_fit_unit)
+        self.streaming = True
+
+
+    def submit_fit_points(self, tmpl_fitpath):
+        for args in self.get_fit_arguments(tmpl_fitpath):
+            self.book_fit(args, submit=True)
+
+
+    def postprocess(self):
+
+        _logger.info("[Postprocess]: Launch the fit in the threaded workflow.")
+
+        if getattr(self, 'streaming', False):
+            # the fit points are already submitted in the streaming mode
+            _logger.info("[Postprocess]: Wait for the fit points submitted during the template writing.")
+            result = self.fit_handler.join()
+            # the points are submitted in the order the templates are written: restore the order of the barrier mode
+            order = {args[1]: i for i, args in enumerate(self.get_fit_arguments(self.tmpl_fitpath))}
+            result = sorted(result, key=lambda res: order[res[0]])
+        else:
+            # 1. Setup CMSSW environment and the fit handler
+            self.setup_fit()
+
+            # 2. Launch the fit then make plots
+            _logger.info(f"[Postprocess]: Launch all fit points on {self.workers} concurrent workers.")
+            for args in self.get_fit_arguments(self.tmpl_fitpath):
+                self.book_fit(args)
+            result = self.fit_handler.run(concurrent_fit_unit)
 
         # summarize when all jobs are done
         failed_dirpath = []
@@ -5,19 +5,34 @@ Launcher for the command line interface to the calibration tool. Example:
 """
 
 from types import SimpleNamespace
+import multiprocessing
 import copy
 import yaml
 import json
+import importlib
 import ast
 import os
 
-from mc_reweight_unit import MCReweightUnit
-from coastline_unit import CoastlineUnit
-from tmpl_writer_unit import TmplWriterUnit
-from fit_unit import FitUnit
+from unit import MultiCardUnit, RUNTIME_CFG_KEYS
+from utils.tools import hash_object
 from utils.web_maker import WebMaker
 from logger import _logger
 
+# module and class of the unit of each step. Units are only imported when their step runs, as they load heavy dependencies
+# (coffea, xgboost, numba, matplotlib, ...) at import time
+STEP_UNITS = {
+    '0': ('skim_unit', 'SkimUnit'),
+    '1': ('mc_reweight_unit', 'MCReweightUnit'),
+    '2': ('coastline_unit', 'CoastlineUnit'),
+    '3': ('tmpl_writer_unit', 'TmplWriterUnit'),
+    '4': ('fit_unit', 'FitUnit'),
+}
+
+
+def import_unit(step):
+    module_name, cls_name = STEP_UNITS[step]
+    return getattr(importlib.import_module(module_name), cls_name)
+
 
 def load_global_cfg(config_path):
     r"""Load the global configuration from the base config file and custom file"""
@@ -42,83 +57,272 @@ def write_global_cfg(cfg, webpage):
     web.write_to_file(webpage, filename='global_cfg.html')
 
 
+def get_fileset(global_cfg):
+    basedir = global_cfg.sample_prefix.replace('$YEAR', str(global_cfg.year))
+    return {sample: [os.path.join(basedir, relpath)] for sample, relpath in global_cfg.fileset_template.items()}
+
+
+def get_coffea_kwargs(global_cfg):
+    return dict(
+        executor=global_cfg.coffea_executor,
+        chunksize=global_cfg.coffea_chunksize,
+        maxchunks=global_cfg.coffea_maxchunks,
+        retries=global_cfg.coffea_retries,
+        checkpoint=global_cfg.coffea_checkpoint,
+        checkpoint_interval=global_cfg.coffea_checkpoint_interval,
+    )
+
+
+def write_routine_webpage(global_cfg):
+    r"""Make the navigation webpage of a routine"""
+
+    job_name = global_cfg.routine_name + '_' + str(global_cfg.year)
+    webpage = os.path.join('web', job_name)
+    web = WebMaker(job_name)
+    web.add_h1("Content")
+    web.add_text(f"Results written by the `boohft-calib` framework {global_cfg.version}.")
+    web.add_text()
+    web.add_text(' 1. [MC reweighting](1_mc_reweight/): MC-to-data reweight plots.')
+    web.add_text(' 2. [sfBDT coastline](2_coastline/): visualize the sfBDT coastline cut to make good gluon-spliting proxy.')
+    web.add_text(' 3. [template writer](3_tmpl_writer/): Some inclusive plots on relavent variables.')
+    web.add_text(' 4. [>> *SF summary* <<](4_fit/): Fit results and SF summary.')
+    web.add_text()
+    web.add_text('[Global config](global_cfg.html) for this routine.')
+    web.write_to_file(webpage)
+    write_global_cfg(global_cfg, webpage)
+
+    _logger.info(f'Job done! Everything write to webpage: {webpage}')
+
+
 def launch_routine(global_cfg):
 
     _logger.info(f'Run with the global configuration: {global_cfg}')
 
-    basedir = global_cfg.sample_prefix.replace('$YEAR', str(global_cfg.year))
-    fileset = {sample: [os.path.join(basedir, relpath)] for sample, relpath in global_cfg.fileset_template.items()}
+    fileset = get_fileset(global_cfg)
     workers = global_cfg.workers
     run_step = str(global_cfg.run_step)
     assert len(workers) == 4, "Invaild arguemnt for 'workers'."
     assert len(run_step) == 4 and all(i in '01' for i in run_step), "Invaild arguemnt for 'run_step'."
+    coffea_kwargs = get_coffea_kwargs(global_cfg)
+
+    # Run the optional step 0: the jet-level skim is reused by step 1-3
+    if global_cfg.use_jet_skim and '1' in run_step[:3]:
+        step_0 = import_unit('0')(global_cfg, fileset=fileset, workers=workers[0], **coffea_kwargs)
+        skim_fileset = step_0.load_skim_fileset()
+        if skim_fileset is None:
+            _logger.info('Launch step 0: write the jet-level skim used by step 1-3...')
+            step_0.launch()
+            skim_fileset = step_0.skim_fileset
+        else:
+            _logger.info('Skip step 0 and reuse the existing jet-level skim.')
+        fileset = skim_fileset
+        coffea_kwargs['treename'] = 'Jets'
 
     # Run step 1-4 sequence
     if run_step[0] == '1':
         if global_cfg.reuse_mc_weight_from_routine is None:
             _logger.info('Launch step 1: reweight total MC to data due to the use of prescaled HT triggers...')
-            step_1 = MCReweightUnit(global_cfg, fileset=fileset, workers=workers[0])
-            step_1.launch(skip_coffea=global_cfg.skip_coffea)
+            step_1 = import_unit('1')(global_cfg, fileset=fileset, workers=workers[0], **coffea_kwargs)
+            step_1.launch(skip_coffea=global_cfg.skip_coffea, incremental=global_cfg.incremental)
         else:
             _logger.info(f'Skip step 1 and reuse MC reweight factors from routine {global_cfg.reuse_mc_weight_from_routine}')
 
     if run_step[1] == '1':
         _logger.info('Launch step 2: calculate the sfBDT coastline on the target transformed tagger...')
-        step_2 = CoastlineUnit(global_cfg, fileset=fileset, workers=workers[1])
-        step_2.launch(skip_coffea=global_cfg.skip_coffea)
+        step_2 = import_unit('2')(global_cfg, fileset=fileset, workers=workers[1], **coffea_kwargs)
+        step_2.launch(skip_coffea=global_cfg.skip_coffea, incremental=global_cfg.incremental)
+
+    # stream the templates of each (WP, pT) point to the fit as soon as they are written
+    stream_tmpl_to_fit = global_cfg.stream_tmpl_to_fit and run_step[2:] == '11'
+    if stream_tmpl_to_fit and (global_cfg.skip_tmpl_writing or global_cfg.incremental or global_cfg.test_n_fit != -1):
+        _logger.warning('Streaming the templates to the fit is not supported with skip_tmpl_writing, incremental, or test_n_fit. '
+                        'Run step 3 and 4 one after another.')
+        stream_tmpl_to_fit = False
 
     if run_step[2] == '1':
         _logger.info('Launch step 3: derive the template for fit...')
-        step_3 = TmplWriterUnit(global_cfg, fileset=fileset, workers=workers[2])
-        step_3.launch(skip_coffea=global_cfg.skip_coffea)
+        step_3 = import_unit('3')(global_cfg, fileset=fileset, workers=workers[2], **coffea_kwargs)
+        if stream_tmpl_to_fit:
+            step_4 = import_unit('4')(global_cfg, fileset=fileset, workers=workers[3])
+            step_4.start_streaming()
+            step_3.on_tmpl_written = step_4.submit_fit_points
+        step_3.launch(skip_coffea=global_cfg.skip_coffea, incremental=global_cfg.incremental)
     
     if run_step[3] == '1':
         _logger.info('Launch step 4: apply the fit to derive SFs, then make plots for the fit...')
-        step_4 = FitUnit(global_cfg, fileset=fileset, workers=workers[3])
-        step_4.launch(skip_coffea=global_cfg.skip_coffea)
+        if not stream_tmpl_to_fit:
+            step_4 = import_unit('4')(global_cfg, fileset=fileset, workers=workers[3])
+        step_4.launch(skip_coffea=global_cfg.skip_coffea, incremental=global_cfg.incremental)
 
     # Make navigation webpage
-    job_name = global_cfg.routine_name + '_' + str(global_cfg.year)
-    webpage = os.path.join('web', job_name)
-    web = WebMaker(job_name)
-    web.add_h1("Content")
-    web.add_text(f"Results written by the `boohft-calib` framework {global_cfg.version}.")
-    web.add_text()
-    web.add_text(' 1. [MC reweighting](1_mc_reweight/): MC-to-data reweight plots.')
-    web.add_text(' 2. [sfBDT coastline](2_coastline/): visualize the sfBDT coastline cut to make good gluon-spliting proxy.')
-    web.add_text(' 3. [template writer](3_tmpl_writer/): Some inclusive plots on relavent variables.')
-    web.add_text(' 4. [>> *SF summary* <<](4_fit/): Fit results and SF summary.')
-    web.add_text()
-    web.add_text('[Global config](global_cfg.html) for this routine.')
-    web.write_to_file(webpage)
-    write_global_cfg(global_cfg, webpage)
+    write_routine_webpage(global_cfg)
+
+
+def launch_concurrent_routines(global_cfgs, total_workers=None):
+    r"""Launch the routines (e.g. of different years) in parallel processes. The budget of `total_workers` (default to the
+        number of CPUs) is split evenly across the routines, capping the workers of each step."""
+
+    if total_workers is None:
+        total_workers = os.cpu_count()
+    budget = max(total_workers // len(global_cfgs), 1)
+
+    # the shared setup is done once before forking: the directories of each routine, and the CMSSW environment of the fit
+    # which all routines would otherwise install at the same time
+    for global_cfg in global_cfgs:
+        for basedir in ['output', 'web']:
+            os.makedirs(os.path.join(basedir, global_cfg.routine_name + '_' + str(global_cfg.year)), exist_ok=True)
+    if any(str(global_cfg.run_step)[3] == '1' for global_cfg in global_cfgs):
+        importlib.import_module(STEP_UNITS['4'][0]).setup_cmssw_env()
+
+    procs = []
+    for global_cfg in global_cfgs:
+        global_cfg.workers = [min(w, budget) for w in global_cfg.workers]
+        _logger.info(f'Launch the routine for year {global_cfg.year} with workers {global_cfg.workers}.')
+        p = multiprocessing.Process(target=launch_routine, args=(global_cfg,))
+        p.start()
+        procs.append(p)
+
+    failed_years = []
+    for global_cfg, p in zip(global_cfgs, procs):
+        p.join()
+        if p.exitcode != 0:
+            failed_years.append(global_cfg.year)
+    if len(failed_years):
+        _logger.error(f'The routine failed for year(s): {failed_years}')
+        raise RuntimeError(f'The routine failed for year(s): {failed_years}')
+
+
+def get_batch_group_key(global_cfg):
+    r"""Cards sharing the input ntuples, the selection, and the MC reweighting (step 1) are processed in one batch"""
+    exclude_keys = RUNTIME_CFG_KEYS + import_unit('1').fingerprint_exclude_cfg_keys + ['routine_name', 'version']
+    return hash_object({k: v for k, v in vars(global_cfg).items() if k not in exclude_keys})
 
-    _logger.info(f'Job done! Everything write to webpage: {webpage}')
 
+def launch_batch_routines(global_cfgs):
+    r"""Launch the routines of multiple cards. Cards sharing the input ntuples and selection are grouped: step 1 runs once
+        per group, the coffea jobs of step 2 and 3 fill the histograms of all cards in a single pass over the events, then
+        the postprocessing and the fit run for each card."""
 
-def launch(config_path, workers=None, run_step=None, skip_coffea=None, options=None, multi_years=None):
-    r"""Launch all steps"""
+    groups = {}
+    for global_cfg in global_cfgs:
+        groups.setdefault(get_batch_group_key(global_cfg), []).append(global_cfg)
 
-    global_cfg_base = load_global_cfg(config_path)
-    if workers is not None:
-        global_cfg_base.workers = workers
-    if run_step is not None:
-        global_cfg_base.run_step = run_step
-    if skip_coffea is not None:
-        global_cfg_base.skip_coffea = skip_coffea
+    for group in groups.values():
+        _logger.info(f'Launch the batch of routines: {[global_cfg.routine_name + "_" + str(global_cfg.year) for global_cfg in group]}')
+        leader = group[0]
+        fileset = get_fileset(leader)
+        workers = leader.workers
+        run_step = str(leader.run_step)
+        assert len(workers) == 4, "Invaild arguemnt for 'workers'."
+        assert len(run_step) == 4 and all(i in '01' for i in run_step), "Invaild arguemnt for 'run_step'."
+        coffea_kwargs = get_coffea_kwargs(leader)
+
+        # one jet-level skim holding the branches of all cards is written under the first card, and read by all cards
+        # (the cards of a group share the selection and the choice of using the skim)
+        if leader.use_jet_skim and '1' in run_step[:3]:
+            step_0 = import_unit('0')(leader, fileset=fileset, workers=workers[0], batch_cfgs=group[1:], **coffea_kwargs)
+            skim_fileset = step_0.load_skim_fileset()
+            if skim_fileset is None:
+                _logger.info(f'Launch step 0 for {len(group)} cards: write the jet-level skim used by step 1-3...')
+                step_0.launch()
+                skim_fileset = step_0.skim_fileset
+            else:
+                _logger.info('Skip step 0 and reuse the existing jet-level skim.')
+            fileset = skim_fileset
+            coffea_kwargs['treename'] = 'Jets'
+
+        # other cards reuse the MC reweight factors of the first card, also when step 1 is not run in this launch
+        for global_cfg in group[1:]:
+            if global_cfg.reuse_mc_weight_from_routine is None:
+                global_cfg.reuse_mc_weight_from_routine = leader.reuse_mc_weight_from_routine or leader.routine_name
+
+        if run_step[0] == '1':
+            if leader.reuse_mc_weight_from_routine is None:
+                _logger.info('Launch step 1: reweight total MC to data due to the use of prescaled HT triggers...')
+                step_1 = import_unit('1')(leader, fileset=fileset, workers=workers[0], **coffea_kwargs)
+                step_1.launch(skip_coffea=leader.skip_coffea, incremental=leader.incremental)
+            else:
+                _logger.info(f'Skip step 1 and reuse MC reweight factors from routine {leader.reuse_mc_weight_from_routine}')
+
+        if run_step[1] == '1':
+            _logger.info(f'Launch step 2 for {len(group)} cards: calculate the sfBDT coastline on the target transformed tagger...')
+            step_2 = MultiCardUnit(
+                [import_unit('2')(global_cfg, fileset=fileset, workers=workers[1], **coffea_kwargs) for global_cfg in group],
+                workers=workers[1], **coffea_kwargs,
+            )
+            step_2.launch(skip_coffea=leader.skip_coffea, incremental=leader.incremental)
+
+        if run_step[2] == '1':
+            _logger.info(f'Launch step 3 for {len(group)} cards: derive the template for fit...')
+            step_3 = MultiCardUnit(
+                [import_unit('3')(global_cfg, fileset=fileset, workers=workers[2], **coffea_kwargs) for global_cfg in group],
+                workers=workers[2], **coffea_kwargs,
+            )
+            step_3.launch(skip_coffea=leader.skip_coffea, incremental=leader.incremental)
+
+        for global_cfg in group:
+            if run_step[3] == '1':
+                _logger.info(f'Launch step 4 for {global_cfg.routine_name}: apply the fit to derive SFs, then make plots for the fit...')
+                step_4 = import_unit('4')(global_cfg, fileset=fileset, workers=workers[3])
+                step_4.launch(skip_coffea=global_cfg.skip_coffea, incremental=global_cfg.incremental)
+
+            # Make navigation webpage
+            write_routine_webpage(global_cfg)
+
+
+def launch(config_path, workers=None, run_step=None, skip_coffea=None, options=None, multi_years=None,
+           executor=None, chunksize=None, maxchunks=None, retries=None, concurrent_years=False, total_workers=None, incremental=None, dry_run=False):
+    r"""Launch all steps. Multiple cards given in `config_path` are launched in the batch mode."""
+
+    config_paths = config_path if isinstance(config_path, (list, tuple)) else [config_path]
     if options is not None and len(options) > 0:
         options = {k: ast.literal_eval(v) for k, v in options}
         print(options)
-        for k in options:
-            setattr(global_cfg_base, k, options[k])
+    if multi_years is not None:
+        assert all(year in ['2016APV', '2016', '2017', '2018'] for year in multi_years), "Please specify the correct year format"
+
+    global_cfgs = []
+    for config_path in config_paths:
+        global_cfg_base = load_global_cfg(config_path)
+        if workers is not None:
+            global_cfg_base.workers = workers
+        if executor is not None:
+            global_cfg_base.coffea_executor = executor
+        if chunksize is not None:
+            global_cfg_base.coffea_chunksize = chunksize
+        if maxchunks is not None:
+            global_cfg_base.coffea_maxchunks = maxchunks
+        if retries is not None:
+            global_cfg_base.coffea_retries = retries
+        if run_step is not None:
+            global_cfg_base.run_step = run_step
+        if skip_coffea is not None:
+            global_cfg_base.skip_coffea = skip_coffea
+        if incremental is not None:
+            global_cfg_base.incremental = incremental
+        if options is not None and len(options) > 0:
+            for k in options:
+                setattr(global_cfg_base, k, options[k])
+
+        if multi_years is None: # use the year specified in the config card
+            global_cfgs.append(global_cfg_base)
+        else:
+            for year in multi_years: # iterate over all specified year
+                global_cfg = copy.deepcopy(global_cfg_base)
+                global_cfg.year = year
+                global_cfgs.append(global_cfg)
 
-    if multi_years is None: # use the year specified in the config card
-        launch_routine(global_cfg_base)
+    if dry_run:
+        # only estimate the resources of each routine
+        from utils.resource_estimator import estimate_resources, print_estimates
+        for global_cfg in global_cfgs:
+            print_estimates(global_cfg, estimate_resources(global_cfg, get_fileset(global_cfg)))
+    elif len(config_paths) > 1:
+        launch_batch_routines(global_cfgs)
+    elif multi_years is not None and concurrent_years:
+        launch_concurrent_routines(global_cfgs, total_workers=total_workers)
     else:
-        assert all(year in ['2016APV', '2016', '2017', '2018'] for year in multi_years), "Please specify the correct year format"
-        for year in multi_years: # iterate over all specified year
-            global_cfg = copy.deepcopy(global_cfg_base)
-            global_cfg.year = year
+        for global_cfg in global_cfgs:
             launch_routine(global_cfg)
 
 
@@ -126,7 +330,9 @@ if __name__ == '__main__':
 
     import argparse
     parser = argparse.ArgumentParser('Preprocess ntuples')
-    parser.add_argument('config_path')
+    parser.add_argument('config_path', nargs='+',
+        help='Path(s) of the config card. Multiple cards are launched in the batch mode: cards sharing the input ntuples and '
+             'selection run step 1 once and fill the histograms of step 2 and 3 in a single pass over the events.')
     parser.add_argument('--workers', '-w', nargs='+', type=int, default=None,
         help='Number of concurrent workers for the coffea and standalone processor. Will overide the option in base config.')
     parser.add_argument('--run-step', '-s', type=str, default=None,
@@ -134,11 +340,34 @@ if __name__ == '__main__':
     parser.add_argument('--skip-coffea', action='store_true',
         help='If specified, skip running the coffea step and directly load the existing results (should guarantee that the coffea step has run before). '
              'Will overide the option in base config.')
+    parser.add_argument('--incremental', action='store_true', default=None,
+        help='If specified, skip the steps (or only their coffea jobs) whose inputs are unchanged since the last run. '
+             'Will overide the option in base config.')
+    parser.add_argument('--executor', '-e', type=str, default=None, choices=['iterative', 'futures', 'threads', 'dask'],
+        help='Execution engine of the coffea jobs: iterative (for debugging), futures (process pool), threads (thread pool), or dask (local dask cluster, requires dask and distributed). '
+             'Will overide the option in base config.')
+    parser.add_argument('--chunksize', type=int, default=None,
+        help='Number of events per chunk in the coffea jobs. Will overide the option in base config.')
+    parser.add_argument('--maxchunks', type=int, default=None,
+        help='Maximum number of chunks to process per dataset in the coffea jobs (for test). Will overide the option in base config.')
+    parser.add_argument('--retries', type=int, default=None,
+        help='Number of retries for a failed chunk in the coffea jobs. Will overide the option in base config.')
     parser.add_argument('--options', '-o', nargs=2, action='append', default=[],
         help='pass the options to override the original value in the YAML card')
     parser.add_argument('--multi-years', '-y', nargs='+', type=str, default=None,
         help='Specify one or multiple year(s) options to run. Will overide the option in the config card.')
+    parser.add_argument('--concurrent-years', action='store_true',
+        help='If specified with --multi-years, run the routines of all years in parallel processes.')
+    parser.add_argument('--total-workers', type=int, default=None,
+        help='Total number of workers shared by the concurrent routines of all years (default: number of CPUs). '
+             'The workers of each step are capped by an even share of this budget.')
+    parser.add_argument('--dry-run', action='store_true',
+        help='If specified, do not run the routine but print the estimated events to read, memory, disk usage, and CPU-hours '
+             'of each step, derived from the card and the metadata of the input files.')
     args = parser.parse_args()
 
     # Launch all steps
-    launch(args.config_path, workers=args.workers, run_step=args.run_step, skip_coffea=args.skip_coffea, options=args.options, multi_years=args.multi_years)
+    launch(args.config_path, workers=args.workers, run_step=args.run_step, skip_coffea=args.skip_coffea, options=args.options, multi_years=args.multi_years,
+           executor=args.executor, chunksize=args.chunksize, maxchunks=args.maxchunks, retries=args.retries,
+           concurrent_years=args.concurrent_years, total_workers=args.total_workers, incremental=args.incremental,
+           dry_run=args.dry_run)
@@ -3,7 +3,8 @@ For step 1: reweight total MC to data due to the use of prescaled HT triggers.
 
 """
 
-from coffea import processor, hist
+from coffea import processor
+import hist
 import awkward as ak
 import numpy as np
 import uproot
@@ -19,143 +20,141 @@ plt.style.use(hep.style.CMS)
 
 from functools import partial
 import pickle
+import glob
 import json
 import os
 
-from unit import ProcessingUnit
+from unit import ProcessingUnit, FIT_CFG_KEYS, POSTPROCESS_CFG_KEYS, RESULT_FORMAT_VERSION
 from utils.web_maker import WebMaker
+from utils.tools import get_jet_selection, get_columns, prefetch_columns, hash_object, get_file_identity
+from utils.expr_tools import ExprEvaluator
+from utils.coffea_tools import HistAccumulator, PerFileCoffeaProcessor, get_file_key, sort_categories
 from logger import _logger
 
 
+# HT range of the reweighting histograms in 50 GeV bins, for each jet and pT bin
+HT_RANGES = {
+    'fj1': {
+        (200, 250): (250, 1250), (250, 300): (350, 1400), (300, 350): (400, 1600), (350, 400): (450, 1700),
+        (400, 450): (500, 1800), (450, 500): (550, 1900), (500, 550): (600, 1900), (550, 600): (650, 2000),
+        (600, 700): (700, 2100), (700, 800): (800, 2200), (800, 100000): (1000, 2400),
+    },
+    'fj2': {
+        (200, 250): (250, 1500), (250, 300): (350, 1600), (300, 350): (400, 1800), (350, 400): (450, 2000),
+        (400, 450): (500, 2200), (450, 500): (550, 2400), (500, 550): (650, 2400), (550, 600): (750, 2400),
+        (600, 700): (850, 2400), (700, 800): (1000, 2400), (800, 100000): (1200, 2400),
+    },
+}
+HT_BINW = 50
+# JES/JER variations: the scale factors applied on the jet pT and the corrected HT branch
+VARIATION_BRANCHES = {'_jesUp': '_jesUncFactorUp', '_jesDown': '_jesUncFactorDn', '_jerUp': '_jerSmearFactorUp', '_jerDown': '_jerSmearFactorDn'}
+
+
 class MCReweightCoffeaProcessor(processor.ProcessorABC):
-    r"""The coffea processor for the reweighting step"""
+    r"""The coffea processor for the reweighting step. For each jet and variation, all pT bins are filled at once into
+        a consolidated histogram on (pT bin index, HT), where the HT axis covers the HT ranges of all pT bins. The HT
+        range of each pT bin is restored in the postprocessing."""
 
     def __init__(self, global_cfg=None):
         self.global_cfg = global_cfg
+        self.columns = get_columns(global_cfg, *self.get_branches(global_cfg), on_skim=global_cfg.use_jet_skim)
+        self.pt_lows = np.array([ptmin for ptmin, _ in global_cfg.rwgt_pt_bins], dtype=float)
+        self.pt_highs = np.array([ptmax for _, ptmax in global_cfg.rwgt_pt_bins], dtype=float)
+        npt = len(global_cfg.rwgt_pt_bins)
+        ht_ranges = [r for jetidx in HT_RANGES for r in HT_RANGES[jetidx].values()]
+        self.ht_edges = np.arange(min(r[0] for r in ht_ranges), max(r[1] for r in ht_ranges) + HT_BINW, HT_BINW)
 
-        dataset = hist.Cat("dataset", "dataset")
-
-        def linspace_bin(start, end, width=50):
-            return hist.Bin('ht', 'ht', (end - start) // width, start, end)
+        dataset = hist.axis.StrCategory([], name='dataset', label='dataset', growth=True)
+        ptbin = hist.axis.Regular(npt, 0, npt, name='ptbin', label='ptbin')
+        ht = hist.axis.Variable(self.ht_edges, name='ht', label='ht')
 
         _hists = {}
         for suffix in ['', '_jesUp', '_jesDown', '_jerUp', '_jerDown']:
-            _hists.update({
-                f'ht_fj1_pt200to250{suffix}': hist.Hist('Counts', dataset, linspace_bin(250, 1250)),
-                f'ht_fj1_pt250to300{suffix}': hist.Hist('Counts', dataset, linspace_bin(350, 1400)),
-                f'ht_fj1_pt300to350{suffix}': hist.Hist('Counts', dataset, linspace_bin(400, 1600)),
-                f'ht_fj1_pt350to400{suffix}': hist.Hist('Counts', dataset, linspace_bin(450, 1700)),
-                f'ht_fj1_pt400to450{suffix}': hist.Hist('Counts', dataset, linspace_bin(500, 1800)),
-                f'ht_fj1_pt450to500{suffix}': hist.Hist('Counts', dataset, linspace_bin(550, 1900)),
-                f'ht_fj1_pt500to550{suffix}': hist.Hist('Counts', dataset, linspace_bin(600, 1900)),
-                f'ht_fj1_pt550to600{suffix}': hist.Hist('Counts', dataset, linspace_bin(650, 2000)),
-                f'ht_fj1_pt600to700{suffix}': hist.Hist('Counts', dataset, linspace_bin(700, 2100)),
-                f'ht_fj1_pt700to800{suffix}': hist.Hist('Counts', dataset, linspace_bin(800, 2200)),
-                f'ht_fj1_pt800to100000{suffix}': hist.Hist('Counts', dataset, linspace_bin(1000, 2400)),
-
-                f'ht_fj2_pt200to250{suffix}': hist.Hist('Counts', dataset, linspace_bin(250, 1500)),
-                f'ht_fj2_pt250to300{suffix}': hist.Hist('Counts', dataset, linspace_bin(350, 1600)),
-                f'ht_fj2_pt300to350{suffix}': hist.Hist('Counts', dataset, linspace_bin(400, 1800)),
-                f'ht_fj2_pt350to400{suffix}': hist.Hist('Counts', dataset, linspace_bin(450, 2000)),
-                f'ht_fj2_pt400to450{suffix}': hist.Hist('Counts', dataset, linspace_bin(500, 2200)),
-                f'ht_fj2_pt450to500{suffix}': hist.Hist('Counts', dataset, linspace_bin(550, 2400)),
-                f'ht_fj2_pt500to550{suffix}': hist.Hist('Counts', dataset, linspace_bin(650, 2400)),
-                f'ht_fj2_pt550to600{suffix}': hist.Hist('Counts', dataset, linspace_bin(750, 2400)),
-                f'ht_fj2_pt600to700{suffix}': hist.Hist('Counts', dataset, linspace_bin(850, 2400)),
-                f'ht_fj2_pt700to800{suffix}': hist.Hist('Counts', dataset, linspace_bin(1000, 2400)),
-                f'ht_fj2_pt800to100000{suffix}': hist.Hist('Counts', dataset, linspace_bin(1200, 2400)),
-            })
+            for jetidx in ['fj1', 'fj2']:
+                _hists[f'ht_{jetidx}{suffix}'] = HistAccumulator(dataset, ptbin, ht, storage=hist.storage.Weight(), label='Counts')
         _hists['cutflow'] = processor.defaultdict_accumulator(
             partial(processor.defaultdict_accumulator, int)
         )
+        _hists['nbytes'] = processor.value_accumulator(int)
+        _hists['expr_cache'] = processor.defaultdict_accumulator(int)
         self._accumulator = processor.dict_accumulator(_hists)
 
+    @staticmethod
+    def get_branches(global_cfg):
+        r"""The event-level and jet-level branches and the expressions read by the processor (see `get_columns`)"""
+        event_branches = ['ht', 'ht_jesUncFactorUp', 'ht_jesUncFactorDn', 'ht_jerSmearFactorUp', 'ht_jerSmearFactorDn', 'genWeight', 'xsecWeight', 'puWeight', 'l1PreFiringWeight']
+        jet_branches = ['fj_x_pt', 'fj_x_jesUncFactorUp', 'fj_x_jesUncFactorDn', 'fj_x_jerSmearFactorUp', 'fj_x_jerSmearFactorDn']
+        return event_branches, jet_branches, []
+
     @property
     def accumulator(self):
         return self._accumulator
 
 
+    def digitize_pt(self, pt):
+        r"""Index of the reweighting pT bin of each jet, or -1 if outside all bins"""
+        pt = ak.to_numpy(pt)
+        idx = np.searchsorted(self.pt_lows, pt, side='right') - 1
+        idx_clip = np.maximum(idx, 0)
+        return np.where((idx >= 0) & (pt >= self.pt_lows[idx_clip]) & (pt < self.pt_highs[idx_clip]), idx, -1)
+
+
     def process(self, events):
         out = self.accumulator.identity()
         dataset = events.metadata['dataset']
         is_mc = dataset != 'jetht'
 
-        presel = ak.numexpr.evaluate('passmetfilters & (' + '|'.join(self.global_cfg.hlt_branches[self.global_cfg.year]) + ')', events)
-        custom_sel_fj1 = ak.numexpr.evaluate(self.global_cfg.custom_selection.replace('fj_x', 'fj_1'), events) if self.global_cfg.custom_selection is not None else ak.ones_like(presel, dtype=bool)
-        custom_sel_fj2 = ak.numexpr.evaluate(self.global_cfg.custom_selection.replace('fj_x', 'fj_2'), events) if self.global_cfg.custom_selection is not None else ak.ones_like(presel, dtype=bool)
-        events_fj1 = events[(presel) & (events.fj_1_is_qualified) & (custom_sel_fj1)]
-        events_fj2 = events[(presel) & (events.fj_2_is_qualified) & (custom_sel_fj2)]
         lumi = self.global_cfg.lumi_dict[self.global_cfg.year]
-
-        for ptmin, ptmax in self.global_cfg.rwgt_pt_bins:
-            events_fj1_pt = events_fj1[(events_fj1.fj_1_pt >= ptmin) & (events_fj1.fj_1_pt < ptmax)]
-            events_fj2_pt = events_fj2[(events_fj2.fj_2_pt >= ptmin) & (events_fj2.fj_2_pt < ptmax)]
-            ht_nom_fj1 = events_fj1_pt.ht
-            ht_nom_fj2 = events_fj2_pt.ht
-
-            # Fill the qualified fj_1 and fj_2 events separately
-            weight_nom_fj1 = ak.numexpr.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeight*{lumi}', events_fj1_pt) if is_mc else ak.ones_like(events_fj1_pt.ht)
-            weight_nom_fj2 = ak.numexpr.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeight*{lumi}', events_fj2_pt) if is_mc else ak.ones_like(events_fj2_pt.ht)
-            # Fill histograms for nominal case ('') and JES/JER cases; no
+        events, nbytes = prefetch_columns(events, self.columns, self.global_cfg.coffea_decompression_workers)
+        out['nbytes'].add(nbytes)
+        evaluator = ExprEvaluator(events)
+
+        for i in '12': # jet index
+            sel, fj = get_jet_selection(events, i, self.global_cfg, on_skim=self.global_cfg.use_jet_skim, evaluator=evaluator)
+            events_fj = events[sel]
+            pt = events_fj[f'{fj}_pt']
+
+            # Fill the qualified fj_1 and fj_2 events separately. The event weight is shared by all variations
+            weight = ak.to_numpy(evaluator.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeight*{lumi}', sel)) if is_mc else np.ones(len(events_fj))
+            # Fill histograms for nominal case ('') and JES/JER cases, using the corrected ht and jet pt
             for suffix in (['', '_jesUp', '_jesDown', '_jerUp', '_jerDown'] if is_mc else ['']):
                 if suffix == '':
-                    ht_fj1, ht_fj2 = ht_nom_fj1, ht_nom_fj2
-                    weight_fj1 = weight_nom_fj1
-                    weight_fj2 = weight_nom_fj2
-
-                # the following PSWeight variation schemes are not considered now
-                elif suffix == '_psWeightIsrUp':
-                    ht_fj1, ht_fj2 = ht_nom_fj1, ht_nom_fj2
-                    weight_fj1 = weight_nom_fj1 * events_fj1_pt.PSWeight[:,2]
-                    weight_fj2 = weight_nom_fj2 * events_fj2_pt.PSWeight[:,2]
-                elif suffix == '_psWeightIsrDown':
-                    ht_fj1, ht_fj2 = ht_nom_fj1, ht_nom_fj2
-                    weight_fj1 = weight_nom_fj1 * events_fj1_pt.PSWeight[:,0]
-                    weight_fj2 = weight_nom_fj2 * events_fj2_pt.PSWeight[:,0]
-                elif suffix == '_psWeightFsrUp':
-                    ht_fj1, ht_fj2 = ht_nom_fj1, ht_nom_fj2
-                    weight_fj1 = weight_nom_fj1 * events_fj1_pt.PSWeight[:,3]
-                    weight_fj2 = weight_nom_fj2 * events_fj2_pt.PSWeight[:,3]
-                elif suffix == '_psWeightFsrDown':
-                    ht_fj1, ht_fj2 = ht_nom_fj1, ht_nom_fj2
-                    weight_fj1 = weight_nom_fj1 * events_fj1_pt.PSWeight[:,1]
-                    weight_fj2 = weight_nom_fj2 * events_fj2_pt.PSWeight[:,1]
-
-                elif suffix in ['_jesUp', '_jesDown', '_jerUp', '_jerDown']:
-                    suffix_to_branch = {'_jesUp': '_jesUncFactorUp', '_jesDown': '_jesUncFactorDn', '_jerUp': '_jerSmearFactorUp', '_jerDown': '_jerSmearFactorDn'}
-                    # should use corrected ht and jet pt to fill histograms
-                    pt_fj1_corr = events_fj1.fj_1_pt * events_fj1[f'fj_1{suffix_to_branch[suffix]}']
-                    pt_fj2_corr = events_fj2.fj_2_pt * events_fj2[f'fj_2{suffix_to_branch[suffix]}']
-                    events_fj1_pt_corr = events_fj1[(pt_fj1_corr >= ptmin) & (pt_fj1_corr < ptmax)]
-                    events_fj2_pt_corr = events_fj2[(pt_fj2_corr >= ptmin) & (pt_fj2_corr < ptmax)]
-
-                    ht_fj1, ht_fj2 = events_fj1_pt_corr[f'ht{suffix_to_branch[suffix]}'], events_fj2_pt_corr[f'ht{suffix_to_branch[suffix]}']
-                    weight_fj1 = ak.numexpr.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeight*{lumi}', events_fj1_pt_corr)
-                    weight_fj2 = ak.numexpr.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeight*{lumi}', events_fj2_pt_corr)
-                out[f'ht_fj1_pt{ptmin}to{ptmax}{suffix}'].fill(
-                    dataset=dataset,
-                    ht=ht_fj1,
-                    weight=weight_fj1,
-                )
-                out[f'ht_fj2_pt{ptmin}to{ptmax}{suffix}'].fill(
+                    ptidx, ht = self.digitize_pt(pt), ak.to_numpy(events_fj.ht)
+                    # cutflow in each pT bin
+                    counts = np.bincount(ptidx[ptidx >= 0], minlength=len(self.pt_lows))
+                    for (ptmin, ptmax), count in zip(self.global_cfg.rwgt_pt_bins, counts):
+                        out['cutflow'][dataset][f'fj{i}_pt{ptmin}to{ptmax}'] += int(count)
+                else:
+                    ptidx = self.digitize_pt(pt * events_fj[f'{fj}{VARIATION_BRANCHES[suffix]}'])
+                    ht = ak.to_numpy(events_fj[f'ht{VARIATION_BRANCHES[suffix]}'])
+                in_bins = ptidx >= 0
+                out[f'ht_fj{i}{suffix}'].fill(
                     dataset=dataset,
-                    ht=ht_fj2,
-                    weight=weight_fj2,
+                    ptbin=ptidx[in_bins],
+                    ht=ht[in_bins],
+                    weight=weight[in_bins],
+                    threads=self.global_cfg.coffea_fill_threads,
                 )
 
-            out['cutflow'][dataset][f'fj1_pt{ptmin}to{ptmax}'] += len(events_fj1_pt)
-            out['cutflow'][dataset][f'fj2_pt{ptmin}to{ptmax}'] += len(events_fj2_pt)
-
+        out['expr_cache']['hits'] += evaluator.hits
+        out['expr_cache']['misses'] += evaluator.misses
         return out
 
 
     def postprocess(self, accumulator):
+        sort_categories(accumulator)
         return accumulator
 
 
 class MCReweightUnit(ProcessingUnit):
     r"""The unit processing wrapper of the MC reweighting step"""
 
+    fingerprint_exclude_cfg_keys = FIT_CFG_KEYS + [
+        'skip_tmpl_writing', 'skip_inclusive_plot_writing', 'logmsv_div_by_binw', 'reuse_mc_weight_from_routine', 'coastline_nbin2d', 'coastline_params', 'coastline_scan',
+        'type', 'pt_edges', 'tagger', 'tagger_name_replace_map', 'main_analysis_tree', 'custom_sfbdt_path', 'custom_sfbdt_kfold', 'sfbdt_input_exprs',
+        'sfbdt_backend',
+    ]
+
     def __init__(self, global_cfg, job_name='1_mc_reweight', fileset=None, **kwargs):
         super().__init__(
             job_name=job_name,
@@ -173,6 +172,82 @@ class MCReweightUnit(ProcessingUnit):
             os.makedirs(self.webdir)
 
 
+    def get_partial_path(self, dataset, path):
+        r"""Path of the stored partial result of an input file, keyed by the file identity and the coffea job configuration.
+            The options defining the fileset and the runtime options (e.g. the chunk size) do not enter, so that adding a
+            sample or changing the chunking keeps the partial results of the others."""
+        fingerprint = hash_object({
+            'job_name': self.job_name,
+            'result_format': RESULT_FORMAT_VERSION,
+            'dataset': dataset,
+            'cfg': hash_object(self.get_cfg_for_fingerprint(exclude_keys=POSTPROCESS_CFG_KEYS + ['fileset_template', 'sample_prefix', 'coffea_maxchunks'])),
+            'file': get_file_identity(path),
+        })
+        return os.path.join(self.outputdir, 'partial', fingerprint[:16] + '.pickle')
+
+
+    def run_coffea_job(self):
+        r"""Run the coffea job keeping the partial result of each input file, stored next to `result.pickle`. In the incremental
+            mode, only the input files without an up-to-date partial result (e.g. a newly added data era or MC sample) are
+            processed. The result is then merged from the partial results of all files."""
+        if not hasattr(self, 'processor_instance'):
+            self.initalize_processor()
+        if self.maxchunks is not None:
+            # the chunks are limited per dataset, so the result of a file depends on the other files: no partial results are kept
+            super().run_coffea_job()
+            return
+        partial_dir = os.path.join(self.outputdir, 'partial')
+        if not os.path.exists(partial_dir):
+            os.makedirs(partial_dir)
+        partial_paths = {(dataset, path): self.get_partial_path(dataset, path) for dataset, paths in self.fileset.items() for path in paths}
+        missing = [key for key, partial_path in partial_paths.items() if not (getattr(self, 'incremental', False) and os.path.isfile(partial_path))]
+
+        if len(missing) < len(partial_paths):
+            _logger.info(f'[{self.job_name}] Reuse the partial results of {len(partial_paths) - len(missing)} input files, process {len(missing)} new or modified files.')
+        if len(missing):
+            # run the coffea job on the missing files only, with the results kept for each file
+            processor_instance, fileset = self.processor_instance, self.fileset
+            self.processor_instance = PerFileCoffeaProcessor(processor_instance)
+            self.fileset = {}
+            for dataset, path in missing:
+                self.fileset.setdefault(dataset, []).append(path)
+            try:
+                super().run_coffea_job()
+            finally:
+                self.processor_instance, self.fileset = processor_instance, fileset
+
+            results = {}
+            for dataset, path in missing:
+                results[(dataset, path)] = self.result.get(get_file_key(path))
+                if results[(dataset, path)] is None:
+                    # no chunk is processed: only expected for an empty tree, otherwise no partial result should be stored
+                    with uproot.open(path) as f:
+                        if f[self.treename].num_entries > 0:
+                            raise RuntimeError(f'[{self.job_name}] No result is found for the input file {path} of {dataset}.')
+                    results[(dataset, path)] = self.processor_instance.accumulator.identity()
+            for key, out in results.items():
+                partial_path = partial_paths[key]
+                with open(partial_path + '.tmp', 'wb') as fw:
+                    pickle.dump(out, fw)
+                os.replace(partial_path + '.tmp', partial_path)
+            result_new = self.processor_instance.accumulator.identity()
+            for out in self.result.values():
+                result_new.add(out)
+            self.log_coffea_result(result_new)
+
+        # remove the partial results of the files not in the fileset anymore
+        for filepath in glob.glob(os.path.join(partial_dir, '*.pickle')):
+            if filepath not in partial_paths.values():
+                os.remove(filepath)
+
+        # merge the partial results in a fixed order
+        self.result = self.processor_instance.accumulator.identity()
+        for key in sorted(partial_paths):
+            with open(partial_paths[key], 'rb') as f:
+                self.result.add(pickle.load(f))
+        self.processor_instance.postprocess(self.result)
+
+
     def postprocess(self):
 
         _logger.info("[Postprocess]: Storing the reweighting histograms.")
@@ -186,20 +261,31 @@ class MCReweightUnit(ProcessingUnit):
             json.dump(self.result['cutflow'], fw, indent=4)
 
         # Caculate and store reweighting values to json file
+        p = self.processor_instance
         hist_values = {}
         for suffix in ['', '_jesUp', '_jesDown', '_jerUp', '_jerDown']:
-            for ptmin, ptmax in self.global_cfg.rwgt_pt_bins:
-                h_mc_fj, h_data_fj = {}, {}
+            for ipt, (ptmin, ptmax) in enumerate(self.global_cfg.rwgt_pt_bins):
                 for jetidx in ['fj1', 'fj2']:
-                    ptbname = f'ht_{jetidx}_pt{ptmin}to{ptmax}'
-                    h_data_fj[jetidx] = self.result[ptbname]['jetht'].project('ht')
-                    h_mc_fj[jetidx] = sum([self.result[ptbname + suffix][sam].project('ht') for sam in self.fileset if sam != 'jetht'], h_data_fj[jetidx].identity())
+                    # restore the HT range of the pT bin: the HT bins outside the range are merged into the under/overflow
+                    ht_start, ht_end = HT_RANGES[jetidx][(ptmin, ptmax)]
+                    istart, iend = np.searchsorted(p.ht_edges, [ht_start, ht_end]) + 1
+                    def get_values(h, datasets):
+                        categories = list(h.axes['dataset'])
+                        values = sum(
+                            (h.values(flow=True)[categories.index(sam)] for sam in datasets if sam in categories),
+                            np.zeros((len(p.pt_lows) + 2, len(p.ht_edges) + 1)),
+                        )
+                        values = values[ipt + 1, :] # the HT axis with under/overflow
+                        return np.concatenate([[values[:istart].sum()], values[istart:iend], [values[iend:].sum()]])
+
+                    h_data = get_values(self.result[f'ht_{jetidx}'], ['jetht'])
+                    h_mc = get_values(self.result[f'ht_{jetidx}{suffix}'], [sam for sam in self.fileset if sam != 'jetht'])
                     # store hist into numerical values
                     _stored = {
-                        'edges': h_data_fj[jetidx].axis('ht').edges().tolist(),
-                        'h_data': h_data_fj[jetidx].to_boost().values(flow=True).tolist(),
-                        'h_mc': h_mc_fj[jetidx].to_boost().values(flow=True).tolist(),
-                        'h_w': np.clip(h_data_fj[jetidx].to_boost().values(flow=True) / np.maximum(h_mc_fj[jetidx].to_boost().values(flow=True), 1e-20), 0., 2.).tolist(),
+                        'edges': np.linspace(ht_start, ht_end, (ht_end - ht_start) // HT_BINW + 1).tolist(),
+                        'h_data': h_data.tolist(),
+                        'h_mc': h_mc.tolist(),
+                        'h_w': np.clip(h_data / np.maximum(h_mc, 1e-20), 0., 2.).tolist(),
                     }
                     hist_values[f'{jetidx}_pt{ptmin}to{ptmax}{suffix}'] = _stored
 
@@ -0,0 +1,160 @@
+"""
+For step 0 (optional): write a compact jet-level skim reused by step 1-3.
+
+"""
+
+from coffea import processor
+import awkward as ak
+import numpy as np
+import uproot
+
+import hashlib
+import shutil
+import json
+import os
+
+from unit import ProcessingUnit
+from utils.tools import select_jets, get_columns, prefetch_columns, hash_object
+from logger import _logger
+
+
+def get_skim_branches(global_cfg, batch_cfgs=None):
+    r"""Get the event-level and jet-level branches used in step 1-3, i.e. the columns read from the skim by their processors
+        (given by `get_columns`), so that the skim always holds what the later steps consume. Jet-level branches are in
+        the 'fj_x' placeholder format. In the batch mode, the branches used by all cards in `batch_cfgs` are included."""
+    from mc_reweight_unit import MCReweightCoffeaProcessor
+    from coastline_unit import CoastlineCoffeaProcessor
+    from tmpl_writer_unit import TmplWriterCoffeaProcessor
+
+    columns = set()
+    for cfg in [global_cfg] + (batch_cfgs or []):
+        for processor_cls in [MCReweightCoffeaProcessor, CoastlineCoffeaProcessor, TmplWriterCoffeaProcessor]:
+            columns.update(get_columns(cfg, *processor_cls.get_branches(cfg), on_skim=True))
+    columns.discard('jetidx') # written by the skim
+    event_branches = sorted(c for c in columns if not c.startswith('fj_x_'))
+    jet_branches = sorted(c for c in columns if c.startswith('fj_x_'))
+    return event_branches, jet_branches
+
+
+class SkimCoffeaProcessor(processor.ProcessorABC):
+    r"""The coffea processor to write the jet-level skim. The fj_1 and fj_2 jets passing the event and jet selection are
+        stacked into one jet table (tree 'Jets'), with the jet index stored in the 'jetidx' branch. Each chunk is written
+        into a separate file."""
+
+    def __init__(self, global_cfg=None, skimdir=None, branches=None):
+        self.global_cfg = global_cfg
+        self.skimdir = skimdir
+        self.event_branches, self.jet_branches = branches if branches is not None else get_skim_branches(global_cfg)
+        self.columns = get_columns(global_cfg, self.event_branches, self.jet_branches, on_skim=False)
+
+        self._accumulator = processor.dict_accumulator({
+            'files': processor.defaultdict_accumulator(list),
+            'nevents': processor.defaultdict_accumulator(int),
+            'njets': processor.defaultdict_accumulator(int),
+            'nbytes': processor.value_accumulator(int),
+        })
+
+    @property
+    def accumulator(self):
+        return self._accumulator
+
+
+    def process(self, events):
+        out = self.accumulator.identity()
+        dataset = events.metadata['dataset']
+        metadata = events.metadata
+        events, nbytes = prefetch_columns(events, self.columns, self.global_cfg.coffea_decompression_workers)
+        out['nbytes'].add(nbytes)
+
+        jets = []
+        for i in '12': # jet index
+            events_fj, fj = select_jets(events, i, self.global_cfg, on_skim=False)
+            jets_fj = {'jetidx': np.full(len(events_fj), int(i), dtype=np.int32)}
+            for b in self.event_branches:
+                if b in events.fields: # e.g. weight branches do not exist in data
+                    jets_fj[b] = events_fj[b]
+            for b in self.jet_branches:
+                if b.replace('fj_x', fj) in events.fields:
+                    jets_fj[b] = events_fj[b.replace('fj_x', fj)]
+            jets.append(jets_fj)
+
+        # stack fj_1 and fj_2 into one jet table
+        jets = {b: ak.concatenate([jets_fj[b] for jets_fj in jets]) for b in jets[0]}
+        njets = len(jets['jetidx'])
+        if njets > 0:
+            chunk = (metadata['filename'], metadata['entrystart'], metadata['entrystop'])
+            filepath = os.path.join(self.skimdir, dataset, hashlib.sha1(str(chunk).encode()).hexdigest()[:16] + '.root')
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            # written to a temporary file first, so that a killed worker does not leave a truncated skim file
+            with uproot.recreate(filepath + '.tmp') as fw:
+                fw['Jets'] = jets
+            os.replace(filepath + '.tmp', filepath)
+            out['files'][dataset].append(os.path.abspath(filepath))
+
+        out['nevents'][dataset] += len(events)
+        out['njets'][dataset] += njets
+        return out
+
+
+    def postprocess(self, accumulator):
+        return accumulator
+
+
+class SkimUnit(ProcessingUnit):
+    r"""The unit processing wrapper of the optional step 0 (write the jet-level skim). In the batch mode, the skim written in
+        the output directory of the first card holds the branches of all cards in `batch_cfgs`."""
+
+    def __init__(self, global_cfg, job_name='0_skim', fileset=None, batch_cfgs=None, **kwargs):
+        self.global_cfg = global_cfg
+        self.outputdir = os.path.join('output', self.global_cfg.routine_name + '_' + str(self.global_cfg.year), job_name)
+        self.branches = get_skim_branches(global_cfg, batch_cfgs)
+        super().__init__(
+            job_name=job_name,
+            fileset=fileset,
+            processor_cls=SkimCoffeaProcessor,
+            processor_kwargs={'global_cfg': global_cfg, 'skimdir': os.path.join(self.outputdir, 'skim'), 'branches': self.branches},
+            **kwargs,
+        )
+        if not os.path.exists(self.outputdir):
+            os.makedirs(self.outputdir)
+
+
+    def get_skim_fingerprint(self):
+        r"""The skim only depends on the input files, the selection and the stored branches"""
+        return hash_object({
+            'fileset': self.fileset,
+            'year': self.global_cfg.year,
+            'hlt_branches': self.global_cfg.hlt_branches[self.global_cfg.year],
+            'custom_selection': self.global_cfg.custom_selection,
+            'branches': self.branches,
+        })
+
+
+    def load_skim_fileset(self):
+        r"""Return the fileset of the existing skim if it is up to date, otherwise None"""
+        filepath = os.path.join(self.outputdir, 'skim_fileset.json')
+        if not os.path.isfile(filepath):
+            return None
+        with open(filepath) as f:
+            content = json.load(f)
+        if content['fingerprint'] != self.get_skim_fingerprint():
+            return None
+        return content['fileset']
+
+
+    def preprocess(self):
+        # remove the outdated skim files
+        if os.path.isfile(os.path.join(self.outputdir, 'skim_fileset.json')) and self.load_skim_fileset() is None:
+            shutil.rmtree(self.processor_kwargs['skimdir'], ignore_errors=True)
+
+
+    def postprocess(self):
+
+        _logger.info("[Postprocess]: Storing the jet-level skim fileset.")
+
+        self.skim_fileset = {dataset: sorted(self.result['files'][dataset]) for dataset in self.fileset}
+        with open(os.path.join(self.outputdir, 'skim_fileset.json'), 'w') as fw:
+            json.dump({'fingerprint': self.get_skim_fingerprint(), 'fileset': self.skim_fileset}, fw, indent=4)
+
+        with open(os.path.join(self.outputdir, 'cutflow.json'), 'w') as fw:
+            json.dump({'nevents': self.result['nevents'], 'njets': self.result['njets']}, fw, indent=4)
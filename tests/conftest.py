@@ -0,0 +1,74 @@
+import sys
+import os
+
+import numpy as np
+import pytest
+
+# the modules of the tool are imported from the repository root
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+HLT_BRANCHES_2018 = ['HLT_PFHT180', 'HLT_PFHT250', 'HLT_PFHT370', 'HLT_PFHT430', 'HLT_PFHT510', 'HLT_PFHT590', 'HLT_PFHT680', 'HLT_PFHT780', 'HLT_PFHT890', 'HLT_PFHT1050', 'HLT_PFHT350']
+SFBDT_VARS = ['tau21', 'sj1_rawmass', 'sj2_rawmass', 'ntracks_sv12', 'sj1_sv1_pt', 'sj2_sv1_pt', 'sj1_sv1_dxysig', 'sj2_sv1_dxysig', 'sj1_sv1_masscor', 'sj2_sv1_masscor']
+
+
+def write_ntuple(path, n, is_mc, seed):
+    r"""Write a synthetic ntuple with the branches read by step 0-3"""
+    import awkward as ak
+    import uproot
+
+    rng = np.random.default_rng(seed)
+    d = {'passmetfilters': rng.random(n) < 0.98}
+    for b in HLT_BRANCHES_2018:
+        d[b] = rng.random(n) < 0.3
+    d['ht'] = rng.uniform(300, 2500, n)
+    for s in ['_jesUncFactorUp', '_jesUncFactorDn', '_jerSmearFactorUp', '_jerSmearFactorDn']:
+        d['ht' + s] = d['ht'] * rng.normal(1, 0.02, n)
+    if is_mc:
+        d['genWeight'] = rng.normal(1, 0.1, n)
+        d['xsecWeight'] = np.full(n, 0.01)
+        for w in ['puWeight', 'puWeightUp', 'puWeightDown', 'l1PreFiringWeight', 'l1PreFiringWeightUp', 'l1PreFiringWeightDown']:
+            d[w] = rng.normal(1, 0.05, n)
+        d['PSWeight'] = ak.Array(rng.normal(1, 0.1, (n, 4)).tolist())
+    for i in '12':
+        fj = f'fj_{i}_'
+        d[fj + 'is_qualified'] = rng.random(n) < 0.8
+        d[fj + 'pt'] = rng.uniform(200, 1200, n)
+        d[fj + 'eta'] = rng.uniform(-2, 2, n)
+        d[fj + 'sdmass'] = rng.uniform(50, 200, n)
+        d[fj + 'nbhadrons'] = rng.integers(0, 3, n)
+        d[fj + 'nchadrons'] = rng.integers(0, 3, n)
+        d[fj + 'sfBDT'] = rng.random(n)
+        for s in ['jesUncFactorUp', 'jesUncFactorDn', 'jerSmearFactorUp', 'jerSmearFactorDn']:
+            d[fj + s] = rng.normal(1, 0.02, n)
+        x, q = rng.random(n), rng.random(n)
+        d[fj + 'ParticleNetMD_Xbb'], d[fj + 'ParticleNetMD_QCD'], d[fj + 'ParticleNetMD_XbbVsQCD'] = x, q, x / (x + q)
+        for v in SFBDT_VARS:
+            d[fj + v] = rng.uniform(0.1, 10, n)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with uproot.recreate(path) as fw:
+        fw['Events'] = d
+
+
+@pytest.fixture
+def synth_cfg(tmp_path, monkeypatch):
+    r"""The global config of a small synthetic routine (2018) reading the ntuples written in `tmp_path`, which becomes the
+        working directory where the outputs are written."""
+    import yaml
+    from launcher import load_global_cfg
+
+    sample_prefix = str(tmp_path / 'samples_$YEAR')
+    card = {
+        'routine_name': 'synth_bb', 'type': 'bb', 'year': 2018, 'sample_prefix': sample_prefix, 'pt_edges': [450, 500, 600],
+        'workers': [1, 1, 1, 1], 'coffea_executor': 'iterative', 'coffea_chunksize': 1000,
+        'tagger': {'expr': 'FatJet_particleNetMD_Xbb / (FatJet_particleNetMD_Xbb + FatJet_particleNetMD_QCD)', 'span': [0., 1.], 'wps': {'HP': [0.9, 1.], 'MP': [0.8, 1.]}},
+        'main_analysis_tree': {'path': str(tmp_path / 'sig_$YEAR.root'), 'treename': 'Events', 'selection': 'fj_1_pt>0', 'tagger': 'fj_1_ParticleNetMD_XbbVsQCD', 'weight': 'genWeight'},
+    }
+    with open(tmp_path / 'card.yml', 'w') as fw:
+        yaml.safe_dump(card, fw)
+    monkeypatch.chdir(REPO_DIR)
+    global_cfg = load_global_cfg(str(tmp_path / 'card.yml'))
+    for i, (sample, relpath) in enumerate(global_cfg.fileset_template.items()):
+        write_ntuple(os.path.join(sample_prefix.replace('$YEAR', '2018'), relpath), 2500, is_mc=sample != 'jetht', seed=i)
+    monkeypatch.chdir(tmp_path)
+    return global_cfg
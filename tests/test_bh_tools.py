@@ -0,0 +1,45 @@
+import numpy as np
+import boost_histogram as bh
+import hist
+
+from utils.bh_tools import bh_to_memmap
+
+
+def book(rng):
+    h = hist.Hist(
+        hist.axis.StrCategory(['qcd', 'top', 'jetht'], name='dataset', growth=True),
+        hist.axis.Variable([-.5, .5, 1.5, 2.5], name='flv'),
+        hist.axis.Variable([0., 0.3, 0.6, 1.], name='coastline'),
+        hist.axis.Regular(10, 0., 1., name='x'),
+        storage=hist.storage.Weight(), label='Counts',
+    )
+    n = 10000
+    h.fill(
+        dataset=rng.choice(['qcd', 'top', 'jetht'], n), flv=rng.integers(0, 3, n), coastline=rng.uniform(-0.2, 1.2, n),
+        x=rng.uniform(-0.1, 1.1, n), weight=rng.normal(1., 0.2, n),
+    )
+    return h
+
+
+def test_memmap_round_trip(tmp_path):
+    rng = np.random.default_rng(42)
+    hists = {'a': book(rng), 'b': book(rng)}
+    handles = bh_to_memmap(hists.items(), str(tmp_path / 'storage.dat'))
+
+    for key, h in hists.items():
+        h_bh = handles[key].to_bh()
+        assert h_bh.axes == h.axes
+        assert np.array_equal(h_bh.view(flow=True), h.view(flow=True))
+
+        # slices as taken by the template writer
+        for index in [
+            (bh.loc('jetht'), 0, bh.underflow, slice(None)),
+            (bh.loc('top'), bh.sum, 1, slice(None)),
+            (2, 1, bh.overflow, slice(None)),
+            (bh.sum, bh.sum, bh.sum, slice(None)),
+            (0, slice(None), bh.sum, slice(None)),
+        ]:
+            h_ref, h_sliced = h_bh[index], handles[key][index]
+            assert h_sliced.axes == h_ref.axes
+            assert np.allclose(h_sliced.values(flow=True), h_ref.values(flow=True), rtol=1e-12, atol=0.)
+            assert np.allclose(h_sliced.variances(flow=True), h_ref.variances(flow=True), rtol=1e-12, atol=0.)
@@ -0,0 +1,45 @@
+import numpy as np
+
+from unit import StandaloneMultiThreadedUnit
+from utils.fast_splines import interp2d
+from utils.coastline_tools import CoastlineIndexGrid
+
+
+def make_grid(size=100):
+    # a smooth sfBDT-cumulative-like surface, decreasing in both xtagger and sfBDT
+    x = y = np.arange(0.0025, 1., 0.005)
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    fspline = interp2d(x, y, (1. - Y**1.5) * (1. - 0.8 * X**2))
+    return CoastlineIndexGrid(fspline, np.linspace(0., 0.6, 12)[3:], size=size, ntest=10000)
+
+
+def evaluate_grid(arg):
+    r"""Compare the lookup with the spline on random points, on the cell edges and corners (including the upper edges of
+        the last cells), and in the boundary cells"""
+    grid = make_grid()
+    points = {'random': np.random.default_rng(1).uniform(-0.1, 1.1, size=(2, 100000))}
+    edges = np.linspace(0., 1., grid.size + 1)
+    points['edges'] = np.stack([a.ravel() for a in np.meshgrid(edges, edges, indexing='ij')])
+    ix, iy = np.nonzero(grid.grid == CoastlineIndexGrid.BOUNDARY)
+    points['boundary'] = (np.stack([ix, iy]) + np.random.default_rng(2).uniform(size=(2, len(ix)))) / grid.size
+    out = {'boundary_fraction': grid.boundary_fraction, 'agreement': grid.agreement, 'nlevels': len(grid.levels)}
+    for name, (xtagger, sfbdt) in points.items():
+        values = grid.fspline(xtagger, sfbdt)
+        out[name] = {
+            'lookup': grid.lookup(xtagger, sfbdt), 'spline': grid.get_bin_index(values),
+            'filled_bin': np.digitize(grid(xtagger, sfbdt), grid.levels), 'spline_bin': np.digitize(values, grid.levels),
+        }
+    return out
+
+
+def test_lookup_matches_spline():
+    # the spline evaluation starts numba threads, which would deadlock the processes forked later by other tests
+    handler = StandaloneMultiThreadedUnit(workers=1)
+    handler.book(None)
+    out = handler.run(evaluate_grid)[0]
+    assert 0. < out['boundary_fraction'] < 0.2 and out['agreement'] == 1.
+    assert out['random']['lookup'].min() == -1 and out['random']['lookup'].max() == out['nlevels'] - 1
+    for name in ['random', 'edges', 'boundary']:
+        assert np.array_equal(out[name]['lookup'], out[name]['spline'])
+        # the filled values fall into the same bins of the coastline axis as the spline values
+        assert np.array_equal(out[name]['filled_bin'], out[name]['spline_bin'])
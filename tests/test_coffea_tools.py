@@ -0,0 +1,99 @@
+from coffea import processor
+import numpy as np
+import hist
+import types
+import glob
+import os
+
+from utils.coffea_tools import HistAccumulator, FILL_ENTRIES_PER_THREAD, CheckpointCoffeaProcessor, load_checkpoint, clear_checkpoint
+
+
+def book():
+    return HistAccumulator(
+        hist.axis.StrCategory([], name='dataset', label='dataset', growth=True),
+        hist.axis.StrCategory([], name='flv', label='flv', growth=True),
+        hist.axis.Regular(20, 0., 1., name='x', label='x'),
+        storage=hist.storage.Weight(), label='Counts',
+    )
+
+
+def fill(threads):
+    rng = np.random.default_rng(42)
+    nentries = 8 * FILL_ENTRIES_PER_THREAD
+    x = rng.uniform(0., 1., nentries)
+    x[::7] = np.nan # dropped before the filling
+    weight = rng.normal(1., 0.1, nentries)
+    h = book()
+    # scalar categories growing the category axes, then an array of categories with a scalar weight
+    for dataset in ['qcd', 'jetht', 'ttbar']:
+        h.fill(dataset=dataset, flv='b', x=x, weight=weight, threads=threads)
+    h.fill(dataset='qcd', flv=np.where(x > 0.5, 'c', 'l'), x=x, weight=2., threads=threads)
+    return h
+
+
+def test_threaded_fill_matches_single_threaded():
+    h1, h4 = fill(threads=1), fill(threads=4)
+    for ax1, ax4 in zip(h1.axes, h4.axes):
+        assert list(ax1) == list(ax4)
+    # the threads sum the weights in a different order
+    assert np.allclose(h1.view(flow=True).value, h4.view(flow=True).value, rtol=1e-12, atol=0.)
+    assert np.allclose(h1.view(flow=True).variance, h4.view(flow=True).variance, rtol=1e-12, atol=0.)
+
+
+class CountProcessor(processor.ProcessorABC):
+    r"""Sum of the entry ranges of the processed chunks"""
+
+    @property
+    def accumulator(self):
+        return processor.dict_accumulator({'entries': processor.value_accumulator(int)})
+
+    def process(self, events):
+        out = self.accumulator.identity()
+        out['entries'] += events.metadata['entrystop'] - events.metadata['entrystart']
+        return out
+
+    def postprocess(self, accumulator):
+        return accumulator
+
+
+def process_chunks(processor_instance, starts):
+    out = processor_instance.accumulator.identity()
+    for start in starts:
+        events = types.SimpleNamespace(metadata={'filename': 'f.root', 'treename': 'Events', 'entrystart': start, 'entrystop': start + 10})
+        out.add(processor_instance.process(events))
+    return out
+
+
+def test_checkpoint_resume(tmp_path):
+    checkpoint_dir = str(tmp_path / 'checkpoint')
+    result, chunks = load_checkpoint(checkpoint_dir, 'job', CountProcessor().accumulator)
+    assert result['entries'].value == 0 and chunks == set()
+
+    # every chunk is stored in its own checkpoint file
+    process_chunks(CheckpointCoffeaProcessor(CountProcessor(), checkpoint_dir, interval=-1), [0, 10, 20])
+    parts = {p: open(p, 'rb').read() for p in glob.glob(os.path.join(checkpoint_dir, 'part_*.pickle'))}
+    assert len(parts) == 3
+
+    result, chunks = load_checkpoint(checkpoint_dir, 'job', CountProcessor().accumulator)
+    assert result['entries'].value == 30 and len(chunks) == 3
+    assert [os.path.basename(p) for p in glob.glob(os.path.join(checkpoint_dir, '*.pickle'))][0].startswith('merged_')
+
+    # the parts left over by a job stopped after writing the merged file are not counted twice
+    for p, content in parts.items():
+        with open(p, 'wb') as fw:
+            fw.write(content)
+    result, chunks = load_checkpoint(checkpoint_dir, 'job', CountProcessor().accumulator)
+    assert result['entries'].value == 30 and len(chunks) == 3
+    assert len(glob.glob(os.path.join(checkpoint_dir, '*.pickle'))) == 1
+
+    # only the new chunks are processed on resume
+    out = process_chunks(CheckpointCoffeaProcessor(CountProcessor(), checkpoint_dir, chunks, interval=-1), [0, 10, 20, 30])
+    assert out['entries'].value == 10
+    result, chunks = load_checkpoint(checkpoint_dir, 'job', CountProcessor().accumulator)
+    assert result['entries'].value == 40 and len(chunks) == 4
+
+    # a checkpoint of a different job configuration is discarded
+    result, chunks = load_checkpoint(checkpoint_dir, 'other job', CountProcessor().accumulator)
+    assert result['entries'].value == 0 and chunks == set()
+    clear_checkpoint(checkpoint_dir)
+    assert not os.path.exists(checkpoint_dir)
@@ -0,0 +1,35 @@
+import awkward as ak
+import numpy as np
+
+from utils.expr_tools import ExprEvaluator
+
+
+def make_events():
+    rng = np.random.default_rng(42)
+    return ak.zip({'a': rng.uniform(0., 3., 1000), 'b': rng.uniform(0., 3., 1000), 'c': rng.uniform(0., 3., 1000)})
+
+
+def test_and_or_of_the_same_operands():
+    events = make_events()
+    a, b = ak.to_numpy(events.a), ak.to_numpy(events.b)
+    evaluator = ExprEvaluator(events)
+    # evaluated in one evaluator, so that a shared cache entry would return the first mask for the second expression
+    assert np.array_equal(ak.to_numpy(evaluator.evaluate('(a>1) and (b>2)')), (a > 1) & (b > 2))
+    assert np.array_equal(ak.to_numpy(evaluator.evaluate('(a>1) or (b>2)')), (a > 1) | (b > 2))
+
+
+def test_grouping_of_bool_ops():
+    events = make_events()
+    a, b, c = ak.to_numpy(events.a), ak.to_numpy(events.b), ak.to_numpy(events.c)
+    evaluator = ExprEvaluator(events)
+    assert np.array_equal(ak.to_numpy(evaluator.evaluate('((a>1) and (b>2)) or (c>1)')), ((a > 1) & (b > 2)) | (c > 1))
+    assert np.array_equal(ak.to_numpy(evaluator.evaluate('(a>1) and ((b>2) or (c>1))')), (a > 1) & ((b > 2) | (c > 1)))
+
+
+def test_chained_comparisons():
+    events = make_events()
+    a, b, c = ak.to_numpy(events.a), ak.to_numpy(events.b), ak.to_numpy(events.c)
+    evaluator = ExprEvaluator(events)
+    assert np.array_equal(ak.to_numpy(evaluator.evaluate('a < b < c')), (a < b) & (b < c))
+    assert np.array_equal(ak.to_numpy(evaluator.evaluate('a > b > c')), (a > b) & (b > c))
+    assert np.array_equal(ak.to_numpy(evaluator.evaluate('a <= b >= c')), (a <= b) & (b >= c))
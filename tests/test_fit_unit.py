@@ -0,0 +1,75 @@
+import os
+import glob
+import time
+import zlib
+import pickle
+import shutil
+
+import fit_unit
+from fit_unit import FitUnit
+
+NBDT = 9
+
+
+def fake_fit_unit(arg):
+    r"""Write a fit log with SFs depending on the fit point only. A few non-central points fail."""
+    inputdir, workdir, args, is_central, mode = arg
+    seed = zlib.crc32(workdir.encode())
+    time.sleep((seed % 5) * 1e-3)
+    os.makedirs(workdir, exist_ok=True)
+    with open(os.path.join(workdir, 'fit.log'), 'w') as fw:
+        for i, sf in enumerate('BCL'):
+            fw.write(f'SF_flv{sf} : {0.8 + (seed >> i) % 400 / 1000:.4f} -0.050/+0.060\n')
+    return (workdir, 1 if not is_central and seed % 7 == 0 else 0)
+
+
+def write_fake_tmpl_fitpath(global_cfg):
+    outputdir = os.path.join('output', global_cfg.routine_name + '_' + str(global_cfg.year), '3_tmpl_writer')
+    pt_edges = global_cfg.pt_edges + [100000]
+    tmpl_fitpath = []
+    for wp in global_cfg.tagger.wps:
+        for ptmin, ptmax in zip(pt_edges[:-1], pt_edges[1:]):
+            for ibdt in range(NBDT):
+                path = os.path.join(outputdir, 'cards', wp, f'pt{ptmin}to{ptmax}', f'bdt{ibdt}{ibdt}')
+                os.makedirs(path)
+                tmpl_fitpath.append(path)
+    with open(os.path.join(outputdir, 'tmpl_fitpath.pickle'), 'wb') as fw:
+        pickle.dump(tmpl_fitpath, fw)
+    return tmpl_fitpath
+
+
+def collect_outputs(global_cfg):
+    dirname = global_cfg.routine_name + '_' + str(global_cfg.year)
+    outputs = {}
+    for path in glob.glob(os.path.join('output', dirname, '4_fit', '**', 'fit.log'), recursive=True) \
+        + glob.glob(os.path.join('web', dirname, '4_fit', '**', '*.html'), recursive=True):
+        outputs[path] = open(path).read()
+    shutil.rmtree(os.path.join('output', dirname, '4_fit'))
+    shutil.rmtree(os.path.join('web', dirname, '4_fit'))
+    return outputs
+
+
+def test_streaming_matches_barrier(synth_cfg, monkeypatch):
+    synth_cfg.show_fit_number_only = True
+    synth_cfg.show_unce_breakdown = synth_cfg.show_full_unce_breakdown = synth_cfg.show_sfbdt_variation = False
+    monkeypatch.setattr(fit_unit, 'concurrent_fit_unit', fake_fit_unit)
+    monkeypatch.setattr(fit_unit, '_cmssw_env_ready', True)
+    failed_summaries = []
+    monkeypatch.setattr(fit_unit._logger, 'error', lambda msg, *args: failed_summaries.append(msg))
+    tmpl_fitpath = write_fake_tmpl_fitpath(synth_cfg)
+
+    FitUnit(synth_cfg, workers=3).launch()
+    outputs_barrier = collect_outputs(synth_cfg)
+
+    # the templates of each WP and pT bin are written in any order in step 3
+    step_4 = FitUnit(synth_cfg, workers=3)
+    step_4.start_streaming()
+    groups = [tmpl_fitpath[i:i + NBDT] for i in range(0, len(tmpl_fitpath), NBDT)]
+    for group in groups[1::2] + groups[::2][::-1]:
+        step_4.submit_fit_points(group)
+    step_4.launch()
+    outputs_streaming = collect_outputs(synth_cfg)
+
+    assert len(outputs_barrier) == 3 * len(tmpl_fitpath) + 4
+    assert outputs_streaming == outputs_barrier
+    assert len(failed_summaries) == 2 and failed_summaries[0] == failed_summaries[1]
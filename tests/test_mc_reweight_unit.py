@@ -0,0 +1,44 @@
+import numpy as np
+
+from mc_reweight_unit import MCReweightUnit, MCReweightCoffeaProcessor
+
+
+def run_incremental(global_cfg, fileset, chunksize=1000):
+    step_1 = MCReweightUnit(global_cfg, fileset=fileset, workers=1, executor='iterative', chunksize=chunksize)
+    step_1.incremental = True
+    step_1.run_coffea_job()
+    return step_1.result
+
+
+def test_new_file_processed_alone(synth_cfg, monkeypatch):
+    from launcher import get_fileset
+    processed = set()
+    process = MCReweightCoffeaProcessor.process
+    def process_recorded(self, events):
+        processed.add(events.metadata['filename'])
+        return process(self, events)
+    monkeypatch.setattr(MCReweightCoffeaProcessor, 'process', process_recorded)
+
+    fileset = get_fileset(synth_cfg)
+    new_dataset = [dataset for dataset in fileset if dataset != 'jetht'][-1]
+    run_incremental(synth_cfg, {dataset: paths for dataset, paths in fileset.items() if dataset != new_dataset})
+    assert processed == {path for dataset, paths in fileset.items() for path in paths if dataset != new_dataset}
+
+    # only the file of a newly added sample is processed
+    processed.clear()
+    result = run_incremental(synth_cfg, fileset)
+    assert processed == set(fileset[new_dataset])
+
+    # the runtime options do not invalidate the partial results
+    processed.clear()
+    run_incremental(synth_cfg, fileset, chunksize=700)
+    assert processed == set()
+
+    # the merged result matches a job over all files
+    step_1 = MCReweightUnit(synth_cfg, fileset=fileset, workers=1, executor='iterative', chunksize=1000)
+    step_1.run_coffea_job()
+    for key, h in step_1.result.items():
+        if key.startswith('ht_'):
+            assert list(h.axes[0]) == list(result[key].axes[0])
+            assert np.allclose(h.values(flow=True), result[key].values(flow=True), rtol=1e-12, atol=0.)
+    assert step_1.result['cutflow'] == result['cutflow']
@@ -0,0 +1,27 @@
+import types
+import numpy as np
+import uproot
+
+from utils.resource_estimator import get_num_entries
+
+
+def test_maxchunks_per_dataset(tmp_path):
+    paths = []
+    for i, n in enumerate([2500, 1000, 3000]):
+        paths.append(str(tmp_path / f'f{i}.root'))
+        with uproot.recreate(paths[-1]) as f:
+            f['Events'] = {'x': np.zeros(n)}
+
+    global_cfg = types.SimpleNamespace(coffea_chunksize=1000, coffea_maxchunks=None)
+    assert get_num_entries(global_cfg, {'a': paths}) == {paths[0]: 2500, paths[1]: 1000, paths[2]: 3000}
+
+    # dataset 'a': 2 chunks of 1250 from the first file, then 1 chunk of 1000 from the second file
+    global_cfg.coffea_maxchunks = 3
+    entries = get_num_entries(global_cfg, {'a': paths})
+    assert entries == {paths[0]: 2500, paths[1]: 1000, paths[2]: 0}
+    global_cfg.coffea_maxchunks = 1
+    entries = get_num_entries(global_cfg, {'a': paths})
+    assert entries == {paths[0]: 1250, paths[1]: 0, paths[2]: 0}
+    # the limit applies to each dataset separately
+    entries = get_num_entries(global_cfg, {'b': paths[2:]})
+    assert entries == {paths[2]: 1000}
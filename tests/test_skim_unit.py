@@ -0,0 +1,50 @@
+import copy
+import numpy as np
+
+from skim_unit import SkimUnit
+from mc_reweight_unit import MCReweightUnit
+
+
+def run_mc_reweight(global_cfg, fileset, treename='Events'):
+    step_1 = MCReweightUnit(global_cfg, fileset=fileset, workers=1, executor='iterative', chunksize=1000, treename=treename)
+    step_1.run_coffea_job()
+    return step_1.result
+
+
+def test_skim_matches_full_ntuples(synth_cfg):
+    from launcher import get_fileset
+    fileset = get_fileset(synth_cfg)
+    step_0 = SkimUnit(synth_cfg, fileset=fileset, workers=1, executor='iterative', chunksize=1000)
+    assert step_0.load_skim_fileset() is None
+    step_0.launch()
+    assert step_0.load_skim_fileset() == step_0.skim_fileset
+
+    # step 1 reading the skim fills the same histograms as reading the full ntuples
+    result_full = run_mc_reweight(synth_cfg, fileset)
+    global_cfg = copy.deepcopy(synth_cfg)
+    global_cfg.use_jet_skim = True
+    result_skim = run_mc_reweight(global_cfg, step_0.skim_fileset, treename='Jets')
+    assert result_full['ht_fj1'].sum().value > 0
+    for key, h in result_full.items():
+        if key.startswith('ht_'):
+            assert list(h.axes[0]) == list(result_skim[key].axes[0])
+            assert np.allclose(h.values(flow=True), result_skim[key].values(flow=True), rtol=1e-12, atol=0.)
+            assert np.allclose(h.variances(flow=True), result_skim[key].variances(flow=True), rtol=1e-12, atol=0.)
+    assert result_full['cutflow'] == result_skim['cutflow']
+
+    # the skim is outdated when the selection changes
+    global_cfg = copy.deepcopy(synth_cfg)
+    global_cfg.custom_selection = 'fj_x_pt>500'
+    assert SkimUnit(global_cfg, fileset=fileset).load_skim_fileset() is None
+
+
+def test_batch_skim_holds_branches_of_all_cards(synth_cfg):
+    global_cfg = copy.deepcopy(synth_cfg)
+    global_cfg.routine_name = 'synth_cc'
+    global_cfg.tagger.expr = 'FatJet_particleNetMD_Xcc / (FatJet_particleNetMD_Xcc + FatJet_particleNetMD_QCD)'
+    step_0 = SkimUnit(synth_cfg, fileset={})
+    step_0_batch = SkimUnit(synth_cfg, fileset={}, batch_cfgs=[global_cfg])
+    assert 'fj_x_ParticleNetMD_Xcc' not in step_0.branches[1] and 'fj_x_ParticleNetMD_Xcc' in step_0_batch.branches[1]
+    assert set(step_0.branches[1]) < set(step_0_batch.branches[1])
+    # a skim written for one card is not reused for the batch
+    assert step_0.get_skim_fingerprint() != step_0_batch.get_skim_fingerprint()
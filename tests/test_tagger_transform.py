@@ -0,0 +1,31 @@
+import numpy as np
+
+from utils.tagger_transform import TaggerTransformMap
+
+
+def make_map():
+    # a signal-like tagger distribution piling up at 1, where the cubic interpolation of its cumulative overshoots
+    x = np.linspace(0., 1., 51)
+    y = np.exp(40. * (x[1:] - 1.))
+    y[-3:] *= [5., 20., 100.]
+    y_cum = np.concatenate([[0.], np.cumsum(y)]) / y.sum()
+    return TaggerTransformMap(x, y_cum)
+
+
+def test_monotone_map():
+    fmap = make_map()
+    assert not fmap.is_monotone
+
+    t = np.sort(np.random.default_rng(42).uniform(0., 1., 100000))
+    assert np.all(np.diff(fmap(t)) >= 0.)
+    assert fmap.max_deviation < 1e-2
+    assert np.max(np.abs(fmap(t) - fmap.cubic_map()(t))) <= fmap.max_deviation + 1e-12
+
+
+def test_edges():
+    fmap = make_map()
+    assert fmap(0.) == 0. and fmap(1.) == 1.
+    assert np.array_equal(fmap([-1., 2.]), [0., 1.])
+    assert np.isnan(fmap(np.nan))
+    # the nodes are mapped to the cumulative distribution up to the correction of the overshoot
+    assert np.max(np.abs(fmap(fmap.x) - fmap.y_cum)) <= fmap.max_deviation
@@ -0,0 +1,108 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import time
+import json
+
+from unit import ProcessingUnit, StandaloneMultiThreadedUnit, get_lpt_makespan
+from utils.tools import hash_object
+
+
+def sleep_task(arg):
+    name, duration = arg
+    start_time = time.time()
+    time.sleep(duration)
+    return name, start_time
+
+
+def test_lpt_makespan():
+    # longest-first order on two workers: [5], [4, 3] -> 7, while the booking order [3, 4, 5] gives [3, 5], [4] -> 8
+    assert get_lpt_makespan([5, 4, 3], 2) == 7
+    assert get_lpt_makespan([3, 4, 5], 2) == 8
+    assert get_lpt_makespan([1, 1], 4) == 1
+
+
+def run_tasks(runtime_model_path, durations, priors):
+    unit = StandaloneMultiThreadedUnit(workers=1, runtime_model_path=runtime_model_path)
+    for name, duration in durations.items():
+        unit.book((name, duration), cost_key=name, prior=priors[name])
+    result = unit.run(sleep_task)
+    unit.pool.close()
+    # the results are in the booking order, while the tasks started in the longest-first order
+    assert [name for name, _ in result] == list(durations)
+    return [name for name, _ in sorted(result, key=lambda res: res[1])]
+
+
+def test_longest_first_scheduling(tmp_path):
+    runtime_model_path = str(tmp_path / 'runtime_model.json')
+    durations = {'a': 0.01, 'b': 0.2, 'c': 0.1}
+    # scheduled by the priors before the runtime is learned
+    assert run_tasks(runtime_model_path, durations, priors={'a': 3., 'b': 1., 'c': 2.}) == ['a', 'c', 'b']
+    with open(runtime_model_path) as f:
+        runtime_model = json.load(f)
+    assert runtime_model['b']['runtime'] > runtime_model['c']['runtime'] > runtime_model['a']['runtime']
+    # then by the learned runtime
+    assert run_tasks(runtime_model_path, durations, priors={'a': 3., 'b': 1., 'c': 2.}) == ['b', 'c', 'a']
+
+
+class Spline(object):
+    r"""An object which cannot be hashed by content, standing for the spline objects passed to the processors"""
+
+    def __init__(self, text):
+        self.coeffs = np.array([float(c) for c in text.split()])
+
+
+class ArtifactUnit(ProcessingUnit):
+    r"""A unit without coffea job whose processor argument is derived from an upstream artifact"""
+
+    def __init__(self, outputdir, artifact, cfg):
+        super().__init__(job_name='test', processor_kwargs={'global_cfg': cfg})
+        self.outputdir = outputdir
+        self.upstream_artifacts = [artifact]
+        self.derived_processor_kwargs = ['spline']
+        self.n_postprocess = 0
+
+    def preprocess(self):
+        with open(self.upstream_artifacts[0]) as f:
+            self.processor_kwargs['spline'] = Spline(f.read())
+
+    def postprocess(self):
+        self.n_postprocess += 1
+
+
+def test_hash_object():
+    cfg = SimpleNamespace(a=1, b=[1., 'x'], c={'d': None})
+    assert hash_object(cfg) == hash_object(SimpleNamespace(c={'d': None}, b=[1., 'x'], a=1))
+    assert hash_object(cfg) != hash_object(SimpleNamespace(a=2, b=[1., 'x'], c={'d': None}))
+    with pytest.raises(TypeError):
+        hash_object({'spline': np.zeros(3)})
+
+
+def test_incremental_skip(tmp_path):
+    artifact = tmp_path / 'artifact.txt'
+    artifact.write_text('1 2 3')
+    cfg = SimpleNamespace(a=1)
+
+    def launch():
+        unit = ArtifactUnit(str(tmp_path), str(artifact), cfg)
+        unit.launch(incremental=True)
+        return unit
+
+    assert launch().n_postprocess == 1
+    # unchanged inputs: the step is skipped
+    assert launch().n_postprocess == 0
+
+    # the derived processor argument enters the fingerprint by the content of the artifact
+    unit = ArtifactUnit(str(tmp_path), str(artifact), cfg)
+    unit.preprocess()
+    fingerprint = unit.get_checkpoint_fingerprint()
+    unit.preprocess()
+    assert unit.get_checkpoint_fingerprint() == fingerprint
+    artifact.write_text('1 2 4')
+    assert unit.get_checkpoint_fingerprint() != fingerprint
+    assert launch().n_postprocess == 1
+    assert launch().n_postprocess == 0
+
+    # the config enters the fingerprint
+    cfg.a = 2
+    assert launch().n_postprocess == 1
@@ -0,0 +1,107 @@
+import os
+import numpy as np
+import pytest
+import xgboost as xgb
+
+from utils.xgb_tools import XGBHelper, XGBEnsemble, FlatTreeEnsemble, SFBDTCache, prob_to_margin
+
+VAR_LIST = ['a', 'b', 'c', 'd']
+
+
+def train_folds(tmp_path, nfold=3, objective='binary:logistic'):
+    r"""Train a small k-fold model on inputs with missing values, stored as `<path>.<fold>` as the sfBDT models"""
+    rng = np.random.default_rng(42)
+    x = rng.normal(size=(3000, len(VAR_LIST))).astype(np.float32)
+    y = (x[:, 0] + x[:, 1] * x[:, 2] + rng.normal(scale=0.5, size=len(x)) > 0).astype(np.float32)
+    x[rng.random(x.shape) < 0.1] = np.nan
+    path = str(tmp_path / 'xgb_train.model')
+    for k in range(nfold):
+        sel = np.arange(len(x)) % nfold != k
+        params = {'objective': objective, 'max_depth': 4, 'eta': 0.3, 'nthread': 1}
+        bst = xgb.train(params, xgb.DMatrix(x[sel], label=y[sel], feature_names=VAR_LIST), num_boost_round=20)
+        bst.save_model(path + f'.{k}')
+    return [path + f'.{k}' for k in range(nfold)]
+
+
+def make_inputs(n=5000):
+    rng = np.random.default_rng(7)
+    inputs = {k: rng.normal(size=n).astype(np.float32) for k in VAR_LIST}
+    for k in VAR_LIST:
+        inputs[k][rng.random(n) < 0.1] = np.nan
+    return inputs
+
+
+def test_xgb_ensemble_matches_folds(tmp_path):
+    model_files = train_folds(tmp_path)
+    inputs = make_inputs()
+    preds = np.mean([XGBHelper(f, VAR_LIST).eval(inputs) for f in model_files], axis=0)
+    assert np.allclose(XGBEnsemble(model_files, VAR_LIST).eval(inputs), preds, rtol=1e-6, atol=0.)
+    assert len(XGBEnsemble(model_files, VAR_LIST).eval({k: v[:0] for k, v in inputs.items()})) == 0
+
+
+@pytest.mark.parametrize('objective', ['binary:logistic', 'reg:squarederror'])
+def test_flat_trees_match_xgboost(tmp_path, objective):
+    model_files = train_folds(tmp_path, objective=objective)
+    inputs = make_inputs()
+    for k in VAR_LIST: # a jet with all inputs missing
+        inputs[k][0] = np.nan
+    preds_xgb = XGBEnsemble(model_files, VAR_LIST).eval(inputs)
+    preds_flat = FlatTreeEnsemble(model_files, VAR_LIST).eval(inputs)
+    assert preds_flat.dtype == np.float32
+    assert np.allclose(preds_flat, preds_xgb, rtol=1e-6, atol=1e-6)
+
+
+def test_unsupported_objective():
+    assert prob_to_margin('binary:logistic', 0.5) == 0.
+    with pytest.raises(ValueError):
+        prob_to_margin('multi:softprob', 0.5)
+
+
+class Predictor:
+    r"""Predictions depending on the tag and the number of selected jets, recording the requested tags"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, tags):
+        self.calls.append(list(tags))
+        return [np.full(self.nsel, float(len(tag))) for tag in tags]
+
+
+def test_sfbdt_cache(tmp_path):
+    path = str(tmp_path / 'f.root')
+    with open(path, 'wb') as fw:
+        fw.write(b'0' * 100)
+    metadata = {'filename': path, 'treename': 'Events', 'entrystart': 0, 'entrystop': 100}
+    mask = np.arange(100) % 3 == 0
+    cache = SFBDTCache(str(tmp_path / 'cache'), 'model')
+    predict = Predictor()
+    predict.nsel = np.count_nonzero(mask)
+
+    counter = {'hits': 0, 'misses': 0}
+    values = cache.get_many(metadata, ['fj1_nominal', 'fj1_jesUp'], mask, predict, counter=counter)
+    assert predict.calls == [['fj1_nominal', 'fj1_jesUp']] and counter == {'hits': 0, 'misses': 2}
+    assert np.array_equal(values['fj1_jesUp'], np.full(predict.nsel, 9.))
+
+    # only the missing tag is predicted
+    values = cache.get_many(metadata, ['fj1_nominal', 'fj1_jesUp', 'fj1_jerUp'], mask, predict, counter=counter)
+    assert predict.calls[1:] == [['fj1_jerUp']] and counter == {'hits': 2, 'misses': 3}
+    assert np.array_equal(values['fj1_nominal'], np.full(predict.nsel, 11.))
+    assert np.array_equal(cache.get(metadata, 'fj1_nominal', mask, lambda: None), values['fj1_nominal'])
+
+    # a corrupted file is predicted again
+    with open(cache.get_path(metadata, 'fj1_nominal', mask), 'wb') as fw:
+        fw.write(b'corrupted')
+    cache.get_many(metadata, ['fj1_nominal'], mask, predict)
+    assert predict.calls[2:] == [['fj1_nominal']]
+
+    # the predictions depend on the jet selection, the chunk, the input file, and the model
+    paths = {cache.get_path(metadata, 'fj1_nominal', mask)}
+    paths.add(cache.get_path(metadata, 'fj1_nominal', np.roll(mask, 1)))
+    paths.add(cache.get_path({**metadata, 'entrystart': 100, 'entrystop': 200}, 'fj1_nominal', mask))
+    paths.add(SFBDTCache(str(tmp_path / 'cache'), 'other model').get_path(metadata, 'fj1_nominal', mask))
+    with open(path, 'ab') as fw:
+        fw.write(b'0')
+    paths.add(cache.get_path(metadata, 'fj1_nominal', mask))
+    assert len(paths) == 5
+    assert not any(p.endswith('.tmp') for _, _, files in os.walk(tmp_path / 'cache') for p in files)
@@ -3,7 +3,8 @@ For step 3: derive the template for fit.
 
 """
 
-from coffea import processor, hist
+from coffea import processor
+import hist
 import awkward as ak
 import numpy as np
 import uproot
@@ -11,7 +12,6 @@ import uproot3
 
 import matplotlib.pyplot as plt
 import matplotlib as mpl
-import seaborn as sns
 from cycler import cycler 
 mpl.use('Agg')
 mpl.rcParams['axes.prop_cycle'] = cycler(color=['blue', 'red', 'green', 'violet', 'darkorange', 'black', 'cyan', 'yellow'])
@@ -27,23 +27,32 @@ import pickle
 import json
 import os
 
-from unit import ProcessingUnit, StandaloneMultiThreadedUnit
+from unit import ProcessingUnit, StandaloneMultiThreadedUnit, FIT_CFG_KEYS
 from utils.web_maker import WebMaker
-from utils.tools import lookup_pt_based_weight, parse_tagger_expr
+from utils.tools import lookup_pt_based_weight, parse_tagger_expr, get_jet_selection, get_columns, prefetch_columns
+from utils.expr_tools import ExprEvaluator
+from utils.coffea_tools import HistAccumulator, sort_categories
 from utils.plotting import make_generic_mc_data_plots
-from utils.bh_tools import bh_to_uproot3, fix_bh, scale_bh
-from utils.xgb_tools import XGBEnsemble
+from utils.bh_tools import bh_to_uproot3, fix_bh, scale_bh, bh_to_memmap
+from utils.xgb_tools import get_input_matrix, get_sfbdt_model_files, load_sfbdt_model, make_sfbdt_cache
+from utils.coastline_tools import concurrent_coastline_grid_unit
 from logger import _logger
 
+# branches of the JES/JER correction factors of the jet pT (and of the HT with the `ht` prefix)
+JES_JER_SUFFIX_TO_BRANCH = {'jesUp': '_jesUncFactorUp', 'jesDown': '_jesUncFactorDn', 'jerUp': '_jerSmearFactorUp', 'jerDown': '_jerSmearFactorDn'}
+# sfBDT inputs rescaled by the JES/JER correction factors
+JES_JER_SCALED_SFBDT_INPUTS = ['fj_x_sj1_rawmass', 'fj_x_sj2_rawmass', 'fj_x_sj1_sv1_pt', 'fj_x_sj2_sv1_pt']
+
 
 class TmplWriterCoffeaProcessor(processor.ProcessorABC):
     r"""The coffea processor for the coastline and template writing step"""
 
-    def __init__(self, global_cfg=None, weight_map=None, xtagger_map=None, coastline_map=None, sfbdt_weight_map=None):
+    def __init__(self, global_cfg=None, weight_map=None, xtagger_map=None, coastline_map=None, coastline_grids=None, sfbdt_weight_map=None):
         self.global_cfg = global_cfg
         self.weight_map = weight_map
         self.xtagger_map = xtagger_map
         self.coastline_map = coastline_map
+        self.coastline_grids = coastline_grids # the CoastlineIndexGrid of each pT bin
         self.sfbdt_weight_map = sfbdt_weight_map
         self.pt_edges = global_cfg.pt_edges + [100000]
         self.pt_reweight_edges = [edge[0] for edge in global_cfg.rwgt_pt_bins]
@@ -52,6 +61,7 @@ class TmplWriterCoffeaProcessor(processor.ProcessorABC):
         self.tagger_expr = parse_tagger_expr(global_cfg.tagger_name_replace_map, global_cfg.tagger.expr)
         self.lookup_mc_weight = partial(lookup_pt_based_weight, self.weight_map, self.pt_reweight_edges, jet_var_maxlimit=2500.)
         self.lookup_sfbdt_weight = partial(lookup_pt_based_weight, self.sfbdt_weight_map, self.pt_reweight_edges, jet_var_maxlimit=1.)
+        self.columns = get_columns(global_cfg, *self.get_branches(global_cfg), on_skim=global_cfg.use_jet_skim)
         self.untypes = ['nominal', 'fracBCLUp', 'fracBCLDown', 'puUp', 'puDown', 'l1PreFiringUp', 'l1PreFiringDown', 'jesUp', 'jesDown', 'jerUp', 'jerDown', 'psWeightIsrUp', 'psWeightIsrDown', 'psWeightFsrUp', 'psWeightFsrDown', 'sfBDTRwgtUp']
         self.write_untypes = [
             'nominal', 'puUp', 'puDown', 'l1PreFiringUp', 'l1PreFiringDown', 'jesUp', 'jesDown', 'jerUp', 'jerDown', \
@@ -60,16 +70,14 @@ class TmplWriterCoffeaProcessor(processor.ProcessorABC):
             'sfBDTRwgtUp', 'sfBDTRwgtDown', 'fitVarRwgtUp', 'fitVarRwgtDown'
         ]
         if self.global_cfg.custom_sfbdt_path is not None:
-            self.xgb = XGBEnsemble(
-                [self.global_cfg.custom_sfbdt_path + '.%d' % i for i in range(self.global_cfg.custom_sfbdt_kfold)],
-                self.global_cfg.sfbdt_input_exprs,
-            )
+            self.xgb = load_sfbdt_model(self.global_cfg)
+        self.sfbdt_cache = make_sfbdt_cache(self.global_cfg)
 
-        dataset = hist.Cat("dataset", "dataset")
-        flv_bin = hist.Bin('flv', 'flv', [-.5, .5, 1.5, 2.5]) # three bins for flvL=0, flvB=1, flvC=2
-        passwp_bin = hist.Bin('passwp', 'passwp', [-.5, .5, 1.5]) # two bins for fail=0, pass=1
+        dataset = hist.axis.StrCategory([], name='dataset', label='dataset', growth=True)
+        flv_bin = hist.axis.Variable([-.5, .5, 1.5, 2.5], name='flv', label='flv') # three bins for flvL=0, flvB=1, flvC=2
+        passwp_bin = hist.axis.Variable([-.5, .5, 1.5], name='passwp', label='passwp') # two bins for fail=0, pass=1
         logmsv_bin_edges = [-0.8, -0.4, 0., 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1., 1.1, 1.2, 1.3, 1.4, 1.5, 1.6, 1.7, 1.8, 2.5, 3.2]
-        logmsv_bin = hist.Bin('logmsv', 'logmsv', logmsv_bin_edges)
+        logmsv_bin = hist.axis.Variable(logmsv_bin_edges, name='logmsv', label='logmsv')
         self.incl_var_dict = { # key: (label, bin args)
             'sfbdt': ('sfBDT', (50, 0., 1.)),
             'tagger': ('Tagger discr.', (50, *self.global_cfg.tagger.span)),
@@ -82,24 +90,47 @@ class TmplWriterCoffeaProcessor(processor.ProcessorABC):
 
         hist_fit, hist_incl = {}, {}
         for ipt, (ptmin, ptmax) in enumerate(zip(self.pt_edges[:-1], self.pt_edges[1:])):
-            coastline_bin = hist.Bin('coastline', 'coastline', coastline_map[ipt]['levels'])
+            coastline_bin = hist.axis.Variable(coastline_map[ipt]['levels'], name='coastline', label='coastline')
             for wp in self.wps:
                 for untype in self.untypes:
                     # these unce types should derive individual hist templates
                     hist_fit.update({
-                        f'h_pt{ptmin}to{ptmax}_{wp}_{untype}': hist.Hist('Counts', dataset, flv_bin, passwp_bin, coastline_bin, logmsv_bin),
+                        f'h_pt{ptmin}to{ptmax}_{wp}_{untype}': HistAccumulator(
+                            dataset, flv_bin, passwp_bin, coastline_bin, logmsv_bin, storage=hist.storage.Weight(), label='Counts'
+                        ),
                     })
             # inclusive histogram (pass+fail)
             for var in self.incl_var_dict:
                 _, bin_args = self.incl_var_dict[var]
+                var_bin = hist.axis.Regular(*bin_args, name='var', label='var') if len(bin_args) == 3 else hist.axis.Variable(*bin_args, name='var', label='var')
                 hist_incl.update({
-                    f'hinc_{var}_pt{ptmin}to{ptmax}': hist.Hist('Counts', dataset, flv_bin, coastline_bin, hist.Bin('var', 'var', *bin_args)),
+                    f'hinc_{var}_pt{ptmin}to{ptmax}': HistAccumulator(dataset, flv_bin, coastline_bin, var_bin, storage=hist.storage.Weight(), label='Counts'),
                 })
 
         self._accumulator = processor.dict_accumulator({
             **hist_fit, **hist_incl,
+            'nbytes': processor.value_accumulator(int),
+            'expr_cache': processor.defaultdict_accumulator(int),
+            'sfbdt_cache': processor.defaultdict_accumulator(int),
         })
 
+    @staticmethod
+    def get_branches(global_cfg):
+        r"""The event-level and jet-level branches and the expressions read by the processor (see `get_columns`)"""
+        custom_sfbdt = global_cfg.custom_sfbdt_path is not None
+        event_branches = [
+            'ht', 'ht_jesUncFactorUp', 'ht_jesUncFactorDn', 'ht_jerSmearFactorUp', 'ht_jerSmearFactorDn',
+            'genWeight', 'xsecWeight', 'puWeight', 'puWeightUp', 'puWeightDown',
+            'l1PreFiringWeight', 'l1PreFiringWeightUp', 'l1PreFiringWeightDown', 'PSWeight',
+        ]
+        jet_branches = [
+            'fj_x_pt', 'fj_x_eta', 'fj_x_sdmass', 'fj_x_nbhadrons', 'fj_x_nchadrons',
+            'fj_x_jesUncFactorUp', 'fj_x_jesUncFactorDn', 'fj_x_jerSmearFactorUp', 'fj_x_jerSmearFactorDn',
+            'fj_x_sj1_sv1_dxysig', 'fj_x_sj2_sv1_dxysig', 'fj_x_sj1_sv1_masscor', 'fj_x_sj2_sv1_masscor',
+        ] + ([] if custom_sfbdt else ['fj_x_sfBDT'])
+        exprs = [parse_tagger_expr(global_cfg.tagger_name_replace_map, global_cfg.tagger.expr)] + (list(global_cfg.sfbdt_input_exprs) if custom_sfbdt else [])
+        return event_branches, jet_branches, exprs
+
     @property
     def accumulator(self):
         return self._accumulator
@@ -107,36 +138,48 @@ class TmplWriterCoffeaProcessor(processor.ProcessorABC):
 
     def process(self, events):
         out = self.accumulator.identity()
-        dataset = events.metadata['dataset']
+        metadata = events.metadata
+        dataset = metadata['dataset']
         is_mc = dataset != 'jetht'
 
-        presel = ak.numexpr.evaluate('passmetfilters & (' + '|'.join(self.global_cfg.hlt_branches[self.global_cfg.year]) + ')', events)
         lumi = self.global_cfg.lumi_dict[self.global_cfg.year]
+        events, nbytes = prefetch_columns(events, self.columns, self.global_cfg.coffea_decompression_workers)
+        out['nbytes'].add(nbytes)
+        evaluator = ExprEvaluator(events)
 
         for i in '12': # jet index
-            custom_sel = ak.numexpr.evaluate(self.global_cfg.custom_selection.replace('fj_x', f'fj_{i}'), events) if self.global_cfg.custom_selection is not None else ak.ones_like(presel, dtype=bool)
-            events_fj = events[(presel) & (events[f'fj_{i}_is_qualified']) & (custom_sel)]
+            sel, fj = get_jet_selection(events, i, self.global_cfg, on_skim=self.global_cfg.use_jet_skim, evaluator=evaluator)
+            events_fj = events[sel]
 
             # calculate bin variables
             if is_mc:
-                isB = events_fj[f'fj_{i}_nbhadrons'] >= 1
-                isC = (~isB) & (events_fj[f'fj_{i}_nchadrons'] >= 1)
+                isB = events_fj[f'{fj}_nbhadrons'] >= 1
+                isC = (~isB) & (events_fj[f'{fj}_nchadrons'] >= 1)
             else:
                 isB = isC = ak.zeros_like(events_fj.ht)
 
-            msv = ak.numexpr.evaluate(
-                f'(fj_{i}_sj1_sv1_dxysig>fj_{i}_sj2_sv1_dxysig)*fj_{i}_sj1_sv1_masscor + (fj_{i}_sj1_sv1_dxysig<=fj_{i}_sj2_sv1_dxysig)*fj_{i}_sj2_sv1_masscor',
-                events_fj
+            msv = evaluator.evaluate(
+                f'({fj}_sj1_sv1_dxysig>{fj}_sj2_sv1_dxysig)*{fj}_sj1_sv1_masscor + ({fj}_sj1_sv1_dxysig<={fj}_sj2_sv1_dxysig)*{fj}_sj2_sv1_masscor',
+                sel
             )
             logmsv = np.log(np.maximum(msv, 1e-20))
-            pt = events_fj[f'fj_{i}_pt']
+            pt = events_fj[f'{fj}_pt']
+            sfbdt_corr = {} # the sfBDT from the JES/JER corrected inputs
             if self.global_cfg.custom_sfbdt_path is not None:
-                sfbdt_inputs = {v: ak.numexpr.evaluate(v.replace('fj_x', f'fj_{i}'), events_fj) for v in self.global_cfg.sfbdt_input_exprs}
-                sfbdt = ak.Array(self.xgb.eval(sfbdt_inputs))
+                # predict the nominal and JES/JER corrected sfBDT at once
+                sfbdt_untypes = ['nominal'] + ([untype for untype in JES_JER_SUFFIX_TO_BRANCH if untype in self.untypes] if is_mc else [])
+                predict = partial(self.predict_sfbdt, evaluator, events_fj, fj, sel)
+                if self.sfbdt_cache is not None:
+                    tags = {f'{fj}_{untype}': untype for untype in sfbdt_untypes}
+                    preds = self.sfbdt_cache.get_many(metadata, list(tags), sel, lambda missing: predict([tags[tag] for tag in missing]), counter=out['sfbdt_cache'])
+                    preds = {tags[tag]: value for tag, value in preds.items()}
+                else:
+                    preds = dict(zip(sfbdt_untypes, predict(sfbdt_untypes)))
+                sfbdt = ak.Array(preds.pop('nominal'))
+                sfbdt_corr = {untype: ak.Array(value) for untype, value in preds.items()}
             else:
-                sfbdt = events_fj[f'fj_{i}_sfBDT']
-            sfbdt_corr_cache = {} # prepared for JES/JER corrected version of sfBDT
-            tagger = ak.numexpr.evaluate(self.tagger_expr.replace('fj_x', f'fj_{i}'), events_fj)
+                sfbdt = events_fj[f'{fj}_sfBDT']
+            tagger = evaluator.evaluate(self.tagger_expr.replace('fj_x', fj), sel)
             tagger = np.clip(tagger, *self.global_cfg.tagger.span)
             xtagger = self.xtagger_map(tagger)
 
@@ -145,22 +188,22 @@ class TmplWriterCoffeaProcessor(processor.ProcessorABC):
             if is_mc:
                 mc_weight = self.lookup_mc_weight(f'fj{i}', pt, events_fj['ht'])
                 sfbdt_weight = self.lookup_sfbdt_weight(f'fj{i}', pt, sfbdt)
-                weight_base = ak.numexpr.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeight*{lumi}', events_fj)
+                weight_base = evaluator.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeight*{lumi}', sel)
                 weight['nominal'] = weight_base * mc_weight
-                weight['fracBCLUp'] = weight['nominal'] * ak.numexpr.evaluate(
-                    f'(fj_{i}_nbhadrons>=1) * (1.2*(fj_{i}_nbhadrons>1) + 1.2*(fj_{i}_nbhadrons<=1)) + ' + \
-                    f'((fj_{i}_nbhadrons==0) & (fj_{i}_nchadrons>=1)) * (1.2*(fj_{i}_nchadrons>1) + 1.2*(fj_{i}_nchadrons<=1)) + ' + \
-                    f'((fj_{i}_nbhadrons==0) & (fj_{i}_nchadrons==0)) * (1.2)', events_fj
+                weight['fracBCLUp'] = weight['nominal'] * evaluator.evaluate(
+                    f'({fj}_nbhadrons>=1) * (1.2*({fj}_nbhadrons>1) + 1.2*({fj}_nbhadrons<=1)) + ' + \
+                    f'(({fj}_nbhadrons==0) & ({fj}_nchadrons>=1)) * (1.2*({fj}_nchadrons>1) + 1.2*({fj}_nchadrons<=1)) + ' + \
+                    f'(({fj}_nbhadrons==0) & ({fj}_nchadrons==0)) * (1.2)', sel
                 )
-                weight['fracBCLDown'] = weight['nominal'] * ak.numexpr.evaluate(
-                    f'(fj_{i}_nbhadrons>=1) * (0.8*(fj_{i}_nbhadrons>1) + 0.8*(fj_{i}_nbhadrons<=1)) + ' + \
-                    f'((fj_{i}_nbhadrons==0) & (fj_{i}_nchadrons>=1)) * (0.8*(fj_{i}_nchadrons>1) + 0.8*(fj_{i}_nchadrons<=1)) + ' + \
-                    f'((fj_{i}_nbhadrons==0) & (fj_{i}_nchadrons==0)) * (0.8)', events_fj
+                weight['fracBCLDown'] = weight['nominal'] * evaluator.evaluate(
+                    f'({fj}_nbhadrons>=1) * (0.8*({fj}_nbhadrons>1) + 0.8*({fj}_nbhadrons<=1)) + ' + \
+                    f'(({fj}_nbhadrons==0) & ({fj}_nchadrons>=1)) * (0.8*({fj}_nchadrons>1) + 0.8*({fj}_nchadrons<=1)) + ' + \
+                    f'(({fj}_nbhadrons==0) & ({fj}_nchadrons==0)) * (0.8)', sel
                 )
-                weight['puUp'] = ak.numexpr.evaluate(f'genWeight*xsecWeight*puWeightUp*l1PreFiringWeight*{lumi}', events_fj) * mc_weight
-                weight['puDown'] = ak.numexpr.evaluate(f'genWeight*xsecWeight*puWeightDown*l1PreFiringWeight*{lumi}', events_fj) * mc_weight
-                weight['l1PreFiringUp'] = ak.numexpr.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeightUp*{lumi}', events_fj) * mc_weight
-                weight['l1PreFiringDown'] = ak.numexpr.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeightDown*{lumi}', events_fj) * mc_weight
+                weight['puUp'] = evaluator.evaluate(f'genWeight*xsecWeight*puWeightUp*l1PreFiringWeight*{lumi}', sel) * mc_weight
+                weight['puDown'] = evaluator.evaluate(f'genWeight*xsecWeight*puWeightDown*l1PreFiringWeight*{lumi}', sel) * mc_weight
+                weight['l1PreFiringUp'] = evaluator.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeightUp*{lumi}', sel) * mc_weight
+                weight['l1PreFiringDown'] = evaluator.evaluate(f'genWeight*xsecWeight*puWeight*l1PreFiringWeightDown*{lumi}', sel) * mc_weight
                 if len(events_fj) and hasattr(events_fj, 'PSWeight') and len(events_fj.PSWeight[0]) == 4:
                     # apply PSWeight only at the final stage, while still using the nominal MC reweighting map
                     weight['psWeightIsrUp'] = weight['nominal'] * events_fj.PSWeight[:,2]
@@ -182,9 +225,9 @@ class TmplWriterCoffeaProcessor(processor.ProcessorABC):
 
             # fill histograms
             for ipt, (ptmin, ptmax) in enumerate(zip(self.pt_edges[:-1], self.pt_edges[1:])):
-                # coastline fpline values should be calculated inside the pT loop as the coastline shape depends on pT
+                # coastline bins should be looked up inside the pT loop as the coastline shape depends on pT
                 ptsel = (pt >= ptmin) & (pt < ptmax)
-                coastline_ptsel = ak.from_numpy(self.coastline_map[ipt]['fspline'](ak.to_numpy(xtagger[ptsel]), ak.to_numpy(sfbdt[ptsel])))
+                coastline_ptsel = self.coastline_grids[ipt](ak.to_numpy(xtagger[ptsel]), ak.to_numpy(sfbdt[ptsel]))
 
                 # fill in fit histogram
                 for wp in self.wps:
@@ -198,58 +241,78 @@ class TmplWriterCoffeaProcessor(processor.ProcessorABC):
                                 passwp=passwp[wp][ptsel],
                                 coastline=coastline_ptsel,
                                 logmsv=logmsv[ptsel],
-                                weight=weight[untype][ptsel]
+                                weight=weight[untype][ptsel],
+                                threads=self.global_cfg.coffea_fill_threads,
                             )
                         else:
                             # special handling for JES/JER: jet pt need to be corrected
-                            suffix_to_branch = {'jesUp': '_jesUncFactorUp', 'jesDown': '_jesUncFactorDn', 'jerUp': '_jerSmearFactorUp', 'jerDown': '_jerSmearFactorDn'}
-                            
-                            pt_corr = events_fj[f'fj_{i}_pt'] * events_fj[f'fj_{i}{suffix_to_branch[untype]}']
+                            suffix_to_branch = JES_JER_SUFFIX_TO_BRANCH
+                            pt_corr = events_fj[f'{fj}_pt'] * events_fj[f'{fj}{suffix_to_branch[untype]}']
                             ht_corr = events_fj[f'ht{suffix_to_branch[untype]}']
                             ptsel_corr = (pt_corr >= ptmin) & (pt_corr < ptmax)
                             weight_corr = weight_base * self.lookup_mc_weight(f'fj{i}', pt_corr, ht_corr, read_suffix=f'_{untype}') # use JES/JER reweight map and corrected HT & pT variables
-                            if untype not in sfbdt_corr_cache.keys():
-                                assert self.global_cfg.custom_sfbdt_path is not None, \
-                                    "To derive JES/JER templates, a customized sfBDT path must be specified because sfBDT will be recalculated from JES/JER corrected input"
-                                sfbdt_inputs = {}
-                                for v in self.global_cfg.sfbdt_input_exprs:
-                                    sfbdt_inputs[v] = ak.numexpr.evaluate(v.replace('fj_x', f'fj_{i}'), events_fj)
-                                    if any(v in expr for expr in ['fj_x_sj1_rawmass', 'fj_x_sj2_rawmass', 'fj_x_sj1_sv1_pt', 'fj_x_sj2_sv1_pt']):
-                                        sfbdt_inputs[v] = sfbdt_inputs[v] * events_fj[f'fj_{i}{suffix_to_branch[untype]}']
-                                sfbdt_corr_cache[untype] = ak.Array(self.xgb.eval(sfbdt_inputs))
-                            coastline_ptsel_corr = ak.from_numpy(self.coastline_map[ipt]['fspline'](ak.to_numpy(xtagger[ptsel_corr]), ak.to_numpy(sfbdt_corr_cache[untype][ptsel_corr])))
+                            assert self.global_cfg.custom_sfbdt_path is not None, \
+                                "To derive JES/JER templates, a customized sfBDT path must be specified because sfBDT will be recalculated from JES/JER corrected input"
+                            coastline_ptsel_corr = self.coastline_grids[ipt](ak.to_numpy(xtagger[ptsel_corr]), ak.to_numpy(sfbdt_corr[untype][ptsel_corr]))
                             out[f'h_pt{ptmin}to{ptmax}_{wp}_{untype}'].fill(
                                 dataset=dataset,
                                 flv=isB[ptsel_corr] * 1 + isC[ptsel_corr] * 2,
                                 passwp=passwp[wp][ptsel_corr],
                                 coastline=coastline_ptsel_corr,
                                 logmsv=logmsv[ptsel_corr],
-                                weight=weight_corr[ptsel_corr]
+                                weight=weight_corr[ptsel_corr],
+                                threads=self.global_cfg.coffea_fill_threads,
                             )
 
                 # fill in inclusive histogram
                 for var, expr in zip(self.incl_var_dict.keys(), [
                     'sfbdt[ptsel]', 'tagger[ptsel]', 'xtagger[ptsel]', 'logmsv[ptsel]', \
-                    f'events_fj.fj_{i}_eta[ptsel]', f'events_fj.fj_{i}_pt[ptsel]', f'events_fj.fj_{i}_sdmass[ptsel]',
+                    f'events_fj.{fj}_eta[ptsel]', f'events_fj.{fj}_pt[ptsel]', f'events_fj.{fj}_sdmass[ptsel]',
                 ]):
                     out[f'hinc_{var}_pt{ptmin}to{ptmax}'].fill(
                         dataset=dataset,
                         flv=isB[ptsel] * 1 + isC[ptsel] * 2,
                         coastline=coastline_ptsel,
                         var=eval(expr),
-                        weight=weight['nominal'][ptsel]
+                        weight=weight['nominal'][ptsel],
+                        threads=self.global_cfg.coffea_fill_threads,
                     )
 
+        out['expr_cache']['hits'] += evaluator.hits
+        out['expr_cache']['misses'] += evaluator.misses
         return out
 
 
+    def predict_sfbdt(self, evaluator, events_fj, fj, sel, untypes):
+        r"""Predict the sfBDT of the selected jets for the nominal and the JES/JER corrected inputs of each given untype with a
+            single call of the model, on the stacked input matrices. Only the inputs rescaled by the JES/JER correction
+            factors are recomputed from the nominal inputs."""
+        var_list = self.global_cfg.sfbdt_input_exprs
+        inputs = {v: evaluator.evaluate(v.replace('fj_x', fj), sel) for v in var_list}
+        mat = get_input_matrix(inputs, var_list)
+        mats = []
+        for untype in untypes:
+            if untype == 'nominal':
+                mats.append(mat)
+                continue
+            mat_corr = mat.copy()
+            for j, v in enumerate(var_list):
+                if any(v in expr for expr in JES_JER_SCALED_SFBDT_INPUTS):
+                    mat_corr[:, j] = ak.to_numpy(inputs[v] * events_fj[f'{fj}{JES_JER_SUFFIX_TO_BRANCH[untype]}'])
+            mats.append(mat_corr)
+        return np.split(self.xgb.eval_matrix(np.concatenate(mats)), len(untypes))
+
+
     def postprocess(self, accumulator):
+        sort_categories(accumulator)
         return accumulator
 
 
 class TmplWriterUnit(ProcessingUnit):
     r"""The unit processing wrapper of the second step (calculate the coastline and derive the fit template"""
 
+    fingerprint_exclude_cfg_keys = FIT_CFG_KEYS + ['coastline_scan']
+
     def __init__(self, global_cfg, job_name='3_tmpl_writer', job_name_step1='1_mc_reweight', job_name_step2='2_coastline', fileset=None, **kwargs):
         super().__init__(
             job_name=job_name,
@@ -269,6 +332,20 @@ class TmplWriterUnit(ProcessingUnit):
             os.makedirs(self.outputdir)
         if not os.path.exists(self.webdir):
             os.makedirs(self.webdir)
+
+        # called with the fit paths of each (WP, pT) point once its templates are written, e.g. to stream them to the fit
+        self.on_tmpl_written = None
+
+        # inputs of the step fingerprint
+        if self.global_cfg.custom_sfbdt_path is not None:
+            self.input_files = get_sfbdt_model_files(self.global_cfg)
+        self.upstream_artifacts = [
+            os.path.join(self.outputdir_step1, 'hist.json'),
+            os.path.join(self.outputdir_step2, 'sfbdt_hist.json'),
+            os.path.join(self.outputdir_step2, 'xtagger_map.pickle'),
+            os.path.join(self.outputdir_step2, 'coastline_map.pickle'),
+        ]
+        self.derived_processor_kwargs = ['weight_map', 'xtagger_map', 'coastline_map', 'coastline_grids', 'sfbdt_weight_map']
             
 
     def preprocess(self):
@@ -294,11 +371,24 @@ class TmplWriterUnit(ProcessingUnit):
         with open(os.path.join(self.outputdir_step2, 'coastline_map.pickle'), 'rb') as f:
             self.coastline_map = pickle.load(f)
 
+        # precompute the lookup grid of the coastline bins, to avoid evaluating the spline for each jet. The grids are built
+        # in subprocesses: the spline evaluation starts numba threads, which would deadlock the processes forked later
+        grid_handler = StandaloneMultiThreadedUnit(workers=min(self.workers, len(self.coastline_map)))
+        for coastline_map in self.coastline_map:
+            grid_handler.book((coastline_map['fspline'], coastline_map['levels']))
+        self.coastline_grids = grid_handler.run(concurrent_coastline_grid_unit)
+        if self.coastline_grids is None:
+            raise KeyboardInterrupt
+        for grid, ptmin, ptmax in zip(self.coastline_grids, self.global_cfg.pt_edges, self.global_cfg.pt_edges[1:] + [100000]):
+            _logger.info(f'Coastline index grid for pT ({ptmin}, {ptmax}): {grid.boundary_fraction * 100:.2f}% boundary cells evaluated '
+                         f'by the spline, agreement with the spline {grid.agreement * 100:.4f}%')
+
         ## 3. Put into arguments to initialize the coffea processor
         self.processor_kwargs.update(
             weight_map=self.weight_map,
             xtagger_map=self.xtagger_map,
             coastline_map=self.coastline_map,
+            coastline_grids=self.coastline_grids,
             sfbdt_weight_map=self.sfbdt_weight_map,
         )
 
@@ -317,16 +407,24 @@ class TmplWriterUnit(ProcessingUnit):
             writer_handler = StandaloneMultiThreadedUnit(workers=self.workers, use_unordered_mapping=True)
             args = SimpleNamespace(write_untypes=p.write_untypes, outputdir=self.outputdir)
 
+            # now all histogram infos are stored in the high-dim histograms. Place their contents in a memory-mapped file
+            # once, so that only the light-weight handles are sent to the workers
+            storage_path = os.path.join(self.outputdir, 'tmpl_hist_storage.dat')
+            bh_handles = bh_to_memmap(((key, self.result[key]) for key in self.result if key.startswith('h_pt')), storage_path)
+
             for wp in p.wps: # WP loop
                 for ipt, (ptmin, ptmax) in enumerate(zip(p.pt_edges[:-1], p.pt_edges[1:])): # pt loop
-                    # now all histogram infos are stored in the high-dim coffea hist
                     # we will use that to write all corresponding templates
-                    bhs = {key: self.result[key].to_boost() for key in self.result if key.startswith(f'h_pt{ptmin}to{ptmax}_{wp}')} # used hists for one tasks
+                    bhs = {key: bh_handles[key] for key in bh_handles if key.startswith(f'h_pt{ptmin}to{ptmax}_{wp}')} # used hists for one tasks
                     nbdt = len(self.coastline_map[ipt]['levels'])
                     writer_handler.book((args, bhs, wp, (ptmin, ptmax), nbdt))
 
             # run the tasks concurrently
-            result = writer_handler.run(concurrent_tmpl_writing_unit)
+            try:
+                callback = (lambda res: self.on_tmpl_written(res[1])) if self.on_tmpl_written is not None else None
+                result = writer_handler.run(concurrent_tmpl_writing_unit, callback=callback)
+            finally:
+                os.remove(storage_path)
 
             # also pickling the templates directly in the boost histogram format
             self.tmpl_hist = {}
@@ -361,6 +459,7 @@ class TmplWriterUnit(ProcessingUnit):
             plotter_handler = StandaloneMultiThreadedUnit(workers=self.workers, use_unordered_mapping=True)
             flvbin = ['flvL', 'flvB', 'flvC']
             iflvbin_order = [0, 2, 1] if self.global_cfg.type=='bb' else [0, 1, 2] if self.global_cfg.type=='cc' else [2, 1, 0] # e.g. flvL, flvC, flvB for bb
+            import seaborn as sns
             color_mc = sns.color_palette('cubehelix', 3)
             year, lumi = self.global_cfg.year, self.global_cfg.lumi_dict[self.global_cfg.year]
 
@@ -374,7 +473,7 @@ class TmplWriterUnit(ProcessingUnit):
                         use_helvetica=self.global_cfg.use_helvetica,
                         logmsv_div_by_binw=self.global_cfg.logmsv_div_by_binw,
                     )
-                    h = self.result[f'hinc_{var}_pt{ptmin}to{ptmax}'].to_boost()
+                    h = self.result[f'hinc_{var}_pt{ptmin}to{ptmax}']
                     nbdt = len(self.coastline_map[ipt]['levels'])
                     plot_args = {'ylog': True} if var == 'xtagger' else {}
                     plotter_handler.book((args, self.webdir, h, (var, xlabel), (ptmin, ptmax), nbdt, plot_args))
@@ -404,6 +503,7 @@ def concurrent_tmpl_writing_unit(arg):
     r"""Unit concurrent task to launch the rest for-loop in the template writing.
     """
     args, bhs, wp, (ptmin, ptmax), nbdt = arg
+    # bhs are the handles of the histograms in the memory-mapped storage: the templates are sliced from the file directly
     hs_stored, fitpath_stored = {}, []
     assert nbdt <= 10 and nbdt % 2 == 1
     bdtlist = [(i, i) for i in range(nbdt)] + [(i, j) for i in range(nbdt) for j in range(nbdt) if j != i]
@@ -1,12 +1,39 @@
-from coffea.nanoevents import BaseSchema
-from coffea import processor
-
+from functools import partial
+import concurrent.futures
 import multiprocessing
+import threading
+import heapq
 import pickle
+import json
+import time
 import os
 import signal
 from tqdm.auto import tqdm
 
+from utils.tools import hash_object, get_file_identity, get_file_hash
+from logger import _logger
+
+# version of the format of the coffea results (pickled in the result and checkpoint files), entering the fingerprints
+RESULT_FORMAT_VERSION = 4
+# options in the global config which do not change the results
+RUNTIME_CFG_KEYS = [
+    'workers', 'run_step', 'skip_coffea', 'incremental', 'stream_tmpl_to_fit', 'coffea_executor', 'coffea_chunksize', 'coffea_retries',
+    'coffea_checkpoint', 'coffea_checkpoint_interval', 'coffea_decompression_workers', 'coffea_fill_threads',
+    'sfbdt_cache', 'sfbdt_nthread',
+]
+# options in the global config only used in the postprocessing and webpage making, not in the coffea jobs
+POSTPROCESS_CFG_KEYS = [
+    'version', 'use_helvetica', 'coastline_params', 'coastline_scan', 'skip_tmpl_writing', 'skip_inclusive_plot_writing', 'logmsv_div_by_binw',
+]
+# options in the global config only used in the fit step
+FIT_CFG_KEYS = [
+    'test_n_fit', 'do_main_fit', 'do_sfbdt_rwgt_fit', 'do_fit_var_rwgt_fit', 'run_central_fit_only', 'set_bounds', 'set_bounds_main_poi',
+    'skip_fit', 'run_impact_for_central_fit', 'run_full_unce_breakdown_for_central_fit', 'show_fitvarrwgt_unce', 'show_fit_number_only',
+    'show_unce_breakdown', 'show_full_unce_breakdown', 'show_sfbdt_variation', 'show_sfbdt_variation_norun',
+    'show_sfbdt_variation_all_flavour', 'unce_list', 'default_wp_name_map',
+]
+
+
 class ProcessingUnit(object):
     r"""A processing unit including
         (1) first runs the standard coffea job;
@@ -14,12 +41,30 @@ class ProcessingUnit(object):
         (3) make custom plots and write to a webpage for easy visualization.
     """
 
+    # options in the global config not used by this step, excluded from the fingerprints
+    fingerprint_exclude_cfg_keys = []
+
     def __init__(self, job_name, fileset=None, processor_cls=None, **kwargs):
         self.job_name = job_name
         self.fileset = fileset
         self.processor_cls = processor_cls
         self.processor_kwargs = kwargs.pop('processor_kwargs', dict())
         self.workers = kwargs.pop('workers', 8)
+        self.treename = kwargs.pop('treename', 'Events')
+        # coffea execution engine and chunking controls
+        self.executor = kwargs.pop('executor', 'futures')
+        self.chunksize = kwargs.pop('chunksize', 100000)
+        self.maxchunks = kwargs.pop('maxchunks', None)
+        self.retries = kwargs.pop('retries', 0)
+        self.checkpoint = kwargs.pop('checkpoint', False)
+        self.checkpoint_interval = kwargs.pop('checkpoint_interval', 300)
+        # inputs entering the step fingerprint besides the fileset: input files identified by path, size, and modification time;
+        # upstream artifacts identified by their content
+        self.input_files = []
+        self.upstream_artifacts = []
+        # processor arguments set in the preprocessing from the input files and upstream artifacts above (e.g. the spline
+        # objects of the coastline): they enter the fingerprints by these inputs, as their pickled form is not stable
+        self.derived_processor_kwargs = []
 
 
     def preprocess(self):
@@ -42,13 +87,157 @@ class ProcessingUnit(object):
         if not hasattr(self, 'processor_instance'):
             self.initalize_processor()
 
-        self.result = processor.run_uproot_job(
-            fileset=self.fileset,
-            treename="Events",
-            processor_instance=self.processor_instance,
-            executor=processor.futures_executor,
-            executor_args={"schema": BaseSchema, "workers": self.workers},
-        )
+        # coffea is only imported when a coffea job runs
+        from coffea import processor
+        from utils.coffea_tools import CheckpointCoffeaProcessor, load_checkpoint, clear_checkpoint
+
+        processor_instance = self.processor_instance
+        if self.checkpoint:
+            # resume from the checkpoint: only the missing chunks will be processed
+            checkpoint_dir = os.path.join(self.outputdir, 'checkpoint')
+            result_done, chunks_done = load_checkpoint(checkpoint_dir, self.get_checkpoint_fingerprint(), processor_instance.accumulator)
+            processor_instance = CheckpointCoffeaProcessor(processor_instance, checkpoint_dir, chunks_done, interval=self.checkpoint_interval)
+
+        executor, executor_args = self.get_coffea_executor()
+        try:
+            self.result = processor.run_uproot_job(
+                fileset=self.fileset,
+                treename=self.treename,
+                processor_instance=processor_instance,
+                executor=executor,
+                executor_args=executor_args,
+                chunksize=self.chunksize,
+                maxchunks=self.maxchunks,
+            )
+        finally:
+            if 'client' in executor_args:
+                # shut down the local dask cluster
+                executor_args['client'].close()
+                executor_args['client'].cluster.close()
+
+        if self.checkpoint:
+            # merge the results from the checkpoint, which are not needed anymore
+            self.result.add(result_done)
+            self.processor_instance.postprocess(self.result)
+            clear_checkpoint(checkpoint_dir)
+
+        self.log_coffea_result()
+
+
+    def log_coffea_result(self, result=None):
+        result = self.result if result is None else result
+        if 'nbytes' in result:
+            _logger.info(f'[{self.job_name}] Read {result["nbytes"].value / 1024**2:.1f} MB from the input files.')
+        if 'expr_cache' in result:
+            _logger.info(f'[{self.job_name}] Expression cache: {result["expr_cache"]["hits"]} hits, {result["expr_cache"]["misses"]} misses.')
+        if 'sfbdt_cache' in result and len(result['sfbdt_cache']) > 0:
+            _logger.info(f'[{self.job_name}] sfBDT prediction cache: {result["sfbdt_cache"]["hits"]} hits, {result["sfbdt_cache"]["misses"]} misses.')
+
+
+    def get_cfg_for_fingerprint(self, exclude_keys=None):
+        r"""The global config entering the fingerprints: runtime options and options not used by this step do not enter."""
+        if 'global_cfg' not in self.processor_kwargs:
+            return None
+        exclude_keys = RUNTIME_CFG_KEYS + self.fingerprint_exclude_cfg_keys + (exclude_keys or [])
+        return {k: v for k, v in vars(self.processor_kwargs['global_cfg']).items() if k not in exclude_keys}
+
+
+    def get_checkpoint_fingerprint(self, fileset=None, exclude_cfg_keys=None):
+        r"""Fingerprint of the coffea job used to validate the checkpoint. The fileset of the unit is used if not given."""
+        processor_kwargs = {k: v for k, v in self.processor_kwargs.items() if k not in self.derived_processor_kwargs}
+        if 'global_cfg' in processor_kwargs:
+            processor_kwargs['global_cfg'] = self.get_cfg_for_fingerprint(exclude_keys=POSTPROCESS_CFG_KEYS + (exclude_cfg_keys or []))
+        derived_from = None
+        if len(self.derived_processor_kwargs):
+            derived_from = {
+                'files': [get_file_identity(path) for path in self.input_files],
+                'artifacts': [get_file_hash(path) for path in self.upstream_artifacts],
+            }
+        return hash_object({
+            'job_name': self.job_name,
+            'result_format': RESULT_FORMAT_VERSION,
+            'fileset': self.fileset if fileset is None else fileset,
+            'chunksize': self.chunksize,
+            'processor_kwargs': {k: hash_object(v) for k, v in processor_kwargs.items()},
+            'derived_from': derived_from,
+        })
+
+
+    def get_coffea_fingerprint(self):
+        r"""Fingerprint of the coffea job and its input files. Only valid after `preprocess`, which may set the processor arguments."""
+        return hash_object({
+            'job': self.get_checkpoint_fingerprint(),
+            'files': [get_file_identity(path) for paths in self.fileset.values() for path in paths],
+        })
+
+
+    def get_step_fingerprint(self):
+        r"""Fingerprint of all inputs of the step: the config, the input files (identified by path, size, and modification time),
+            and the content of the upstream artifacts."""
+        input_files = list(self.input_files)
+        if self.fileset is not None:
+            input_files += [path for paths in self.fileset.values() for path in paths]
+        return hash_object({
+            'job_name': self.job_name,
+            'cfg': hash_object(self.get_cfg_for_fingerprint()),
+            'files': [get_file_identity(path) for path in input_files],
+            'artifacts': [get_file_hash(path) for path in self.upstream_artifacts],
+        })
+
+
+    def load_fingerprint(self):
+        filepath = os.path.join(self.outputdir, 'fingerprint.json')
+        if not os.path.isfile(filepath):
+            return {}
+        with open(filepath) as f:
+            return json.load(f)
+
+
+    def store_fingerprint(self, **fingerprints):
+        r"""Store the fingerprint of each level ('coffea' or 'step'), or remove it if set to None"""
+        content = self.load_fingerprint()
+        content.update(fingerprints)
+        content = {k: v for k, v in content.items() if v is not None}
+        filepath = os.path.join(self.outputdir, 'fingerprint.json')
+        with open(filepath + '.tmp', 'w') as fw:
+            json.dump(content, fw, indent=4)
+        os.replace(filepath + '.tmp', filepath)
+
+
+    def get_coffea_executor(self):
+        r"""Get the coffea executor and its arguments from the chosen execution engine:
+            'iterative': run all chunks in the main process (for debugging);
+            'futures': a process pool with `workers` processes;
+            'threads': a thread pool with `workers` threads;
+            'dask': a local dask cluster with `workers` single-threaded workers (requires dask and distributed, not in
+                the default environment).
+        """
+        from coffea.nanoevents import BaseSchema
+        from coffea import processor
+
+        executor_args = {"schema": BaseSchema}
+        if self.retries > 0:
+            executor_args["retries"] = self.retries
+
+        if self.executor == 'iterative':
+            return processor.iterative_executor, executor_args
+        elif self.executor == 'futures':
+            executor_args.update(workers=self.workers)
+            return processor.futures_executor, executor_args
+        elif self.executor == 'threads':
+            executor_args.update(workers=self.workers, pool=concurrent.futures.ThreadPoolExecutor)
+            return processor.futures_executor, executor_args
+        elif self.executor == 'dask':
+            try:
+                from distributed import Client, LocalCluster
+            except ImportError:
+                raise ImportError("The 'dask' executor requires the dask and distributed packages, which are not in conda_env.yml. "
+                                  "Install them (`pip install dask distributed`) or choose another executor.") from None
+            cluster = LocalCluster(n_workers=self.workers, threads_per_worker=1)
+            executor_args.update(client=Client(cluster))
+            return processor.dask_executor, executor_args
+        else:
+            raise ValueError(f"Unrecognized coffea executor '{self.executor}'. Should be 'iterative', 'futures', 'threads', or 'dask'.")
 
 
     def load_pickle(self, attrname: str):
@@ -67,10 +256,27 @@ class ProcessingUnit(object):
         pass
 
 
-    def launch(self, skip_coffea=False):
-        r"""Launch the processing unit"""
+    def launch(self, skip_coffea=False, incremental=False):
+        r"""Launch the processing unit. In the incremental mode, skip the step if its inputs are unchanged since the last run,
+            or only skip the coffea job if the inputs of the coffea job are unchanged."""
+        self.incremental = incremental
+        if incremental:
+            step_fingerprint = self.get_step_fingerprint()
+            if self.load_fingerprint().get('step') == step_fingerprint:
+                _logger.info(f'[{self.job_name}] Outputs are up to date. Skip this step.')
+                return
+        # invalidate the step fingerprint until the step finishes
+        self.store_fingerprint(step=None)
+
         self.preprocess()
+        coffea_fingerprint = self.get_coffea_fingerprint() if self.processor_cls is not None else None
+        if incremental and not skip_coffea and coffea_fingerprint is not None and self.load_fingerprint().get('coffea') == coffea_fingerprint \
+            and os.path.isfile(os.path.join(self.outputdir, 'result.pickle')):
+            _logger.info(f'[{self.job_name}] The coffea job is up to date. Load the existing results.')
+            skip_coffea = True
+
         if not skip_coffea:
+            self.store_fingerprint(coffea=None)
             self.run_coffea_job()
         else: # skip coffea step
             if self.processor_cls is not None:
@@ -78,18 +284,86 @@ class ProcessingUnit(object):
                 self.load_pickle('result')
 
         self.postprocess()
+        if not skip_coffea:
+            # the coffea result is stored in the postprocessing
+            self.store_fingerprint(coffea=coffea_fingerprint)
         self.make_webpage()
+        self.store_fingerprint(step=self.get_step_fingerprint())
+
+
+class MultiCardUnit(ProcessingUnit):
+    r"""Run the same step for multiple cards sharing the input files: the coffea jobs are run in a single pass over the
+        events, then the postprocessing and webpage making are launched for each card."""
+
+    def __init__(self, units, **kwargs):
+        from utils.coffea_tools import MultiCardCoffeaProcessor
+
+        self.units = units
+        super().__init__(
+            job_name=units[0].job_name,
+            fileset=units[0].fileset,
+            processor_cls=MultiCardCoffeaProcessor,
+            **kwargs,
+        )
+        self.outputdir = os.path.join('output', 'multi_card_' + hash_object(sorted(u.outputdir for u in units))[:10], self.job_name)
+        if not os.path.exists(self.outputdir):
+            os.makedirs(self.outputdir)
+
+
+    def get_checkpoint_fingerprint(self, fileset=None, exclude_cfg_keys=None):
+        return hash_object([u.get_checkpoint_fingerprint(fileset=fileset, exclude_cfg_keys=exclude_cfg_keys) for u in self.units])
+
+
+    def launch(self, skip_coffea=False, incremental=False):
+        units = []
+        for unit in self.units:
+            if incremental and unit.load_fingerprint().get('step') == unit.get_step_fingerprint():
+                _logger.info(f'[{unit.job_name}] Outputs of {unit.outputdir} are up to date. Skip this step.')
+                continue
+            unit.store_fingerprint(step=None)
+            unit.preprocess()
+            unit.initalize_processor()
+            units.append(unit)
+        if len(units) == 0:
+            return
+        self.units = units
+
+        if not skip_coffea:
+            for unit in units:
+                unit.store_fingerprint(coffea=None)
+            self.processor_kwargs = {
+                'processors': {unit.outputdir: unit.processor_instance for unit in units},
+                'decompression_workers': units[0].global_cfg.coffea_decompression_workers,
+            }
+            self.run_coffea_job()
+            for unit in units:
+                unit.result = self.result[unit.outputdir]
+        else:
+            for unit in units:
+                unit.load_pickle('result')
+
+        # postprocessing for each card
+        for unit in units:
+            _logger.info(f'[{unit.job_name}] Postprocess for {unit.outputdir}')
+            unit.postprocess()
+            if not skip_coffea:
+                unit.store_fingerprint(coffea=unit.get_coffea_fingerprint())
+            unit.make_webpage()
+            unit.store_fingerprint(step=unit.get_step_fingerprint())
 
 
 class StandaloneMultiThreadedUnit(object):
     r"""Holds a standalone multi-threaded unit to book and submit multiple processes.
         Can use local resource or batch resources depending on the config. 
+        Tasks booked with a cost key are scheduled longest-first, with the runtime of each cost key learned from previous
+        runs and stored in `runtime_model_path` (if specified).
     """
 
     def __init__(self, **kwargs):
 
         self.workers = kwargs.pop('workers', 8)
         self.use_unordered_mapping = kwargs.pop('use_unordered_mapping', False)
+        self.runtime_model_path = kwargs.pop('runtime_model_path', None)
 
         # book multi tasks handler by multiprocessing.Pool
         def init_worker():
@@ -97,17 +371,151 @@ class StandaloneMultiThreadedUnit(object):
             signal.signal(signal.SIGINT, signal.SIG_IGN)
         self.pool = multiprocessing.Pool(processes=self.workers, initializer=init_worker)
         self.args = []
+        self.cost_keys = []
+        self.priors = []
+
+        # the runtime model: {cost_key: {'runtime': averaged runtime in seconds, 'n': number of measurements}}
+        self.runtime_model = {}
+        if self.runtime_model_path is not None and os.path.isfile(self.runtime_model_path):
+            with open(self.runtime_model_path) as f:
+                self.runtime_model = json.load(f)
     
-    def book(self, arg: tuple):
-        # accept one argument only
+    def book(self, arg: tuple, cost_key=None, prior=1.):
+        r"""Book a task. Accept one argument only. Tasks with the same `cost_key` are expected to have similar runtime;
+            `prior` is the estimated runtime (in seconds) used before the cost key is measured."""
         self.args.append(arg)
+        self.cost_keys.append(cost_key)
+        self.priors.append(prior)
+
+    def predict_cost(self, i):
+        cost_key = self.cost_keys[i]
+        if cost_key is not None and cost_key in self.runtime_model:
+            return self.runtime_model[cost_key]['runtime']
+        return self.priors[i]
 
-    def run(self, func):
+    def run(self, func, callback=None):
+        r"""Run all booked tasks and return the results in the booking order. If specified, `callback` is called on each
+            result as soon as it arrives (in the order of completion if using the unordered mapping)."""
+        if all(cost_key is None for cost_key in self.cost_keys):
+            try:
+                imap = self.pool.imap if not self.use_unordered_mapping else self.pool.imap_unordered
+                result = [None] * len(self.args)
+                timed_func = partial(run_timed_task, func)
+                for i, _, res in tqdm(imap(timed_func, enumerate(self.args)), total=len(self.args)):
+                    result[i] = res
+                    if callback is not None:
+                        callback(res)
+                return result
+            except KeyboardInterrupt:
+                self.pool.terminate()
+                self.pool.join()
+                return None
+
+        # longest processing time first, then restore the booking order of the results
+        costs = [self.predict_cost(i) for i in range(len(self.args))]
+        order = sorted(range(len(self.args)), key=lambda i: -costs[i])
+        predicted_makespan = get_lpt_makespan([costs[i] for i in order], self.workers)
+        start_time = time.time()
         try:
-            imap = self.pool.imap if not self.use_unordered_mapping else self.pool.imap_unordered
-            result = list(tqdm(imap(func, self.args), total=len(self.args)))
-            return result
+            result, runtimes = [None] * len(self.args), [None] * len(self.args)
+            timed_func = partial(run_timed_task, func)
+            for i, runtime, res in tqdm(self.pool.imap_unordered(timed_func, [(i, self.args[i]) for i in order]), total=len(self.args)):
+                result[i], runtimes[i] = res, runtime
+                if callback is not None:
+                    callback(res)
         except KeyboardInterrupt:
             self.pool.terminate()
             self.pool.join()
             return None
+        _logger.info(f'Makespan of {len(self.args)} tasks on {self.workers} workers: predicted {predicted_makespan:.1f}s, actual {time.time() - start_time:.1f}s.')
+
+        self.update_runtime_model(runtimes)
+        return result
+
+    def start(self, func):
+        r"""Start the streaming mode: tasks added by `submit` are dispatched as soon as a worker is free, the one with the
+            longest predicted runtime first. Call `join` to wait for all submitted tasks and collect the results."""
+        self.timed_func = partial(run_timed_task, func)
+        self.queue, self.n_inflight = [], 0
+        self.results, self.runtimes, self.error = {}, {}, None
+        self.cond = threading.Condition()
+        self.start_time = time.time()
+
+    def submit(self, arg: tuple, cost_key=None, prior=1.):
+        with self.cond:
+            i = len(self.args)
+            self.book(arg, cost_key=cost_key, prior=prior)
+            heapq.heappush(self.queue, (-self.predict_cost(i), i))
+            self.dispatch()
+
+    def dispatch(self):
+        # keep at most one task per worker in the pool, so that the queue can still be reordered by later submissions
+        while self.n_inflight < self.workers and len(self.queue):
+            _, i = heapq.heappop(self.queue)
+            self.n_inflight += 1
+            self.pool.apply_async(self.timed_func, ((i, self.args[i]),), callback=self.on_task_done, error_callback=self.on_task_error)
+
+    def on_task_done(self, output):
+        i, runtime, result = output
+        with self.cond:
+            self.results[i], self.runtimes[i] = result, runtime
+            self.n_inflight -= 1
+            self.dispatch()
+            self.cond.notify_all()
+
+    def on_task_error(self, error):
+        with self.cond:
+            self.error = error
+            self.cond.notify_all()
+
+    def join(self):
+        try:
+            with self.cond:
+                while len(self.results) < len(self.args) and self.error is None:
+                    self.cond.wait()
+        except KeyboardInterrupt:
+            self.pool.terminate()
+            self.pool.join()
+            return None
+        if self.error is not None:
+            self.pool.terminate()
+            raise self.error
+        _logger.info(f'Finished {len(self.args)} streamed tasks on {self.workers} workers in {time.time() - self.start_time:.1f}s.')
+
+        self.update_runtime_model([self.runtimes[i] for i in range(len(self.args))])
+        return [self.results[i] for i in range(len(self.args))]
+
+    def update_runtime_model(self, runtimes, alpha=0.5):
+        r"""Update the runtime of each cost key by the exponential moving average of the measured (mean) runtime"""
+        measured = {}
+        for cost_key, runtime in zip(self.cost_keys, runtimes):
+            if cost_key is not None:
+                measured.setdefault(cost_key, []).append(runtime)
+        for cost_key, rts in measured.items():
+            runtime = sum(rts) / len(rts)
+            if cost_key in self.runtime_model:
+                entry = self.runtime_model[cost_key]
+                entry['runtime'] = alpha * runtime + (1 - alpha) * entry['runtime']
+                entry['n'] += len(rts)
+            else:
+                self.runtime_model[cost_key] = {'runtime': runtime, 'n': len(rts)}
+
+        if self.runtime_model_path is not None:
+            with open(self.runtime_model_path + '.tmp', 'w') as fw:
+                json.dump(self.runtime_model, fw, indent=4)
+            os.replace(self.runtime_model_path + '.tmp', self.runtime_model_path)
+
+
+def run_timed_task(func, indexed_arg):
+    i, arg = indexed_arg
+    start_time = time.time()
+    result = func(arg)
+    return i, time.time() - start_time, result
+
+
+def get_lpt_makespan(costs, workers):
+    r"""Simulate the makespan when the tasks are submitted in the given order, each to the first free worker"""
+    loads = [0.] * min(workers, max(len(costs), 1))
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
@@ -81,3 +81,85 @@ def scale_bh(h_in: bh.Histogram, weight) -> bh.Histogram:
         h_out.variances(flow=True)[i] *= (weight[i] ** 2)
 
     return h_out
+
+
+class MemmapHist(object):
+    r"""A light-weight handle of a boost histogram, whose bin contents (flows included) are stored in a memory-mapped file.
+        Only the axes and attributes are pickled when passed to a worker. Indexing the handle as a boost histogram only
+        reads the selected bins from the file, so the workers do not hold a copy of the histogram; `to_bh()` rebuilds the
+        full histogram.
+    """
+
+    def __init__(self, filepath, offset, dtype, shape, axes, storage_type, attrs=None):
+        self.filepath = filepath
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = shape
+        self.axes = axes
+        self.storage_type = storage_type
+        self.attrs = attrs if attrs is not None else {} # e.g. the histogram label
+
+    def view(self):
+        return np.memmap(self.filepath, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+
+    def __getitem__(self, index):
+        r"""Same as indexing the boost histogram, with an integer, a locator (e.g. `bh.loc(...)`, `bh.underflow`), `bh.sum`
+            (over all bins, flows included), or `:` (keep the axis) for each axis. At least one axis should be kept."""
+        index = index if isinstance(index, tuple) else (index,)
+        assert len(index) == len(self.axes), 'An index should be given for each axis.'
+        view_index, axes, sum_axes = [], [], []
+        for axis, idx in zip(self.axes, index):
+            if idx is bh.sum:
+                sum_axes.append(len(axes) + len(sum_axes)) # position of the axis in the selected array
+                view_index.append(slice(None))
+            elif isinstance(idx, slice):
+                assert idx == slice(None), 'Only the full slice is supported.'
+                axes.append(axis)
+                view_index.append(slice(None))
+            else:
+                i = idx(axis) if callable(idx) else idx
+                view_index.append(i + (1 if axis.traits.underflow else 0))
+        assert len(axes) > 0, 'At least one axis should be kept.'
+
+        # only the selected bins are read from the file
+        view = self.view()[tuple(view_index)]
+        h = bh.Histogram(*axes, storage=self.storage_type())
+        h.__dict__.update(self.attrs)
+        h_view = h.view(flow=True)
+        if view.dtype.names is None:
+            h_view[...] = view.sum(axis=tuple(sum_axes))
+        else:
+            for name in view.dtype.names:
+                h_view[name] = view[name].sum(axis=tuple(sum_axes))
+        return h
+
+    def to_bh(self) -> bh.Histogram:
+        h = bh.Histogram(*self.axes, storage=self.storage_type())
+        h.__dict__.update(self.attrs)
+        h_view, view = h.view(flow=True), self.view()
+        if view.dtype.names is None:
+            h_view[...] = view
+        else:
+            for name in view.dtype.names:
+                h_view[name] = view[name]
+        return h
+
+
+def bh_to_memmap(histograms, filepath, align=64):
+    r"""Write the bin contents of the boost histograms into one memory-mapped file, given an iterable of (key, histogram).
+        Return the dict of `MemmapHist` handles. Histograms are written one by one so that they can be created on the fly.
+    """
+
+    handles = {}
+    offset = 0
+    with open(filepath, 'wb') as fw:
+        for key, h in histograms:
+            arr = np.ascontiguousarray(h.view(flow=True)).view(np.ndarray)
+            fw.write(arr.tobytes())
+            handles[key] = MemmapHist(filepath, offset, arr.dtype, arr.shape, tuple(h.axes), h.storage_type, dict(h.__dict__))
+            # align the start of the next histogram
+            padding = -arr.nbytes % align
+            fw.write(b'\0' * padding)
+            offset += arr.nbytes + padding
+
+    return handles
@@ -0,0 +1,70 @@
+"""
+The lookup grid of the sfBDT coastline bins (built in step 3 from the coastline derived in step 2), replacing the spline
+evaluation for each jet by a table lookup, except in the cells crossed by a contour.
+
+"""
+
+import numpy as np
+
+
+class CoastlineIndexGrid:
+    r"""Lookup grid of the coastline bin index on (xtagger, sfBDT) in [0, 1]^2, i.e. the bin of the smeared cumulative
+        distribution (`fspline`) in the contour `levels`: -1 for the underflow, and len(levels) - 1 for the overflow.
+
+    Each cell stores the bin index if the spline values at its four corners fall into the same bin. The cells crossed by
+    a contour are marked as boundary cells, where the spline is evaluated directly, as for the points outside [0, 1]^2.
+    `boundary_fraction` is the fraction of boundary cells, and `agreement` the fraction of uniform random points where
+    the lookup agrees with the binning of the spline values.
+
+    Arguments:
+        fspline: the spline of the smeared cumulative distribution
+        levels: the contour levels
+        size: number of cells per axis
+        ntest: number of random points to measure the agreement
+    """
+
+    BOUNDARY = -2
+
+    def __init__(self, fspline, levels, size=1000, ntest=1000000):
+        self.fspline, self.levels, self.size = fspline, np.asarray(levels), size
+        # the value filled into the coastline axis (with edges at the levels) for each bin index, NaN for a NaN spline value
+        self.bin_values = np.concatenate([[self.levels[0] - 1.], (self.levels[:-1] + self.levels[1:]) / 2, [self.levels[-1] + 1., np.nan]])
+
+        nodes = np.linspace(0., 1., size + 1)
+        X, Y = np.meshgrid(nodes, nodes, indexing='ij')
+        node_index = self.get_bin_index(fspline(X, Y))
+        corners = np.stack([node_index[:-1, :-1], node_index[1:, :-1], node_index[:-1, 1:], node_index[1:, 1:]])
+        self.grid = np.where(corners.min(axis=0) == corners.max(axis=0), corners[0], self.BOUNDARY).astype(np.int8)
+        self.boundary_fraction = float(np.mean(self.grid == self.BOUNDARY))
+
+        x, y = np.random.default_rng(42).uniform(size=(2, ntest))
+        self.agreement = float(np.mean(self.lookup(x, y) == self.get_bin_index(fspline(x, y))))
+
+
+    def get_bin_index(self, values):
+        r"""The coastline bin index of the spline values, len(levels) for NaN"""
+        return np.where(np.isnan(values), len(self.levels), np.searchsorted(self.levels, values, side='right') - 1)
+
+
+    def lookup(self, xtagger, sfbdt):
+        r"""The coastline bin index of the points"""
+        xtagger, sfbdt = np.asarray(xtagger, dtype=np.float64), np.asarray(sfbdt, dtype=np.float64)
+        inside = (xtagger >= 0.) & (xtagger <= 1.) & (sfbdt >= 0.) & (sfbdt <= 1.)
+        ix = np.minimum(np.where(inside, xtagger, 0.) * self.size, self.size - 1).astype(np.int64)
+        iy = np.minimum(np.where(inside, sfbdt, 0.) * self.size, self.size - 1).astype(np.int64)
+        index = np.where(inside, self.grid[ix, iy], self.BOUNDARY).astype(np.int64)
+        boundary = index == self.BOUNDARY
+        if np.any(boundary):
+            index[boundary] = self.get_bin_index(self.fspline(xtagger[boundary], sfbdt[boundary]))
+        return index
+
+
+    def __call__(self, xtagger, sfbdt):
+        r"""The values to fill into the coastline axis, in the same bins as the spline values"""
+        return self.bin_values[self.lookup(xtagger, sfbdt) + 1]
+
+
+def concurrent_coastline_grid_unit(arg):
+    r"""Unit concurrent task to build the coastline index grid of one pT bin"""
+    fspline, levels = arg
+    return CoastlineIndexGrid(fspline, levels)
@@ -0,0 +1,347 @@
+from coffea import processor
+import boost_histogram as bh
+import numpy as np
+import hist
+
+import threading
+import pickle
+import shutil
+import glob
+import time
+import uuid
+import os
+
+from utils.tools import cached_columns
+from logger import _logger
+
+
+# minimum number of entries filled by each thread in the threaded histogram filling
+FILL_ENTRIES_PER_THREAD = 50000
+
+
+class HistAccumulator(hist.Hist):
+    r"""A `hist.Hist` with the coffea accumulator semantics, booked directly in the coffea processors. It follows the
+        conventions of `coffea.hist.Hist`: the category axes (e.g. the dataset) are growing string categories, and the
+        entries with a NaN value on a numeric axis are not filled. Large arrays are filled with the threaded filling of
+        boost-histogram, unless the category values are given as arrays.
+    """
+
+    def identity(self):
+        h = self.copy()
+        h.reset()
+        return h
+
+
+    def add(self, other):
+        self += other
+
+
+    def fill(self, threads=1, weight=None, **kwargs):
+        values = {k: v if isinstance(v, str) else np.asarray(v) for k, v in kwargs.items()}
+        weight = np.asarray(weight) if weight is not None else None
+        nentries = max((v.size for v in values.values() if not isinstance(v, str)), default=1)
+        # drop the entries with a NaN value, which coffea stores in its nanflow bin
+        mask = np.ones(nentries, dtype=bool)
+        for v in values.values():
+            if not isinstance(v, str) and v.dtype.kind == 'f':
+                mask &= ~np.isnan(v)
+        if not mask.all():
+            values = {k: v if isinstance(v, str) or v.ndim == 0 else v[mask] for k, v in values.items()}
+            if weight is not None and weight.ndim > 0:
+                weight = weight[mask]
+            nentries = int(mask.sum())
+        threads = min(threads, nentries // FILL_ENTRIES_PER_THREAD)
+        if any(not isinstance(values[ax.name], str) for ax in self.axes if isinstance(ax, bh.axis.StrCategory) and ax.name in values):
+            # the clones filled by the threads would grow the category axes in an arbitrary order
+            threads = 1
+        if threads > 1:
+            # the threaded filling splits the inputs between the threads, each filling a clone of the histogram: the scalar
+            # values (e.g. the dataset on the growing category axis) are broadcast to the entries, not split
+            values = {k: np.full(nentries, v) if isinstance(v, str) or v.ndim == 0 else v for k, v in values.items()}
+            if weight is not None and weight.ndim == 0:
+                weight = np.full(nentries, weight)
+        return super().fill(weight=weight, threads=threads if threads > 1 else None, **values)
+
+
+    def __iadd__(self, other):
+        if not isinstance(other, bh.Histogram) or all(
+            list(ax) == list(ax_other) for ax, ax_other in zip(self.axes, other.axes) if isinstance(ax, bh.axis.StrCategory)
+            ):
+            return super().__iadd__(other)
+
+        # the category axes grow independently in each chunk. Grow the missing categories with empty entries first, then
+        # add the bin contents by matching the categories
+        if any(len(ax) == 0 for ax in other.axes if isinstance(ax, bh.axis.StrCategory)):
+            return self
+        new_categories = {
+            ax.name: [c for c in ax_other if c not in list(ax)] for ax, ax_other in zip(self.axes, other.axes) if isinstance(ax, bh.axis.StrCategory)
+        }
+        nfill = max(len(cats) for cats in new_categories.values())
+        if nfill > 0:
+            super().fill(
+                weight=0., **{
+                    ax.name: (new_categories[ax.name] + [ax_other[0]] * nfill)[:nfill] if isinstance(ax, bh.axis.StrCategory) else ax.centers[0]
+                    for ax, ax_other in zip(self.axes, other.axes)
+                }
+            )
+        index = np.ix_(*[
+            [list(ax).index(c) for c in ax_other] if isinstance(ax, bh.axis.StrCategory) else np.arange(n)
+            for ax, ax_other, n in zip(self.axes, other.axes, other.view(flow=True).shape)
+        ])
+        view, view_other = self.view(flow=True), other.view(flow=True)
+        if view.dtype.names is None:
+            view[index] += view_other
+        else:
+            for name in view.dtype.names:
+                view[name][index] += view_other[name]
+        return self
+
+
+    def sort_categories(self):
+        r"""Return a copy with the bins of the category axes sorted by name, as in `coffea.hist.Hist`"""
+        h = type(self)(
+            *[hist.axis.StrCategory(sorted(ax), name=ax.name, label=ax.label, growth=True) if isinstance(ax, bh.axis.StrCategory) else ax for ax in self.axes],
+            storage=self.storage_type(), label=self.label,
+        )
+        h += self
+        return h
+
+
+class SparseHistAccumulator(processor.AccumulatorABC):
+    r"""A sparse weighted histogram with one string category axis and numeric axes, for fine grids of which only a small
+        fraction of the bins is filled in each chunk. Only the filled bins are stored for each category, as their sorted
+        flat indices (flow bins included) with the sums of weights and of squared weights. The bins are given by the
+        numeric axes, and the entries with a NaN value are not filled, as in `HistAccumulator`. Use `to_hist` to get the
+        dense `HistAccumulator`.
+
+    Arguments:
+        category: the string category axis (e.g. the dataset)
+        axes: the numeric axes
+        label: the label of the dense histogram
+    """
+
+    def __init__(self, category, *axes, label='Counts'):
+        self.category = category
+        self.axes = axes
+        self.label = label
+        self.entries = {} # category -> (flat indices, sums of weights, sums of squared weights)
+
+
+    def identity(self):
+        return SparseHistAccumulator(self.category, *self.axes, label=self.label)
+
+
+    def add(self, other):
+        for cat, entry in other.entries.items():
+            self._merge(cat, *entry)
+
+
+    def _merge(self, cat, index, sumw, sumw2):
+        if cat in self.entries:
+            index, sumw, sumw2 = [np.concatenate([a, b]) for a, b in zip(self.entries[cat], (index, sumw, sumw2))]
+        # sum the bins in order, so that the sums are the same as filling the dense histogram
+        index, inverse = np.unique(index, return_inverse=True)
+        self.entries[cat] = (index, np.bincount(inverse, weights=sumw, minlength=len(index)), np.bincount(inverse, weights=sumw2, minlength=len(index)))
+
+
+    def fill(self, threads=1, weight=None, **kwargs):
+        values = [np.asarray(kwargs[ax.name]) for ax in self.axes]
+        nentries = max(v.size for v in values)
+        weight = np.broadcast_to(np.asarray(weight if weight is not None else 1., dtype=np.float64), (nentries,))
+        # drop the entries with a NaN value, which coffea stores in its nanflow bin
+        mask = np.ones(nentries, dtype=bool)
+        for v in values:
+            if v.dtype.kind == 'f':
+                mask &= ~np.isnan(v)
+        values, weight = [v[mask] for v in values], weight[mask]
+        # flat bin indices, with the underflow bin at 0 on each axis
+        index = np.ravel_multi_index(
+            [np.asarray(ax.index(v)) + (1 if ax.traits.underflow else 0) for ax, v in zip(self.axes, values)],
+            [ax.extent for ax in self.axes],
+        )
+        self._merge(kwargs[self.category.name], index, weight, weight ** 2)
+
+
+    def to_hist(self):
+        r"""The dense `HistAccumulator`, with the categories sorted by name"""
+        h = HistAccumulator(
+            hist.axis.StrCategory(sorted(self.entries), name=self.category.name, label=self.category.label, growth=True),
+            *self.axes, storage=hist.storage.Weight(), label=self.label,
+        )
+        view = h.view(flow=True)
+        for i, cat in enumerate(sorted(self.entries)):
+            index, sumw, sumw2 = self.entries[cat]
+            view.value[i].flat[index] = sumw
+            view.variance[i].flat[index] = sumw2
+        return h
+
+
+def sort_categories(accumulator):
+    r"""Sort the category bins of all `HistAccumulator` in the (nested) accumulator in place"""
+    for key, value in accumulator.items():
+        if isinstance(value, HistAccumulator):
+            accumulator[key] = value.sort_categories()
+        elif isinstance(value, processor.dict_accumulator):
+            sort_categories(value)
+
+
+class MultiCardCoffeaProcessor(processor.ProcessorABC):
+    r"""Run the coffea processors of multiple cards in a single pass over the events. The union of their columns is read
+        once per chunk and shared by all processors."""
+
+    def __init__(self, processors=None, decompression_workers=1):
+        self.processors = processors
+        self.decompression_workers = decompression_workers
+        self.columns = sorted({c for p in processors.values() for c in p.columns})
+        self._accumulator = processor.dict_accumulator({
+            name: p.accumulator for name, p in processors.items()
+        })
+        self._accumulator['nbytes'] = processor.value_accumulator(int)
+
+    @property
+    def accumulator(self):
+        return self._accumulator
+
+
+    def process(self, events):
+        out = self.accumulator.identity()
+        with cached_columns(events, self.columns, self.decompression_workers) as nbytes:
+            for name, p in self.processors.items():
+                out[name] = p.process(events)
+        out['nbytes'].add(nbytes)
+        return out
+
+
+    def postprocess(self, accumulator):
+        for name, p in self.processors.items():
+            p.postprocess(accumulator[name])
+        return accumulator
+
+
+def get_file_key(path):
+    r"""The normalised path identifying an input file in the per-file results: local paths are made absolute, remote URLs are kept"""
+    if '://' in path:
+        return path
+    return os.path.normpath(os.path.abspath(path))
+
+
+class PerFileCoffeaProcessor(processor.ProcessorABC):
+    r"""A wrapper of the coffea processor which keeps the results of each input file separately, keyed by the normalised
+        file path (see `get_file_key`)"""
+
+    def __init__(self, processor_instance):
+        self.processor_instance = processor_instance
+        self._accumulator = processor.dict_accumulator({})
+
+    @property
+    def accumulator(self):
+        return self._accumulator
+
+
+    def process(self, events):
+        return processor.dict_accumulator({get_file_key(events.metadata['filename']): self.processor_instance.process(events)})
+
+
+    def postprocess(self, accumulator):
+        for out in accumulator.values():
+            self.processor_instance.postprocess(out)
+        return accumulator
+
+
+# buffers of the partially merged results in each worker, keyed by the checkpoint directory
+_checkpoint_buffers = {}
+_checkpoint_lock = threading.Lock()
+
+
+class CheckpointCoffeaProcessor(processor.ProcessorABC):
+    r"""A wrapper of the coffea processor which periodically stores the partially merged results of each worker on disk,
+        keyed by the processed chunks (file and entry range). Chunks already stored in the checkpoint are skipped.
+    """
+
+    def __init__(self, processor_instance, checkpoint_dir, chunks_done=None, interval=300):
+        self.processor_instance = processor_instance
+        self.checkpoint_dir = checkpoint_dir
+        self.chunks_done = chunks_done if chunks_done is not None else set()
+        self.interval = interval
+
+    @property
+    def accumulator(self):
+        return self.processor_instance.accumulator
+
+
+    def process(self, events):
+        chunk = get_chunk_key(events.metadata)
+        if chunk in self.chunks_done:
+            return self.accumulator.identity()
+
+        out = self.processor_instance.process(events)
+
+        with _checkpoint_lock:
+            buffer = _checkpoint_buffers.setdefault(self.checkpoint_dir, {'result': None, 'chunks': set(), 'time': time.time()})
+            if buffer['result'] is None:
+                buffer['result'] = self.accumulator.identity()
+            buffer['result'].add(out)
+            buffer['chunks'].add(chunk)
+            if time.time() - buffer['time'] > self.interval:
+                # store the buffer to a new checkpoint file (atomically) and reset it
+                filepath = os.path.join(self.checkpoint_dir, f'part_{os.getpid()}_{uuid.uuid4().hex}.pickle')
+                with open(filepath + '.tmp', 'wb') as fw:
+                    pickle.dump({'result': buffer['result'], 'chunks': buffer['chunks']}, fw)
+                os.replace(filepath + '.tmp', filepath)
+                _checkpoint_buffers[self.checkpoint_dir] = {'result': None, 'chunks': set(), 'time': time.time()}
+
+        return out
+
+
+    def postprocess(self, accumulator):
+        return self.processor_instance.postprocess(accumulator)
+
+
+def get_chunk_key(metadata):
+    r"""Identify a chunk by the file, tree, and entry range"""
+    return (metadata['filename'], metadata['treename'], metadata['entrystart'], metadata['entrystop'])
+
+
+def load_checkpoint(checkpoint_dir, fingerprint, accumulator):
+    r"""Merge all stored checkpoint files into one. Return the merged result and the set of processed chunks.
+        The checkpoint is discarded if it is written by a job with a different fingerprint.
+    """
+    result, chunks = accumulator.identity(), set()
+    fingerprint_path = os.path.join(checkpoint_dir, 'fingerprint')
+    if os.path.isfile(fingerprint_path) and open(fingerprint_path).read() != fingerprint:
+        _logger.warning(f'Discard the checkpoint in {checkpoint_dir} written by a different job configuration.')
+        shutil.rmtree(checkpoint_dir)
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+        with open(fingerprint_path, 'w') as fw:
+            fw.write(fingerprint)
+        return result, chunks
+
+    contents = {}
+    for filepath in sorted(glob.glob(os.path.join(checkpoint_dir, '*.pickle'))):
+        with open(filepath, 'rb') as f:
+            contents[os.path.basename(filepath)] = pickle.load(f)
+    # a merged file lists the files it consumed: these may be left over if the job stopped before removing them
+    consumed = set().union(*[content.get('merged', ()) for content in contents.values()])
+    filenames = [filename for filename in contents if filename not in consumed]
+    for filename in filenames:
+        result.add(contents[filename]['result'])
+        chunks.update(contents[filename]['chunks'])
+    if len(filenames) > 1:
+        # consolidate into one file before removing the others
+        merged_path = os.path.join(checkpoint_dir, f'merged_{uuid.uuid4().hex}.pickle')
+        with open(merged_path + '.tmp', 'wb') as fw:
+            pickle.dump({'result': result, 'chunks': chunks, 'merged': filenames}, fw)
+        os.replace(merged_path + '.tmp', merged_path)
+        consumed.update(filenames)
+    for filename in consumed & set(contents):
+        os.remove(os.path.join(checkpoint_dir, filename))
+    if len(chunks):
+        _logger.info(f'Resume from the checkpoint in {checkpoint_dir}: {len(chunks)} chunks already processed.')
+    return result, chunks
+
+
+def clear_checkpoint(checkpoint_dir):
+    _checkpoint_buffers.pop(checkpoint_dir, None)
+    if os.path.exists(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
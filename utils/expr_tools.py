@@ -0,0 +1,177 @@
+"""
+Per-chunk expression engine used in the coffea processors, replacing the repeated `ak.numexpr.evaluate` calls.
+Each expression string is parsed once per process. Within a chunk, the values of all subexpressions are cached, so that
+common subexpressions are shared across jets and variations (e.g. the HLT OR preselection, or the `genWeight*xsecWeight`
+factors of the nominal and varied weights). The type promotion follows numexpr, so that the results are identical.
+
+"""
+
+import awkward as ak
+import numpy as np
+import operator
+import ast
+
+# numexpr kinds and the corresponding dtypes
+BOOL, INT, LONG, FLOAT, DOUBLE = range(5)
+KIND_DTYPES = [np.dtype(np.bool_), np.dtype(np.int32), np.dtype(np.int64), np.dtype(np.float32), np.dtype(np.float64)]
+
+ARITH_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.Pow: operator.pow, ast.Mod: operator.mod, ast.FloorDiv: operator.floordiv,
+}
+LOGICAL_OPS = {ast.BitAnd: operator.and_, ast.BitOr: operator.or_, ast.BitXor: operator.xor}
+COMPARE_OPS = {
+    ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Lt: operator.lt, ast.LtE: operator.le, ast.Eq: operator.eq, ast.NotEq: operator.ne,
+}
+# symbols of the operators in the keys of the subexpressions folded from a BoolOp or a chained comparison (parenthesized
+# to keep the grouping)
+BOOL_SYMBOLS = {ast.And: '&', ast.Or: '|'}
+COMPARE_SYMBOLS = {ast.Gt: '>', ast.GtE: '>=', ast.Lt: '<', ast.LtE: '<=', ast.Eq: '==', ast.NotEq: '!='}
+FUNCTIONS = {
+    'where': np.where, 'abs': np.abs, 'sqrt': np.sqrt, 'exp': np.exp, 'expm1': np.expm1, 'log': np.log, 'log10': np.log10,
+    'log1p': np.log1p, 'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'arcsin': np.arcsin, 'arccos': np.arccos, 'arctan': np.arctan,
+    'arctan2': np.arctan2, 'sinh': np.sinh, 'cosh': np.cosh, 'tanh': np.tanh, 'minimum': np.minimum, 'maximum': np.maximum,
+}
+MODULES = ['np', 'numpy', 'math']
+
+
+def get_kind(value):
+    r"""The numexpr kind of an array or a constant"""
+    if isinstance(value, (bool, np.bool_)):
+        return BOOL
+    if isinstance(value, int):
+        return INT if -2**31 <= value < 2**31 else LONG
+    if isinstance(value, float):
+        return DOUBLE
+    dtype = value.dtype
+    if dtype.kind == 'b':
+        return BOOL
+    if dtype.kind in 'iu':
+        return INT if dtype.itemsize < 4 or (dtype.itemsize == 4 and dtype.kind == 'i') else LONG
+    return FLOAT if dtype == np.float32 else DOUBLE
+
+
+def cast(value, kind):
+    if isinstance(value, np.ndarray):
+        return value.astype(KIND_DTYPES[kind], copy=False)
+    return KIND_DTYPES[kind].type(value)
+
+
+_compiled_exprs = {}
+
+def compile_expr(expr):
+    r"""Parse the expression into a tree of (key, op, args...) tuples, where the key identifies the subexpression.
+        The parsed expressions are kept for the lifetime of the process."""
+    if expr not in _compiled_exprs:
+        _compiled_exprs[expr] = _compile_node(ast.parse(expr.strip(), mode='eval').body, expr)
+    return _compiled_exprs[expr]
+
+
+def _compile_node(node, expr):
+    key = ast.dump(node)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (bool, int, float)):
+        return (key, 'const', node.value)
+    if isinstance(node, ast.Name):
+        if node.id in ('True', 'False'):
+            return (key, 'const', node.id == 'True')
+        return (key, 'name', node.id)
+    if isinstance(node, ast.BinOp) and type(node.op) in ARITH_OPS:
+        return (key, 'arith', ARITH_OPS[type(node.op)], _compile_node(node.left, expr), _compile_node(node.right, expr))
+    if isinstance(node, ast.BinOp) and type(node.op) in LOGICAL_OPS:
+        return (key, 'logical', LOGICAL_OPS[type(node.op)], _compile_node(node.left, expr), _compile_node(node.right, expr))
+    if isinstance(node, ast.BoolOp):
+        op = operator.and_ if isinstance(node.op, ast.And) else operator.or_
+        args = [_compile_node(v, expr) for v in node.values]
+        tree = args[0]
+        for arg in args[1:]:
+            tree = (f'({tree[0]}{BOOL_SYMBOLS[type(node.op)]}{arg[0]})', 'logical', op, tree, arg)
+        return tree
+    if isinstance(node, ast.UnaryOp):
+        if isinstance(node.op, (ast.Invert, ast.Not)):
+            return (key, 'invert', _compile_node(node.operand, expr))
+        if isinstance(node.op, ast.USub):
+            return (key, 'neg', _compile_node(node.operand, expr))
+        if isinstance(node.op, ast.UAdd):
+            return _compile_node(node.operand, expr)
+    if isinstance(node, ast.Compare):
+        # a chain of comparisons is the AND of each comparison
+        left, tree = _compile_node(node.left, expr), None
+        for op, comparator in zip(node.ops, node.comparators):
+            right = _compile_node(comparator, expr)
+            cmp = (key if len(node.ops) == 1 else f'({left[0]}{COMPARE_SYMBOLS[type(op)]}{right[0]})', 'compare', COMPARE_OPS[type(op)], left, right)
+            tree = cmp if tree is None else (f'({tree[0]}&{cmp[0]})', 'logical', operator.and_, tree, cmp)
+            left = right
+        return tree
+    if isinstance(node, ast.Call):
+        func = node.func
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id in MODULES:
+            func = ast.Name(id=func.attr)
+        if isinstance(func, ast.Name) and func.id in FUNCTIONS and not node.keywords:
+            return (key, 'call', func.id, *[_compile_node(arg, expr) for arg in node.args])
+    raise ValueError(f"Unsupported syntax '{ast.dump(node)}' in the expression: {expr}")
+
+
+class ExprEvaluator:
+    r"""Evaluate expressions on the events of one chunk. All subexpressions are evaluated on the full chunk and cached for
+        the lifetime of the evaluator (i.e. the chunk), then the results are selected by the given event mask.
+        `hits` and `misses` count the cache lookups of all subexpressions.
+
+    Arguments:
+        events: the events of the chunk (with flat columns)
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def evaluate(self, expr, mask=None):
+        r"""Evaluate the expression, and select the events by `mask` if given. Return an awkward array."""
+        with np.errstate(all='ignore'): # as numexpr, do not warn on invalid values
+            value = self._eval(compile_expr(expr))
+        if not isinstance(value, np.ndarray):
+            value = np.full(len(self.events), value)
+        return ak.from_numpy(value[mask] if mask is not None else value)
+
+
+    def _eval(self, node):
+        key, op = node[0], node[1]
+        if op == 'const':
+            return node[2]
+        if key in self.cache:
+            self.hits += 1
+            return self.cache[key]
+        self.misses += 1
+
+        if op == 'name':
+            value = ak.to_numpy(self.events[node[2]])
+        elif op in ('arith', 'compare'):
+            func, left, right = node[2], self._eval(node[3]), self._eval(node[4])
+            kind = max(get_kind(left), get_kind(right))
+            if op == 'arith':
+                # arithmetics on booleans are done in integers, and the true division of integers in doubles
+                kind = max(kind, INT) if func is not operator.truediv else (DOUBLE if kind <= LONG else kind)
+            value = func(cast(left, kind), cast(right, kind))
+        elif op == 'logical':
+            value = node[2](self._eval(node[3]), self._eval(node[4]))
+        elif op == 'invert':
+            value = np.invert(self._eval(node[2]))
+        elif op == 'neg':
+            operand = self._eval(node[2])
+            value = -cast(operand, max(get_kind(operand), INT))
+        elif op == 'call':
+            args = [self._eval(arg) for arg in node[3:]]
+            if node[2] == 'where':
+                kind = max(get_kind(args[1]), get_kind(args[2]))
+                value = np.where(args[0], cast(args[1], kind), cast(args[2], kind))
+            else:
+                # the math functions of integers are evaluated in doubles. Note: numexpr has its own implementation of the
+                # float32 functions, which may differ from numpy in the last digit
+                kind = max(get_kind(arg) for arg in args)
+                kind = DOUBLE if kind <= LONG else kind
+                value = FUNCTIONS[node[2]](*[cast(arg, kind) for arg in args])
+
+        self.cache[key] = value
+        return value
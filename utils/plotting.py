@@ -3,7 +3,6 @@ import uproot
 
 import matplotlib.pyplot as plt
 import matplotlib as mpl
-import seaborn as sns
 from cycler import cycler 
 mpl.use('Agg')
 mpl.rcParams['axes.prop_cycle'] = cycler(color=['blue', 'red', 'green', 'violet', 'darkorange', 'black', 'cyan', 'yellow'])
@@ -15,6 +14,7 @@ import os
 from logger import _logger
 
 def set_sns_color(*args):
+    import seaborn as sns
     sns.palplot(sns.color_palette(*args))
     sns.set_palette(*args)
 
@@ -240,6 +240,7 @@ def make_generic_mc_data_plots(
     plot_subtext = kwargs.get('plot_subtext', None)
 
     def set_sns_color(*args):
+        import seaborn as sns
         sns.palplot(sns.color_palette(*args))
         sns.set_palette(*args)
 
@@ -0,0 +1,206 @@
+"""
+Dry-run estimator of the resources of a routine. The numbers are derived from the card and the metadata of the input files,
+without processing any events: the histograms and columns are taken from the coffea processors instantiated on the card.
+
+"""
+
+import boost_histogram as bh
+import numpy as np
+import uproot
+import json
+import copy
+import math
+import os
+
+from logger import _logger
+
+# rough per-core throughput of the coffea jobs (events/s), and CPU time of the postprocessing tasks (s)
+EVENT_RATE = {'0': 50000, '1': 200000, '2': 50000, '3': 20000}
+TMPL_WRITING_TIME = 45. # per (WP, pT) template writing task
+INCL_PLOT_TIME = 2. # per inclusive plot
+# the fit priors match the ones in FitUnit.book_fit, used if no runtime model is learned from previous runs
+FIT_TIME_PRIOR = {'central': 600., 'other': 30.}
+
+# disk usage of the outputs (bytes)
+TMPL_BYTES_PER_HIST = 1500 # one TH1 in the template ROOT files
+FIT_BYTES = {'central': 10 * 1024**2, 'other': 1024**2} # fit workdir with the fitDiagnostics file and plots
+PLOT_BYTES = 150 * 1024 # one plot stored as png and pdf
+
+# size of the category axes of the booked histograms, besides the 'dataset' axis
+CATEGORY_AXIS_SIZE = {'jetidx': 2}
+
+
+def get_num_entries(global_cfg, fileset, treename='Events'):
+    r"""Number of entries to read in each file, accounting for `coffea_maxchunks`. As in coffea, the chunks of a dataset
+        are taken from its files in order until `coffea_maxchunks` chunks are reached (an empty file counts as one chunk)"""
+    entries = {}
+    for dataset, paths in fileset.items():
+        nchunks_left = global_cfg.coffea_maxchunks
+        for path in paths:
+            with uproot.open(path) as f:
+                n = f[treename].num_entries
+            if nchunks_left is not None:
+                # coffea splits the file into equal chunks close to the chunk size
+                nchunks = max(round(n / global_cfg.coffea_chunksize), 1)
+                n = min(n, min(nchunks, nchunks_left) * math.ceil(n / nchunks))
+                nchunks_left -= min(nchunks, nchunks_left)
+            entries[path] = n
+    return entries
+
+
+def get_read_bytes(fileset, columns, entries, treename='Events'):
+    r"""Compressed bytes of the columns to read from the input files, scaled by the fraction of entries read"""
+    nbytes = 0
+    for paths in fileset.values():
+        for path in paths:
+            with uproot.open(path) as f:
+                tree = f[treename]
+                if tree.num_entries == 0:
+                    continue
+                nbytes += sum(tree[c].compressed_bytes for c in columns if c in tree) * entries[path] / tree.num_entries
+    return nbytes
+
+
+def get_accumulator_bytes(accumulator, ndatasets):
+    r"""Memory of the booked histograms (sum of weights and variances in float64), with all datasets filled. The sparse
+        histograms are counted with all bins filled (with the flat indices in int64), as an upper bound"""
+    from utils.coffea_tools import SparseHistAccumulator
+
+    nbytes = 0
+    for h in accumulator.values():
+        if isinstance(h, SparseHistAccumulator):
+            nbytes += ndatasets * int(np.prod([ax.extent for ax in h.axes])) * 8 * 3
+            continue
+        if not isinstance(h, bh.Histogram):
+            continue
+        nbins = np.prod([
+            (ndatasets if ax.name == 'dataset' else CATEGORY_AXIS_SIZE.get(ax.name, 1)) if isinstance(ax, bh.axis.StrCategory) else ax.extent
+            for ax in h.axes
+        ])
+        nbytes += int(nbins) * 8 * 2
+    return nbytes
+
+
+def get_fit_time(global_cfg, cost_key):
+    r"""Expected runtime of one fit from the runtime model learned in previous runs, or the prior"""
+    runtime_model_path = os.path.join('output', global_cfg.routine_name + '_' + str(global_cfg.year), '4_fit', 'runtime_model.json')
+    if os.path.isfile(runtime_model_path):
+        with open(runtime_model_path) as f:
+            runtime_model = json.load(f)
+        if cost_key in runtime_model:
+            return runtime_model[cost_key]['runtime']
+    return FIT_TIME_PRIOR['central' if '_central' in cost_key else 'other']
+
+
+def estimate_coffea_step(global_cfg, step, processor_instance, fileset, entries, workers):
+    ndatasets = len(fileset)
+    nevents = sum(entries.values())
+    accumulator_bytes = get_accumulator_bytes(processor_instance.accumulator, ndatasets)
+    # each worker holds its own accumulator and the columns of one chunk; the results are merged in the main process
+    chunk_bytes = global_cfg.coffea_chunksize * len(processor_instance.columns) * 8 * 2
+    return {
+        'events': nevents,
+        'read_bytes': get_read_bytes(fileset, processor_instance.columns, entries),
+        'memory_bytes': accumulator_bytes * (workers + 1) + chunk_bytes * workers,
+        'disk_bytes': accumulator_bytes, # the pickled coffea result
+        'cpu_hours': nevents / EVENT_RATE[step] / 3600,
+    }
+
+
+def estimate_resources(global_cfg, fileset):
+    r"""Estimate the events to read, the memory, the disk usage, and the CPU time of each step of a routine.
+        The estimates of the steps 1-3 are given for reading the full ntuples, which is an upper bound if the jet-level
+        skim is used."""
+    from skim_unit import SkimCoffeaProcessor
+    from mc_reweight_unit import MCReweightCoffeaProcessor
+    from coastline_unit import CoastlineCoffeaProcessor, get_coastline_params
+    from tmpl_writer_unit import TmplWriterCoffeaProcessor
+
+    run_step = str(global_cfg.run_step)
+    workers = global_cfg.workers
+    cfg = copy.copy(global_cfg)
+    cfg.use_jet_skim = False
+    entries = get_num_entries(global_cfg, fileset)
+    npt, nwp = len(global_cfg.pt_edges), len(global_cfg.tagger.wps)
+    # number of the coastline levels (i.e. the sfBDT cuts) derived in step 2, see derive_coastline_map
+    coastline_params = get_coastline_params(global_cfg)
+    nbdt = len(np.linspace(0, 1., coastline_params['nlevels'])[coastline_params['skip_levels']:])
+    estimates = {}
+
+    if global_cfg.use_jet_skim and '1' in run_step[:3]:
+        p = SkimCoffeaProcessor(global_cfg=cfg, skimdir=None)
+        estimates['0_skim'] = estimate_coffea_step(global_cfg, '0', p, fileset, entries, workers[0])
+        # the skim stores at most the read columns
+        estimates['0_skim']['disk_bytes'] = estimates['0_skim']['read_bytes']
+
+    if run_step[0] == '1' and global_cfg.reuse_mc_weight_from_routine is None:
+        p = MCReweightCoffeaProcessor(global_cfg=cfg)
+        estimates['1_mc_reweight'] = estimate_coffea_step(global_cfg, '1', p, fileset, entries, workers[0])
+
+    if run_step[1] == '1':
+        p = CoastlineCoffeaProcessor(global_cfg=cfg)
+        est = estimate_coffea_step(global_cfg, '2', p, fileset, entries, workers[1])
+        est['disk_bytes'] += npt * p.nbin2d ** 2 * 8 * 3 # the coastline map
+        estimates['2_coastline'] = est
+
+    if run_step[2] == '1':
+        # book the histograms with the number of coastline levels derived in step 2
+        coastline_map = [{'levels': np.linspace(0, 1., nbdt)} for _ in range(npt)]
+        p = TmplWriterCoffeaProcessor(global_cfg=cfg, coastline_map=coastline_map)
+        est = estimate_coffea_step(global_cfg, '3', p, fileset, entries, workers[2])
+        est['histograms'] = sum(isinstance(h, bh.Histogram) for h in p.accumulator.values())
+        if not global_cfg.skip_tmpl_writing:
+            # each file stores the templates of three flavours for all uncertainty types, and the data
+            est['template_files'] = nwp * npt * nbdt ** 2 * 2
+            hists_per_file = 3 * len(p.write_untypes) + 1
+            # the templates of the diagonal coastline points are also pickled, the others are copied
+            est['disk_bytes'] += (est['template_files'] + nwp * npt * nbdt * 2) * hists_per_file * TMPL_BYTES_PER_HIST
+            est['cpu_hours'] += nwp * npt * TMPL_WRITING_TIME / 3600
+        if not global_cfg.skip_inclusive_plot_writing:
+            nplots = npt * len(p.incl_var_dict) * (nbdt + 1)
+            est['disk_bytes'] += nplots * PLOT_BYTES
+            est['cpu_hours'] += nplots * INCL_PLOT_TIME / 3600
+        estimates['3_tmpl_writer'] = est
+
+    if run_step[3] == '1':
+        modes = [mode for mode, flag in zip(['main', 'sfbdt_rwgt', 'fit_var_rwgt'], \
+            [global_cfg.do_main_fit, global_cfg.do_sfbdt_rwgt_fit, global_cfg.do_fit_var_rwgt_fit]) if flag]
+        ncentral = nwp * npt
+        nother = 0 if global_cfg.run_central_fit_only else nwp * npt * (nbdt ** 2 - 1)
+        skipfit = '_skipfit' if global_cfg.skip_fit else ''
+        est = {'fits': (ncentral + nother) * len(modes), 'disk_bytes': 0, 'cpu_hours': 0.}
+        for mode in modes:
+            est['cpu_hours'] += (ncentral * get_fit_time(global_cfg, mode + '_central' + skipfit) + nother * get_fit_time(global_cfg, mode + skipfit)) / 3600
+            est['disk_bytes'] += ncentral * FIT_BYTES['central'] + nother * FIT_BYTES['other']
+        if global_cfg.test_n_fit != -1:
+            scale = min(1., global_cfg.test_n_fit / max(est['fits'], 1))
+            est.update(fits=min(est['fits'], global_cfg.test_n_fit), disk_bytes=est['disk_bytes'] * scale, cpu_hours=est['cpu_hours'] * scale)
+        estimates['4_fit'] = est
+
+    return estimates
+
+
+def format_bytes(nbytes):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if nbytes < 1024:
+            return f'{nbytes:.1f} {unit}'
+        nbytes /= 1024
+    return f'{nbytes:.1f} TB'
+
+
+def print_estimates(global_cfg, estimates):
+    job_name = global_cfg.routine_name + '_' + str(global_cfg.year)
+    lines = [f'Estimated resources of routine {job_name} (dry run, no events processed):']
+    lines.append(f'  {"step":<15}{"events":>12}{"read":>12}{"memory":>12}{"disk":>12}{"CPU-hours":>12}  details')
+    for step, est in estimates.items():
+        details = ', '.join(f'{k.replace("_", " ")}: {est[k]}' for k in ['histograms', 'template_files', 'fits'] if k in est)
+        lines.append(
+            f'  {step:<15}{est.get("events", "-"):>12}{format_bytes(est["read_bytes"]) if "read_bytes" in est else "-":>12}'
+            f'{format_bytes(est["memory_bytes"]) if "memory_bytes" in est else "-":>12}{format_bytes(est["disk_bytes"]):>12}{est["cpu_hours"]:>12.2f}  {details}'
+        )
+    lines.append(
+        f'  {"total":<15}{"":>12}{format_bytes(sum(est.get("read_bytes", 0) for est in estimates.values())):>12}'
+        f'{format_bytes(max([est.get("memory_bytes", 0) for est in estimates.values()] + [0])):>12}'
+        f'{format_bytes(sum(est["disk_bytes"] for est in estimates.values())):>12}{sum(est["cpu_hours"] for est in estimates.values()):>12.2f}'
+    )
+    _logger.info('\n'.join(lines))
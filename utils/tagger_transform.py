@@ -0,0 +1,59 @@
+"""
+The tagger transformation map (used in step 2 and 3), mapping the tagger score to its cumulative signal distribution.
+The cubic interpolation of the cumulative distribution is tabulated once on a dense uniform grid over the tagger span,
+then evaluated by a vectorized linear lookup. The map only holds numpy arrays, so it is cheap to ship to the workers.
+
+"""
+
+import numpy as np
+import scipy.interpolate
+
+# number of grid intervals over the tagger span. The linear interpolation error (~ step^2 * max|f''| / 8) is then far
+# below the correction needed to make the cubic map monotone (typically O(1e-5))
+NGRID_DEFAULT = 2**14
+# number of test points per grid interval to measure the deviation from the cubic map
+NTEST_PER_INTERVAL = 4
+
+
+class TaggerTransformMap:
+    r"""Monotone lookup table of the cubic interpolation of the tagger cumulative distribution.
+
+    The cubic interpolation may slightly overshoot where the distribution is steep, breaking the monotonicity. The
+    tabulated values are replaced by the average of their running maximum from the left and running minimum from the
+    right, which is non-decreasing, and clipped to the range of the cumulative distribution (so that the span edges are
+    mapped exactly to 0 and 1); the linear lookup between the grid points is thus monotone. The maximum deviation
+    from the cubic map, measured on a finer grid, is stored in `max_deviation`. Tagger values beyond the span are
+    mapped to the edge values.
+
+    Arguments:
+        x: the tagger values of the nodes (i.e. the bin edges over the tagger span)
+        y_cum: the cumulative distribution at the nodes
+        ngrid: number of grid intervals
+    """
+
+    def __init__(self, x, y_cum, ngrid=NGRID_DEFAULT):
+        self.x, self.y_cum = np.asarray(x, dtype=np.float64), np.asarray(y_cum, dtype=np.float64)
+        self.tmin, self.tmax = self.x[0], self.x[-1]
+        self.ngrid = ngrid
+        self.inv_step = ngrid / (self.tmax - self.tmin)
+
+        fcubic = self.cubic_map()
+        grid = fcubic(np.linspace(self.tmin, self.tmax, ngrid + 1))
+        self.grid = (np.maximum.accumulate(grid) + np.minimum.accumulate(grid[::-1])[::-1]) / 2
+        self.grid = np.clip(self.grid, self.y_cum[0], self.y_cum[-1])
+        self.is_monotone = bool(np.all(np.diff(grid) >= 0))
+
+        t = np.linspace(self.tmin, self.tmax, ngrid * NTEST_PER_INTERVAL + 1)
+        self.max_deviation = float(np.max(np.abs(self(t) - fcubic(t))))
+
+
+    def cubic_map(self):
+        r"""The reference cubic interpolation of the cumulative distribution"""
+        return scipy.interpolate.interp1d(self.x, self.y_cum, kind='cubic')
+
+
+    def __call__(self, tagger):
+        tagger = np.asarray(tagger, dtype=np.float64)
+        u = np.clip((tagger - self.tmin) * self.inv_step, 0., self.ngrid)
+        i = np.minimum(np.nan_to_num(u).astype(np.int64), self.ngrid - 1) # NaN inputs are propagated by u
+        return self.grid[i] + (u - i) * (self.grid[i + 1] - self.grid[i])
@@ -1,11 +1,18 @@
-import awkward as ak
 import numpy as np
+import hashlib
+import json
 import re
+import os
+from contextlib import contextmanager
 
 from logger import _logger
 
+# awkward and uproot are only imported in the functions using them: the launcher and the units import the light helpers
+# of this module (e.g. `hash_object`) at startup
+
 def lookup_pt_based_weight(weight_map, pt_reweight_edges, jet_idx, jet_pt, jet_var, jet_var_maxlimit=None, read_suffix=''):
     r"""Obtain the pT-based weight using the weight map. jet_idx: 'fj1' or 'fj2'."""
+    import awkward as ak
 
     assert jet_var_maxlimit is not None, "Need to specify a jet_var_maxlimit."
     # flatten the 2d weight factor map
@@ -45,14 +52,16 @@ def parse_tagger_expr(tagger_name_replace_map, expr):
     return expr
 
 
+def get_variable_names(expr, exclude=['awkward', 'ak', 'np', 'numpy', 'math']):
+    """Extract variables in the expr"""
+    import ast
+    root = ast.parse(expr)
+    return sorted({node.id for node in ast.walk(root) if isinstance(node, ast.Name) and not node.id.startswith('_')} - set(exclude))
+
+
 def eval_expr(expr, events):
     """A function that can do `eval` to the awkward array, immitating the behavior of `eval` in pandas."""
-    
-    def get_variable_names(expr, exclude=['awkward', 'ak', 'np', 'numpy', 'math']):
-        """Extract variables in the expr"""
-        import ast
-        root = ast.parse(expr)
-        return sorted({node.id for node in ast.walk(root) if isinstance(node, ast.Name) and not node.id.startswith('_')} - set(exclude))
+    import awkward as ak
 
     try:
         return ak.numexpr.evaluate(expr, events)
@@ -61,3 +70,145 @@ def eval_expr(expr, events):
         tmp = {k: events[k] for k in get_variable_names(expr)}
         tmp.update({'math': math, 'numpy': np, 'np': np, 'awkward': ak, 'ak': ak})
         return eval(expr, tmp)
+
+
+def get_event_preselection(events, global_cfg, evaluator=None):
+    r"""The event preselection: MET filters and the OR of the HLT_PFHT* triggers of the given year. If an `ExprEvaluator`
+        of the chunk is given, the preselection is evaluated once and shared by both jets."""
+    import awkward as ak
+    expr = 'passmetfilters & (' + '|'.join(global_cfg.hlt_branches[global_cfg.year]) + ')'
+    if evaluator is not None:
+        return evaluator.evaluate(expr)
+    return ak.numexpr.evaluate(expr, events)
+
+
+def get_jet_selection(events, jetidx, global_cfg, on_skim=False, evaluator=None):
+    r"""The event mask for the jet `fj_{jetidx}` (jetidx: '1' or '2') passing the event preselection, the jet quality and
+        the custom selection, as a numpy array. Return the mask and the prefix to access the jet branches.
+        On the jet-level skim written in step 0 the selections are already applied, hence only the jet index is selected
+        and the jet branches are accessed with the 'fj_x' placeholder.
+    """
+    import awkward as ak
+    if on_skim:
+        return ak.to_numpy(events.jetidx == int(jetidx)), 'fj_x'
+
+    fj = f'fj_{jetidx}'
+    presel = ak.to_numpy(get_event_preselection(events, global_cfg, evaluator))
+    sel = presel & ak.to_numpy(events[f'{fj}_is_qualified'])
+    if global_cfg.custom_selection is not None:
+        expr = global_cfg.custom_selection.replace('fj_x', fj)
+        sel = sel & ak.to_numpy(evaluator.evaluate(expr) if evaluator is not None else ak.numexpr.evaluate(expr, events))
+    return sel, fj
+
+
+def select_jets(events, jetidx, global_cfg, on_skim=False):
+    r"""Select events for the jet `fj_{jetidx}`, see `get_jet_selection`. Return the selected events and the prefix to access
+        the jet branches."""
+    sel, fj = get_jet_selection(events, jetidx, global_cfg, on_skim=on_skim)
+    return events[sel], fj
+
+
+def get_columns(global_cfg, event_branches, jet_branches, exprs=[], on_skim=False):
+    r"""Expand the branches declared by a processor into the columns read from the input tree. Jet-level branches are given in
+        the 'fj_x' placeholder format, and the variables used in `exprs` are added. The columns used in the event and jet
+        selection are included unless reading the jet-level skim, where the selections are already applied.
+    """
+    event_branches, jet_branches = list(event_branches), list(jet_branches)
+    if not on_skim:
+        event_branches += ['passmetfilters'] + global_cfg.hlt_branches[global_cfg.year]
+        jet_branches += ['fj_x_is_qualified']
+        if global_cfg.custom_selection is not None:
+            exprs = list(exprs) + [global_cfg.custom_selection]
+    for expr in exprs:
+        for var in get_variable_names(expr):
+            (jet_branches if var.startswith('fj_x_') else event_branches).append(var)
+
+    if on_skim:
+        return sorted(set(event_branches + jet_branches + ['jetidx']))
+    return sorted(set(event_branches + [b.replace('fj_x', f'fj_{i}') for b in jet_branches for i in '12']))
+
+
+_decompression_executors = {}
+# columns of the chunks being shared by multiple processors, keyed by the chunk
+_column_cache = {}
+
+def read_columns(metadata, columns, decompression_workers=1):
+    r"""Read the columns of a chunk in one bulk uproot read, with the baskets decompressed in parallel threads. Return the dict
+        of arrays and the number of bytes read from the file. Columns not in the tree (e.g. the weight branches in data) are skipped.
+    """
+    import uproot
+    executor = None
+    if decompression_workers > 1:
+        # one thread pool per (forked) worker process
+        key = (os.getpid(), decompression_workers)
+        if key not in _decompression_executors:
+            _decompression_executors[key] = uproot.ThreadPoolExecutor(num_workers=decompression_workers)
+        executor = _decompression_executors[key]
+
+    with uproot.open(metadata['filename']) as f:
+        tree = f[metadata['treename']]
+        arrays = tree.arrays(
+            [c for c in columns if c in tree], entry_start=metadata['entrystart'], entry_stop=metadata['entrystop'],
+            decompression_executor=executor, how=dict,
+        )
+        nbytes = f.file.source.num_requested_bytes
+    return arrays, nbytes
+
+
+def get_chunk_id(metadata):
+    return (metadata['filename'], metadata['treename'], metadata['entrystart'], metadata['entrystop'])
+
+
+def prefetch_columns(events, columns, decompression_workers=1):
+    r"""Read the declared columns of a chunk and return them as a flat record array used in place of the lazy events, together
+        with the number of bytes read. Columns already read by `cached_columns` for the chunk are served from the cache.
+    """
+    import awkward as ak
+    chunk = get_chunk_id(events.metadata)
+    if chunk in _column_cache:
+        arrays, nbytes = {c: _column_cache[chunk][c] for c in columns if c in _column_cache[chunk]}, 0
+    else:
+        arrays, nbytes = read_columns(events.metadata, columns, decompression_workers)
+    return ak.zip(arrays, depth_limit=1), nbytes
+
+
+@contextmanager
+def cached_columns(events, columns, decompression_workers=1):
+    r"""Read the columns of a chunk once and share them among all processors calling `prefetch_columns` on the chunk
+        within the context. Yield the number of bytes read."""
+    chunk = get_chunk_id(events.metadata)
+    _column_cache[chunk], nbytes = read_columns(events.metadata, columns, decompression_workers)
+    try:
+        yield nbytes
+    finally:
+        _column_cache.pop(chunk, None)
+
+
+def hash_object(obj):
+    r"""Return a stable hex digest of a JSON-serializable object. Namespaces (e.g. the global config) are hashed by their content.
+        Other objects are not supported, as their pickled form is not stable across runs: fingerprint their inputs instead."""
+
+    def default(o):
+        if not hasattr(o, '__dict__'):
+            raise TypeError(f'Cannot hash an object of type {type(o).__name__}.')
+        return o.__dict__
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=default).encode()).hexdigest()
+
+
+def get_file_identity(path):
+    r"""Identify an input file by its path, size, and modification time (only the path for remote files)"""
+    if not os.path.isfile(path):
+        return (path,)
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def get_file_hash(path):
+    r"""Identify an artifact by its content"""
+    if not os.path.isfile(path):
+        return None
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
@@ -1,25 +1,321 @@
+import awkward as ak
 import numpy as np
-import xgboost as xgb
+import hashlib
+import struct
+import json
+import uuid
+import os
+
+from utils.tools import hash_object, get_file_identity, get_file_hash
+
+# xgboost is only imported when the models are loaded: the workers evaluating a `FlatTreeEnsemble` do not need it. numba
+# is only imported when the flat trees are evaluated
+
+
+def get_input_matrix(inputs, var_list):
+    r"""Assemble the inputs into a (njets, nvars) float32 matrix (the precision used by xgboost internally), column by column"""
+    mat = np.empty((len(inputs[var_list[0]]), len(var_list)), dtype=np.float32)
+    for j, k in enumerate(var_list):
+        mat[:, j] = ak.to_numpy(inputs[k])
+    return mat
+
 
 class XGBHelper:
 
     def __init__(self, model_file, var_list):
+        import xgboost as xgb
         self.bst = xgb.Booster(params={'nthread': 1}, model_file=model_file)
         self.var_list = var_list
         print('Load XGBoost model %s, input variables:\n  %s' % (model_file, str(var_list)))
 
     def eval(self, inputs):
+        import xgboost as xgb
         dmat = xgb.DMatrix(np.array([inputs[k] for k in self.var_list]).T, feature_names=self.var_list)
         return self.bst.predict(dmat)
 
 class XGBEnsemble:
+    r"""The k-fold sfBDT models, predicting the average of the folds. The inputs are assembled into one contiguous float32
+        matrix (the precision used by xgboost internally, so the predictions are unchanged), from which a single DMatrix is
+        built and shared by all folds. Each fold is still predicted by its own call.
 
-    def __init__(self, model_files, var_list):
-        self.bst_list = [xgb.Booster(params={'nthread': 1}, model_file=f) for f in model_files]
+    Arguments:
+        model_files: the model file of each fold
+        var_list: the input variables
+        nthread: number of threads used by xgboost in the prediction
+    """
+
+    def __init__(self, model_files, var_list, nthread=1):
+        import xgboost as xgb
+        self.bst_list = [xgb.Booster(params={'nthread': nthread}, model_file=f) for f in model_files]
         self.var_list = var_list
+        self.nthread = nthread
         print('Load XGBoost models:\n  %s, \ninput variables:\n  %s' % ('\n  '.join(model_files), str(var_list)))
 
     def eval(self, inputs):
-        dmat = xgb.DMatrix(np.array([inputs[k] for k in self.var_list]).T, feature_names=self.var_list)
+        return self.eval_matrix(get_input_matrix(inputs, self.var_list))
+
+    def eval_matrix(self, mat):
+        r"""Predict from the float32 input matrix given by `get_input_matrix`"""
+        import xgboost as xgb
+        if len(mat) == 0:
+            return np.zeros(0, dtype=np.float32)
+        dmat = xgb.DMatrix(mat, feature_names=self.var_list, nthread=self.nthread)
         preds = np.array([bst.predict(dmat) for bst in self.bst_list])
-        return preds.sum(axis=0) / len(self.bst_list)
\ No newline at end of file
+        return preds.sum(axis=0) / len(self.bst_list)
+
+
+def read_xgb_trees(model_file):
+    r"""Read the trees of a binary classification or regression gbtree model. Return the objective, the base margin,
+        whether the base margin is added before the trees in the prediction (as in xgboost >= 1.0; otherwise after their
+        sum), and the list of trees, each given as a dict of the node arrays. The left child of a leaf is -1, and its
+        value is stored in the split condition. The model is read in the JSON format if supported by the xgboost version
+        (>= 1.3), otherwise the binary format of the former versions is parsed."""
+    import xgboost as xgb
+    bst = xgb.Booster(params={'nthread': 1}, model_file=model_file)
+    try:
+        model = json.loads(bytes(bst.save_raw(raw_format='json')))
+    except TypeError:
+        return parse_legacy_xgb_model(bytes(bst.save_raw()))
+
+    learner = model['learner']
+    assert learner['gradient_booster']['name'] == 'gbtree', 'Only gbtree models are supported.'
+    base_score = float(np.ravel(json.loads(learner['learner_model_param']['base_score']))[0]) # probability, e.g. "5E-1" or "[5E-1]"
+    objective = learner['objective']['name']
+    trees = []
+    for tree in learner['gradient_booster']['model']['trees']:
+        trees.append({
+            'left': np.array(tree['left_children'], dtype=np.int32),
+            'right': np.array(tree['right_children'], dtype=np.int32),
+            'feature': np.array(tree['split_indices'], dtype=np.int32),
+            'split': np.array(tree['split_conditions'], dtype=np.float32),
+            'default_left': np.array(tree['default_left'], dtype=np.bool_),
+        })
+    assert all(group == 0 for group in learner['gradient_booster']['model']['tree_info']), 'Only single-output models are supported.'
+    return objective, prob_to_margin(objective, base_score), True, trees
+
+
+def parse_legacy_xgb_model(raw):
+    r"""Parse the binary model format of xgboost < 1.0 (the base margin is stored already transformed)"""
+    if raw[:4] == b'binf':
+        raw = raw[4:]
+    def read_string(pos):
+        length, = struct.unpack_from('<Q', raw, pos)
+        return raw[pos + 8: pos + 8 + length].decode(), pos + 8 + length
+
+    # learner parameters: base_score, num_feature, num_class, and reserved fields (136 bytes)
+    base_margin, _, num_class = struct.unpack_from('<fIi', raw, 0)
+    objective, pos = read_string(136)
+    booster, pos = read_string(pos)
+    assert booster == 'gbtree', 'Only gbtree models are supported.'
+    assert num_class == 0, 'Only single-output models are supported.'
+    # gbtree parameters: num_trees, num_roots, num_feature, padding, num_pbuffer (int64), num_output_group, ... (160 bytes)
+    num_trees, = struct.unpack_from('<i', raw, pos)
+    pos += 160
+    trees = []
+    for _ in range(num_trees):
+        # tree parameters: num_roots, num_nodes, ... (148 bytes); nodes: parent, left, right, split index with the default
+        # direction in the highest bit, split condition or leaf value (20 bytes); node statistics (16 bytes)
+        num_roots, num_nodes, _, _, _, size_leaf_vector = struct.unpack_from('<6i', raw, pos)
+        assert num_roots == 1 and size_leaf_vector == 0, 'Only trees with a single root and scalar leaves are supported.'
+        pos += 148
+        nodes = np.frombuffer(raw, dtype=np.dtype([('parent', '<i4'), ('left', '<i4'), ('right', '<i4'), ('sindex', '<u4'), ('info', '<f4')]), count=num_nodes, offset=pos)
+        pos += 20 * num_nodes + 16 * num_nodes
+        trees.append({
+            'left': nodes['left'].astype(np.int32),
+            'right': nodes['right'].astype(np.int32),
+            'feature': (nodes['sindex'] & 0x7fffffff).astype(np.int32),
+            'split': nodes['info'].astype(np.float32),
+            'default_left': (nodes['sindex'] >> 31).astype(np.bool_),
+        })
+    assert all(group == 0 for group in np.frombuffer(raw, dtype='<i4', count=num_trees, offset=pos)), 'Only single-output models are supported.'
+    return objective, np.float32(base_margin), False, trees
+
+
+def prob_to_margin(objective, base_score):
+    r"""Transform the base score into the base margin in float32 as xgboost. The logarithm is computed in double precision
+        and rounded, which gives the correctly rounded result of the C library as used by xgboost."""
+    if objective == 'binary:logistic':
+        return -np.float32(np.log(np.float64(np.float32(1.) / np.float32(base_score) - np.float32(1.))))
+    if objective in ('reg:linear', 'reg:squarederror'):
+        return np.float32(base_score)
+    raise ValueError(f'Unsupported objective of the sfBDT model: {objective}')
+
+
+def predict_flat_trees(x, left, right, feature, split, default_left, roots, fold_offsets, base_margins, base_margin_first):
+    r"""Sum the leaf values of the trees of each fold for each row of `x`, in float32 and in the same order as xgboost.
+        The missing values (NaN) follow the default direction. Return the margins in the shape (nfold, nrows)."""
+    nfold = len(fold_offsets) - 1
+    out = np.empty((nfold, x.shape[0]), dtype=np.float32)
+    for i in range(x.shape[0]):
+        for k in range(nfold):
+            psum = base_margins[k] if base_margin_first else np.float32(0.)
+            for t in range(fold_offsets[k], fold_offsets[k + 1]):
+                node = roots[t]
+                while left[node] >= 0:
+                    value = x[i, feature[node]]
+                    if np.isnan(value):
+                        node = left[node] if default_left[node] else right[node]
+                    elif value < split[node]:
+                        node = left[node]
+                    else:
+                        node = right[node]
+                psum += split[node]
+            out[k, i] = psum if base_margin_first else psum + base_margins[k]
+    return out
+
+
+# compiled by numba on the first evaluation of the flat trees in this process
+_predict_flat_trees_kernel = None
+
+def get_flat_trees_kernel():
+    r"""The numba kernel of `predict_flat_trees`"""
+    global _predict_flat_trees_kernel
+    if _predict_flat_trees_kernel is None:
+        import numba
+        _predict_flat_trees_kernel = numba.njit(nogil=True)(predict_flat_trees)
+    return _predict_flat_trees_kernel
+
+
+class FlatTreeEnsemble:
+    r"""The k-fold sfBDT models compiled into flat node arrays (all trees of all folds concatenated), evaluated by a numba
+        kernel. It predicts the same as `XGBEnsemble` up to the float32 rounding of the output transformation, and only
+        holds numpy arrays: the models are read with xgboost once, while the workers need neither xgboost nor the boosters.
+
+    Arguments:
+        model_files: the model file of each fold
+        var_list: the input variables
+    """
+
+    def __init__(self, model_files, var_list):
+        self.var_list = var_list
+        objectives, orders, base_margins, trees, fold_offsets = set(), set(), [], [], [0]
+        for f in model_files:
+            objective, base_margin, base_margin_first, fold_trees = read_xgb_trees(f)
+            objectives.add(objective)
+            orders.add(base_margin_first)
+            base_margins.append(base_margin)
+            trees += fold_trees
+            fold_offsets.append(len(trees))
+        assert len(objectives) == 1, 'The folds should share the same objective.'
+        self.objective = objectives.pop()
+        self.base_margin_first = orders.pop()
+        prob_to_margin(self.objective, 0.5) # check the objective is supported
+        self.base_margins = np.array(base_margins, dtype=np.float32)
+        self.fold_offsets = np.array(fold_offsets, dtype=np.int64)
+
+        # concatenate the nodes, shifting the child indices by the node offset of each tree
+        offsets = np.cumsum([0] + [len(tree['left']) for tree in trees])
+        self.roots = offsets[:-1].astype(np.int64)
+        self.left = np.concatenate([np.where(tree['left'] >= 0, tree['left'] + offset, -1) for tree, offset in zip(trees, offsets)]).astype(np.int64)
+        self.right = np.concatenate([np.where(tree['left'] >= 0, tree['right'] + offset, -1) for tree, offset in zip(trees, offsets)]).astype(np.int64)
+        self.feature = np.concatenate([tree['feature'] for tree in trees]).astype(np.int64)
+        self.split = np.concatenate([tree['split'] for tree in trees])
+        self.default_left = np.concatenate([tree['default_left'] for tree in trees])
+        assert self.feature[self.left >= 0].max(initial=0) < len(var_list), 'The models use more input variables than given.'
+        print('Compile XGBoost models (%d trees, %d nodes):\n  %s, \ninput variables:\n  %s' % (
+            len(trees), len(self.left), '\n  '.join(model_files), str(var_list)))
+
+    def eval(self, inputs):
+        return self.eval_matrix(get_input_matrix(inputs, self.var_list))
+
+    def eval_matrix(self, mat):
+        r"""Predict from the float32 input matrix given by `get_input_matrix`"""
+        margins = get_flat_trees_kernel()(
+            mat, self.left, self.right, self.feature, self.split, self.default_left, self.roots, self.fold_offsets, self.base_margins,
+            self.base_margin_first,
+        )
+        if self.objective == 'binary:logistic':
+            # same float32 sigmoid as xgboost, with the exponential rounded from double precision (see `prob_to_margin`)
+            preds = np.float32(1.) / (np.float32(1.) + np.exp(-margins.astype(np.float64)).astype(np.float32))
+        else:
+            preds = margins
+        return preds.sum(axis=0) / len(self.base_margins)
+
+
+class SFBDTCache:
+    r"""On-disk cache of the sfBDT predictions of the selected jets in each chunk, shared by the steps and their reruns.
+        The predictions are keyed by the model (content of the model files and the input expressions), the input file (path,
+        size, and modification time), the tree and entry range of the chunk, a tag of the jet collection and its variation
+        (e.g. `fj1_nominal`, `fj1_jesUp`), and the jet selection. Each prediction is stored in a separate .npy file.
+
+    Arguments:
+        cachedir: the cache directory
+        model_key: identifier of the model
+    """
+
+    def __init__(self, cachedir, model_key):
+        self.cachedir = os.path.abspath(cachedir)
+        self.model_key = model_key
+
+
+    def get_path(self, metadata, tag, mask):
+        key = hash_object([
+            self.model_key, get_file_identity(metadata['filename']), metadata['treename'], metadata['entrystart'], metadata['entrystop'],
+            tag, len(mask), hashlib.sha1(np.packbits(mask)).hexdigest(),
+        ])
+        return os.path.join(self.cachedir, key[:2], key + '.npy')
+
+
+    def load(self, path, size):
+        r"""Load the stored predictions, or return None if missing or corrupted"""
+        if not os.path.isfile(path):
+            return None
+        try:
+            values = np.load(path)
+        except (OSError, ValueError):
+            return None # a corrupted file is overwritten
+        return values if len(values) == size else None
+
+
+    def store(self, path, values):
+        # written atomically, as several workers may store the same prediction
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = path + f'.{uuid.uuid4().hex}.tmp'
+        with open(tmppath, 'wb') as fw:
+            np.save(fw, values)
+        os.replace(tmppath, path)
+
+
+    def get_many(self, metadata, tags, mask, predict, counter=None):
+        r"""Return the predictions of the jets selected by `mask` for each tag in a dict. The missing predictions are
+            obtained by a single call of `predict` with the list of the missing tags, returning their predictions in the
+            same order, and are stored. Hits and misses are counted in `counter` if given."""
+        paths = {tag: self.get_path(metadata, tag, mask) for tag in tags}
+        values = {tag: self.load(paths[tag], np.count_nonzero(mask)) for tag in tags}
+        missing = [tag for tag in tags if values[tag] is None]
+        if len(missing) > 0:
+            for tag, value in zip(missing, predict(missing)):
+                values[tag] = np.asarray(value)
+                self.store(paths[tag], values[tag])
+        if counter is not None:
+            counter['hits'] += len(tags) - len(missing)
+            counter['misses'] += len(missing)
+        return values
+
+
+    def get(self, metadata, tag, mask, predict, counter=None):
+        r"""Return the cached predictions of the jets selected by `mask` for one tag, or call `predict` and store its outputs"""
+        return self.get_many(metadata, [tag], mask, lambda tags: [predict()], counter=counter)[tag]
+
+
+def get_sfbdt_model_files(global_cfg):
+    return [global_cfg.custom_sfbdt_path + '.%d' % i for i in range(global_cfg.custom_sfbdt_kfold)]
+
+
+def load_sfbdt_model(global_cfg):
+    r"""The customized sfBDT model, evaluated with xgboost or compiled into flat trees depending on `sfbdt_backend`"""
+    assert global_cfg.sfbdt_backend in ['xgboost', 'flat'], "The sfBDT backend must be 'xgboost' or 'flat'."
+    if global_cfg.sfbdt_backend == 'flat':
+        return FlatTreeEnsemble(get_sfbdt_model_files(global_cfg), global_cfg.sfbdt_input_exprs)
+    return XGBEnsemble(get_sfbdt_model_files(global_cfg), global_cfg.sfbdt_input_exprs, nthread=global_cfg.sfbdt_nthread)
+
+
+def make_sfbdt_cache(global_cfg):
+    r"""The on-disk cache of the custom sfBDT predictions shared by step 2 and 3, or None if not used"""
+    if global_cfg.custom_sfbdt_path is None or not global_cfg.sfbdt_cache:
+        return None
+    model_key = hash_object([
+        [get_file_hash(path) for path in get_sfbdt_model_files(global_cfg)], list(global_cfg.sfbdt_input_exprs), global_cfg.sfbdt_backend,
+    ])
+    cachedir = os.path.join('output', global_cfg.routine_name + '_' + str(global_cfg.year), 'sfbdt_cache')
+    return SFBDTCache(cachedir, model_key)